@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2026 Runmaker4 contributors
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+#
+# Measures how runmaker4 scales: parse time, claim latency, and dispatch throughput
+# on synthetic job files. Results are printed as JSON lines.
+#
+
+from __future__ import print_function
+import functools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+# directory containing runmaker4.py and friends
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASEDIR)
+import runmaker4
+
+
+def generate(fname, lines, run, cmd_length, failed):
+    """
+    Write a job file of the given number of lines, of which (evenly spread) run lines are pristine.
+    Of the other lines, the given fraction is marked failed, the rest done.
+    """
+
+    rnd = random.Random(lines)
+    stride = max(1, lines // max(1, run))
+    with open(fname, 'w') as outf:
+        for i in range(lines):
+            if i % stride == 0 and i // stride < run:
+                state = '.'
+            elif rnd.random() < failed:
+                state = '!'
+            else:
+                state = 'd'
+            cmd = "true %d" % i
+            outf.write("%s %s\n" % (state, cmd.ljust(cmd_length, "x")))
+
+
+def percentiles(values):
+    """
+    Return a dict of summary statistics (in milliseconds) of a list of durations (in seconds).
+    """
+
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {}
+    for p in (50, 90, 99):
+        result["p%d_ms" % p] = values[min(len(values) - 1, len(values) * p // 100)] * 1000
+    result["max_ms"] = values[-1] * 1000
+    return result
+
+
+def run_child(args):
+    """
+    Run a command, return its wall clock time and peak RSS (in kilobytes).
+    """
+
+    devnull = open(os.devnull, 'w')
+    t0 = time.time()
+    p = subprocess.Popen(args, stdout=devnull, stderr=devnull)
+    (pid, status, rusage) = os.wait4(p.pid, 0)
+    wall = time.time() - t0
+    devnull.close()
+    return (wall, rusage.ru_maxrss, status)
+
+
+def bench_parse(fname, options):
+    """
+    Measure the time needed to parse a job file, and the resulting peak RSS.
+    """
+
+    code = "import sys, time; sys.path.insert(0, %r); import runmaker4; f = open(%r, 'rb'); t0 = time.time(); runmaker4.read_jobs(f); print(time.time() - t0)" % (BASEDIR, fname)
+    p = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE)
+    out = p.stdout.read()
+    (pid, status, rusage) = os.wait4(p.pid, 0)
+    return {"parse_s": float(out), "rss_kb": rusage.ru_maxrss}
+
+
+def claim_worker(fname, queue):
+    """
+    Claim all pristine jobs of a file (without running them), report claim latencies.
+    """
+
+    f = open(fname, 'rb+', 0)
+    jobs = runmaker4.read_jobs(f)
+    latencies = []
+    claimed = 0
+    for job in jobs:
+        if job.state != '.':
+            continue
+        t0 = time.time()
+        ok = runmaker4.set_job_state(f, job, '?')
+        latencies.append(time.time() - t0)
+        if ok:
+            claimed = claimed + 1
+    f.close()
+    queue.put((claimed, latencies))
+
+
+def bench_claim(fname, num_jobs, options):
+    """
+    Measure claim latency and throughput of num_jobs processes claiming jobs concurrently.
+    """
+
+    queue = multiprocessing.Queue()
+    children = [multiprocessing.Process(target=claim_worker, args=(fname, queue)) for i in range(num_jobs)]
+    t0 = time.time()
+    for child in children:
+        child.start()
+    results = [queue.get() for child in children]
+    wall = time.time() - t0
+    for child in children:
+        child.join()
+    claimed = sum(r[0] for r in results)
+    latencies = [l for r in results for l in r[1]]
+    result = {"claimed": claimed, "attempts": len(latencies), "wall_s": wall, "claims_per_s": claimed / wall}
+    result.update(percentiles(latencies))
+    return result
+
+
+def bench_file(fname, num_jobs, options):
+    """
+    Measure dispatch throughput of runmaker4.py, running all pristine jobs.
+    """
+
+    (wall, rss, status) = run_child([sys.executable, os.path.join(BASEDIR, "runmaker4.py"), "-j", str(num_jobs), fname])
+    return {"jobs": options.run, "wall_s": wall, "jobs_per_s": options.run / wall, "rss_kb": rss}
+
+
+def connect(address):
+    """
+    Return a socket connected to a server's Unix domain socket (if the address is a path) or TCP port.
+    """
+
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        return sock
+    return socket.create_connection(address)
+
+
+def server_worker(address, token, queue):
+    """
+    Fetch jobs from a server until none are left (without running them), report GET latencies.
+    """
+
+    latencies = []
+    while True:
+        t0 = time.time()
+        sock = connect(address)
+        sock.sendall(("GET " + token).encode())
+        response = sock.recv(2048).decode()
+        sock.sendall("ACK".encode())
+        sock.close()
+        latencies.append(time.time() - t0)
+        number = int(response.split(" ", 1)[0])
+        if number == -1:
+            break
+        if number == 0:
+            time.sleep(0.1)
+            continue
+        for state in ('r', 'd'):
+            sock = connect(address)
+            sock.sendall(("SET %s %d %s" % (token, number, state)).encode())
+            sock.recv(2048)
+            sock.close()
+    queue.put(latencies)
+
+
+def bench_server(fname, num_clients, options, transport="tcp"):
+    """
+    Measure GET latency and dispatch throughput of runmaker4-server.py with many clients over loopback,
+    using a TCP port ("tcp"), a TCP port shared by several accept loops ("reuseport"), or a Unix domain socket ("unix").
+    """
+
+    tmpdir = tempfile.mkdtemp(prefix="runbench4-")
+    tokenfile = os.path.join(tmpdir, "bench.token")
+    port = options.port
+    args = []
+    address = ("127.0.0.1", port)
+    if transport == "reuseport":
+        args = ["--accept-loops", str(options.accept_loops)]
+    elif transport == "unix":
+        address = os.path.join(tmpdir, "server.sock")
+        args = ["--socket", address]
+    devnull = open(os.devnull, 'w')
+    server = subprocess.Popen([sys.executable, os.path.join(BASEDIR, "runmaker4-server.py"), "-q", "-p", str(port), "-t", tokenfile, "-l", os.path.join(tmpdir, "server.log")] + args + [fname], stdout=devnull, stderr=devnull)
+    try:
+        # wait for the server to come up
+        while True:
+            try:
+                connect(address).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+        with open(tokenfile) as inf:
+            token = inf.read()
+        queue = multiprocessing.Queue()
+        children = [multiprocessing.Process(target=server_worker, args=(address, token, queue)) for i in range(num_clients)]
+        t0 = time.time()
+        for child in children:
+            child.start()
+        results = [queue.get() for child in children]
+        wall = time.time() - t0
+        for child in children:
+            child.join()
+    finally:
+        server.terminate()
+        server.wait()
+        devnull.close()
+        shutil.rmtree(tmpdir)
+
+    latencies = [l for r in results for l in r]
+    result = {"transport": transport, "jobs": options.run, "gets": len(latencies), "wall_s": wall, "jobs_per_s": options.run / wall}
+    result.update(percentiles(latencies))
+    return result
+
+
+def main():
+    """
+    Program entry point when run interactively.
+    """
+
+    # prepare option parser
+    parser = OptionParser(usage="usage: %prog [options]", description="Measure parse time, claim latency, and dispatch throughput of runmaker4 on synthetic job files.", epilog="Each result is printed as one line of JSON. Benchmarks are parse (reading a job file), claim (claiming jobs from a shared file), file (running jobs with runmaker4.py), and server (fetching jobs from runmaker4-server.py, once for each transport).")
+    parser.add_option("-b", "--benchmarks", dest="benchmarks", default="parse,claim,file,server", help="run the comma-separated list of BENCHMARKS [default: %default]", metavar="BENCHMARKS")
+    parser.add_option("-L", "--lines", dest="lines", default="10000,100000,1000000", help="comma-separated list of job file sizes, in LINES [default: %default]", metavar="LINES")
+    parser.add_option("-r", "--run", dest="run", type="int", default=1000, action="store", help="make NUMBER lines of each file pristine, the rest done or failed [default: %default]", metavar="NUMBER")
+    parser.add_option("-f", "--failed", dest="failed", type="float", default=0.1, action="store", help="mark FRACTION of the non-pristine lines failed [default: %default]", metavar="FRACTION")
+    parser.add_option("-c", "--cmd-length", dest="cmd_length", default="20,200", help="comma-separated list of command LENGTHS [default: %default]", metavar="LENGTHS")
+    parser.add_option("-j", "--jobs", dest="num_jobs", default="1,2,4,8", help="comma-separated list of NUMBERS of parallel jobs (or clients) [default: %default]", metavar="NUMBERS")
+    parser.add_option("-p", "--port", dest="port", type="int", default=9997, action="store", help="TCP PORT for the server benchmark [default: %default]", metavar="PORT")
+    parser.add_option("-T", "--transports", dest="transports", default="tcp,reuseport,unix", help="comma-separated list of TRANSPORTS for the server benchmark: tcp, reuseport (several accept loops), unix (Unix domain socket) [default: %default]", metavar="TRANSPORTS")
+    parser.add_option("-a", "--accept-loops", dest="accept_loops", type="int", default=4, action="store", help="with the reuseport transport, accept connections in NUMBER threads [default: %default]", metavar="NUMBER")
+    parser.add_option("-o", "--output", dest="output", default="", help="append results to FILENAME [default: stdout]", metavar="FILENAME")
+
+    # parse options
+    (options, args) = parser.parse_args()
+
+    benchmarks = options.benchmarks.split(",")
+    outf = sys.stdout
+    if options.output:
+        outf = open(options.output, 'a')
+
+    tmpdir = tempfile.mkdtemp(prefix="runbench4-")
+    fname = os.path.join(tmpdir, "runs.txt")
+    try:
+        for lines in [int(n) for n in options.lines.split(",")]:
+            for cmd_length in [int(n) for n in options.cmd_length.split(",")]:
+                base = {"lines": lines, "cmd_length": cmd_length, "run": options.run, "failed": options.failed, "host": os.uname()[1], "time": time.time()}
+                runs = []
+                if "parse" in benchmarks:
+                    runs.append(("parse", None, bench_parse))
+                for num_jobs in [int(n) for n in options.num_jobs.split(",")]:
+                    for benchmark in ("claim", "file"):
+                        if benchmark in benchmarks:
+                            runs.append((benchmark, num_jobs, globals()["bench_" + benchmark]))
+                    if "server" in benchmarks:
+                        for transport in options.transports.split(","):
+                            runs.append(("server", num_jobs, functools.partial(bench_server, transport=transport)))
+                for (benchmark, num_jobs, func) in runs:
+                    generate(fname, lines, options.run, cmd_length, options.failed)
+                    result = dict(base)
+                    result["benchmark"] = benchmark
+                    if num_jobs is None:
+                        result.update(func(fname, options))
+                    else:
+                        result["num_jobs"] = num_jobs
+                        result.update(func(fname, num_jobs, options))
+                    outf.write(json.dumps(result, sort_keys=True) + "\n")
+                    outf.flush()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if options.output:
+        outf.close()
+
+
+# Start main() when run interactively
+if __name__ == '__main__':
+    main()
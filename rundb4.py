@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2026 Runmaker4 contributors
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+#
+# Converts a text file with jobs to an SQLite job database and back, and shows its state.
+#
+
+from __future__ import print_function
+import os
+import sqlite3
+import sys
+from optparse import OptionParser
+
+# directory containing runmaker4.py and friends
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASEDIR)
+import runmaker4
+
+# tables and indices of a job database
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    number INTEGER PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT '.',
+    priority INTEGER NOT NULL DEFAULT 0,
+    cmd TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL NOT NULL DEFAULT 0,
+    retry_at REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, priority DESC, number);
+"""
+
+
+def open_db(fname):
+    """
+    Open (or create) a job database in WAL mode.
+    """
+
+    db = sqlite3.connect(fname, timeout=60, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def format_annotations(cmd, annotations):
+    """
+    Return a command line, followed by its annotations (if any).
+    """
+
+    if not annotations:
+        return cmd
+    words = [(value and "%s=%s" % (key, value) or key) for (key, value) in sorted(annotations.items())]
+    return "%s #@ %s" % (cmd, " ".join(words))
+
+
+def import_jobs(txtname, dbname, options):
+    """
+    Add the jobs of a text file to a job database, one row per job (expanding parameter sweeps).
+    Jobs keep the numbers they have in the text file.
+    """
+
+    with open(txtname, 'rb') as f:
+        jobs = runmaker4.read_jobs(f)
+
+    for job in jobs:
+        if "after" in job.annotations:
+            print("Job dependencies (`%s') are not supported in job databases" % job.cmd)
+            sys.exit(1)
+
+    def rows():
+        for job in jobs:
+            try:
+                priority = int(job.annotations.get("priority", 0))
+            except ValueError:
+                priority = 0
+            if not job.sweep:
+                yield (job.number, job.state, priority, format_annotations(job.cmd, job.annotations))
+                continue
+            # elements of parameter sweeps take their state from the sweep's file, if there is one
+            states = b""
+            sweepname = "%s.%d.sweep" % (txtname, job.offset)
+            if os.path.exists(sweepname):
+                with open(sweepname, 'rb') as inf:
+                    states = inf.read(job.sweep.size)
+            # each element is a job of its own, no longer a sweep
+            annotations = dict([(key, value) for (key, value) in job.annotations.items() if key != "sweep"])
+            for i in range(job.sweep.size):
+                state = (i < len(states)) and chr(states[i]) or job.state
+                yield (job.number + i, state, priority, format_annotations(runmaker4.expand_sweep(job.sweep, i), annotations))
+
+    db = open_db(dbname)
+    db.execute("BEGIN IMMEDIATE")
+    db.executemany("INSERT OR REPLACE INTO jobs (number, state, priority, cmd) VALUES (?, ?, ?, ?)", rows())
+    db.execute("COMMIT")
+    db.close()
+
+
+def export_jobs(dbname, txtname, options):
+    """
+    Write the jobs of a job database to a text file, one line per job.
+    """
+
+    db = open_db(dbname)
+    with open(txtname, 'w') as outf:
+        for (state, cmd) in db.execute("SELECT state, cmd FROM jobs ORDER BY number"):
+            outf.write("%s %s\n" % (state, cmd))
+    db.close()
+
+
+def show_status(dbname, options):
+    """
+    Print the number of jobs in each state.
+    """
+
+    db = open_db(dbname)
+    for (state, count) in db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state ORDER BY state"):
+        print("%s %d" % (state, count))
+    db.close()
+
+
+def main():
+    """
+    Program entry point when run interactively.
+    """
+
+    # prepare option parser
+    parser = OptionParser(usage="usage: %prog [options] import filename.txt filename.db | export filename.db filename.txt | status filename.db", description="Convert a text file with jobs to an SQLite job database and back, or show the number of jobs in each state.", epilog="Job databases can be used instead of text files by runmaker4.py, runmaker4-server.py, runwait4.py, and runset4.py, if their name ends with .db. Each element of a parameter sweep (a line with a sweep annotation) becomes a job of its own; lines can be given a priority annotation (higher runs first).")
+
+    # parse options
+    (options, args) = parser.parse_args()
+
+    if len(args) == 3 and args[0] == "import":
+        import_jobs(args[1], args[2], options)
+    elif len(args) == 3 and args[0] == "export":
+        export_jobs(args[1], args[2], options)
+    elif len(args) == 2 and args[0] == "status":
+        show_status(args[1], options)
+    else:
+        print(parser.get_usage())
+        sys.exit(1)
+
+
+# Start main() when run interactively
+if __name__ == '__main__':
+    main()
@@ -26,20 +26,87 @@
 #
 
 from __future__ import print_function
+import ast
+import builtins
+import csv
 import fcntl
+import importlib
+import io
+import json
 import os
 import select
+import shlex
 import signal
 import subprocess
 import sys
 import socket
 import multiprocessing
+import multiprocessing.connection
+import queue
 import random
+import threading
 import time
+import traceback
+import zlib
+from collections import deque
 from optparse import OptionParser
 
 LOGWIDTH = 500
 
+# command lines containing any of these characters are run via the shell
+SHELLCHARS = set("|&;<>()$`\\*?[]{}~#!\n")
+
+# command lines starting with any of these words are run via the shell
+SHELLWORDS = set(["cd", "exec", "exit", "export", "set", "source", ".", "ulimit", "umask", "if", "for", "while", "until", "case", "eval", "trap", "unset", "alias", "wait"])
+
+# if tracing, the Trace object events are recorded to
+trace = None
+
+# if forking jobs from a pre-initialized program, the Zygote object
+zygote = None
+
+# once asked to drain (by SIGUSR1 or the drain file), no more jobs are started
+draining = False
+
+# with adaptive concurrency, the shared number of slots (counting from 0) allowed to start jobs
+concurrency = None
+
+# with adaptive concurrency, set (for all slots) once the server said there is nothing left to do
+finished = None
+
+# if sending output to the server, the queue through which slots pass on the last lines of their jobs' output, to be sent in batches
+tail_queue = None
+
+# index of this process among the slots running jobs
+slot = 0
+
+# if pinning jobs, the CPUs this slot's jobs run on
+cpus = None
+
+# number of seconds between checks whether a job's other copy finished
+ABORTCHECKDELAY = 10
+
+# number of seconds between asking a timed out job to terminate, and killing it
+KILLDELAY = 10
+
+# number of seconds between checks whether to drain, if running jobs are to be sent a checkpoint signal
+DRAINCHECKDELAY = 1
+
+# if sending output to the server, number of seconds between sending the last lines of the jobs' output
+TAILDELAY = 10
+
+# number of seconds to wait for the server when sending output, before giving up on it
+TAILTIMEOUT = 5
+
+# lines of output starting with this report results of a job, e.g., "@result key=value key=value"
+RESULTPREFIX = "@result "
+
+# number of seconds to wait (at most) before repeating a failed request to the server, doubling with each consecutive failure
+RETRYDELAY = 0.5
+
+# number of seconds between adjustments of the number of slots allowed to start jobs (and checks whether to start one)
+ADAPTDELAY = 2
+
 class Job:
     """
     Stores a (parsed) line in the job file.
@@ -50,43 +117,825 @@ class Job:
     length = 0
     state = "."
     cmd = ""
+    annotations = {}
+    timed_out = False
+    checkpointed = False
+    results = None
+    cgroup = ""
+    memory_peak = None
+    cpu_time = None
+    oom_killed = False
 
     def __repr__(self):
         return "Job(%s, %s, '%s', '%s')" % (self.offset, self.length, self.state, self.cmd)
 
 
-def set_job_state(job, newstate, host, options):
+class Trace:
+    """
+    Records timestamped events in Chrome trace event format, one JSON object per line.
+    Events are buffered and appended in whole lines, so many processes can share one file.
+    """
+
+    def __init__(self, fname):
+        self.fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.pid = os.getpid()
+        self.lines = []
+        self.last_flush = time.time()
+        self.metadata("process_name", name="%s,%s" % (os.uname()[1], self.pid))
+
+    def metadata(self, kind, **args):
+        self.lines.append(json.dumps({"name": kind, "ph": "M", "pid": self.pid, "tid": self.pid, "args": args}))
+
+    def event(self, kind, start, duration, **args):
+        self.lines.append(json.dumps({"name": kind, "ph": "X", "ts": int(start * 1000000), "dur": int(duration * 1000000), "pid": self.pid, "tid": self.pid, "args": args}))
+        if len(self.lines) >= 1000 or time.time() - self.last_flush >= 1:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            os.write(self.fd, ("\n".join(self.lines) + "\n").encode())
+            self.lines = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+def parse_annotations(cmd):
+    """
+    Split a command line into the command proper and its annotations.
+    Annotations are written as a trailing shell comment "#@ key=value key=value ...",
+    so the shell ignores them if the line is run by an older version.
+    """
+
+    i = cmd.rfind("#@")
+    if i == -1 or (i > 0 and not cmd[i-1].isspace()):
+        return (cmd, {})
+
+    annotations = {}
+    for word in cmd[i+2:].split():
+        (key, sep, value) = word.partition("=")
+        annotations[key] = value
+
+    if "timeout" in annotations:
+        try:
+            timeout = float(annotations["timeout"])
+        except ValueError:
+            timeout = -1
+        if not timeout >= 0:
+            print("ignoring invalid timeout annotation `%s' of `%s'" % (annotations["timeout"], cmd[:i].rstrip()))
+            del annotations["timeout"]
+
+    return (cmd[:i].rstrip(), annotations)
+
+
+def connect_to_server(host, options, timeout=None):
+    """
+    Return a socket connected to the server: to its Unix domain socket if the host is given as a path (containing a slash), to its TCP port otherwise.
+    With a timeout, give up on connecting and on each later send or receive after that many seconds.
+    """
+
+    if "/" in host:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(host)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect((host, options.port))
+    return sock
+
+
+def backoff_delay(failures, options):
+    """
+    Return the number of seconds to wait before repeating a request to the server after the given number of consecutive failures:
+    a random time up to a limit doubling with each failure ("full jitter"), so that many clients do not all come back at once.
+    """
+
+    return random.uniform(0, min(options.max_backoff, RETRYDELAY * 2 ** max(failures - 1, 0)))
+
+
+def busy_delay(response):
+    """
+    Return the number of seconds to wait before asking again if the server said it is busy ("BUSY retry-after=N"), None otherwise.
+    """
+
+    if not response.startswith("BUSY"):
+        return None
+    delay = 1.0
+    for word in response.split()[1:]:
+        (key, sep, value) = word.partition("=")
+        if key == "retry-after":
+            try:
+                delay = float(value)
+            except ValueError:
+                pass
+    return delay + random.uniform(0, delay)
+
+
+def reload_token(options):
+    """
+    Read the token again from its file (if it came from one), as the server might have been restarted with a new one.
+    Return true if the token changed.
+    """
+
+    if not options.token_file:
+        return False
+    try:
+        with open(options.token_file, 'r') as inf:
+            token = inf.read().strip()
+    except IOError:
+        return False
+    if token == options.token:
+        return False
+    options.token = token
+    return True
+
 
-    #do 5 attempts
-    attempts = 5
-    while (attempts > 0):
-        attempts = attempts - 1
+def set_job_state(job, newstate, host, options, payload=b""):
+    """
+    Tell the server about a job's new state, along with the given results (see results_payload) when it is done.
+    Once a job has run, keep trying (up to --set-retries times, 0 meaning forever), so that no finished job is lost while the server is away.
+    """
+
+    limit = options.set_retries
+    if newstate == 'r':
+        limit = options.retries
+    failures = 0
+    while True:
         try:
+            start = time.time()
             #connect to the server
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sa = (host, options.port)
-            sock.connect(sa)
+            sock = connect_to_server(host, options)
             #send command to change job status
-            sock.sendall(("SET " + options.token + " " + str(job.number) + " " + newstate).encode())
+            if payload:
+                sock.sendall(("SET %s %d %s %d\n" % (options.token, job.number, newstate, len(payload))).encode() + payload)
+            else:
+                sock.sendall(("SET " + options.token + " " + str(job.number) + " " + newstate).encode())
             #receive the ack, to be sure server go the message
-            sock.recv(2048).decode()
+            response = sock.recv(2048).decode()
             #close the connection
             sock.close()
+            if response == "INVALID_TOKEN" and reload_token(options):
+                raise IOError("server has a new token")
+            if response == "INVALID_CMD" and payload:
+                #servers older than reporting results along with the state take them separately
+                if not send_results(job, payload, host, options):
+                    #leave the job to be retried
+                    print("Could not send the results of `%s' to the server" % job.cmd)
+                    newstate = 'e'
+                payload = b""
+                continue
+            #asking again will not help with these
+            if response == "INVALID_TOKEN":
+                print("Got invalid token error. Check that token or token file are correct. Quitting")
+                sys.exit(1)
+            if response == "INVALID_CMD":
+                print("Got invalid command error from server. Check the code. Quitting")
+                sys.exit(1)
+            if response != "ACK":
+                raise IOError("server replied %s" % (response or "nothing"))
+            if trace:
+                trace.event("set_job_state", start, time.time() - start, job=job.number, newstate=newstate)
             return
-        except:
+        except (IOError, OSError):
             #if something went wrong, wait a little and try again
-            print("Error connecting to server. Retrying in a few seconds.")
-            time.sleep(random.uniform(0,3))
+            failures = failures + 1
+            if limit and failures >= limit:
+                raise
+            delay = backoff_delay(failures, options)
+            print("Error connecting to server. Retrying in %.1f seconds." % delay)
+            time.sleep(delay)
+
+
+def split_command(cmd):
+    """
+    Split a command line into its arguments, return None if it needs a shell to run.
+    """
+
+    if SHELLCHARS.intersection(cmd):
+        return None
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not args or args[0] in SHELLWORDS or "=" in args[0]:
+        return None
+
+    return args
+
+
+class Zygote:
+    """
+    Stores a pre-initialized Python program that jobs running it are forked from.
+    """
+
+    path = ""
+    code = None
+
+    def __repr__(self):
+        return "Zygote(%s)" % self.path
+
+
+class ZygoteProcess:
+    """
+    A job forked from the (pre-initialized) runner process.
+    Provides the parts of the interface of subprocess.Popen needed to run a job.
+    """
+
+    def __init__(self, args, env, cgroup=""):
+        (stdin_r, stdin_w) = os.pipe()
+        (stdout_r, stdout_w) = os.pipe()
+        (stderr_r, stderr_w) = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            returncode = 1
+            try:
+                if cgroup:
+                    join_cgroup(cgroup)
+                os.setpgid(0, 0)
+                os.dup2(stdin_r, 0)
+                os.dup2(stdout_w, 1)
+                os.dup2(stderr_w, 2)
+                for fd in (stdin_r, stdin_w, stdout_r, stdout_w, stderr_r, stderr_w):
+                    os.close(fd)
+                for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2):
+                    signal.signal(signum, signal.SIG_DFL)
+                sys.stdin = open(0, 'r', closefd=False)
+                sys.stdout = open(1, 'w', closefd=False)
+                sys.stderr = open(2, 'w', closefd=False)
+                sys.argv = args
+                os.environ.clear()
+                os.environ.update(env)
+                sys.path[0] = os.path.dirname(zygote.path)
+                returncode = 0
+                try:
+                    exec(zygote.code, {"__name__": "__main__", "__file__": zygote.path, "__builtins__": builtins})
+                except SystemExit as e:
+                    if e.code is None:
+                        returncode = 0
+                    elif isinstance(e.code, int):
+                        returncode = e.code & 0xff
+                    else:
+                        print(e.code, file=sys.stderr)
+                        returncode = 1
+                except:
+                    traceback.print_exc()
+                    returncode = 1
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(returncode)
+        os.close(stdin_r)
+        os.close(stdout_w)
+        os.close(stderr_w)
+        self.stdin = os.fdopen(stdin_w, 'wb')
+        self.stdout = os.fdopen(stdout_r, 'rb')
+        self.stderr = os.fdopen(stderr_r, 'rb')
+        self.returncode = None
+
+    def wait(self):
+        if self.returncode is None:
+            (pid, status) = os.waitpid(self.pid, 0)
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+            self.stdout.close()
+            self.stderr.close()
+        return self.returncode
+
+
+def prepare_zygote(options):
+    """
+    Load the Python program given as zygote, and import the modules it (and the user) asks for,
+    so that jobs running it are forked with all of this already done.
+    """
+
+    global zygote
+    zygote = Zygote()
+    zygote.path = os.path.realpath(options.zygote)
+    with open(zygote.path) as inf:
+        source = inf.read()
+    zygote.code = compile(source, zygote.path, "exec")
+
+    modules = [m for m in options.zygote_preload.split(",") if m]
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.append(node.module)
+    sys.path.insert(0, os.path.dirname(zygote.path))
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            pass
+    sys.path.pop(0)
+
+
+def zygote_args(cmd):
+    """
+    Return the arguments of a job running the zygote's program, None if it runs something else.
+    """
+
+    args = split_command(cmd)
+    if not args:
+        return None
+    if os.path.basename(args[0]).startswith("python") and len(args) > 1:
+        args = args[1:]
+    if os.path.realpath(args[0]) != zygote.path:
+        return None
+
+    return args
+
+
+def spawn_job(job, options):
+    """
+    Start a job in a process group of its own, return the Popen object and how it was started.
+    Unless told otherwise, command lines without shell syntax are executed directly.
+    This saves a shell per job, and (as no preexec_fn is needed) allows Python to use vfork.
+    """
+
+    # tell the job who it is, so that copies of a job can keep their outputs apart
+    env = dict(os.environ, RUNMAKER_JOB=str(job.number), RUNMAKER_COPY="%s,%s" % (os.uname()[1], os.getpid()))
+
+    kwargs = dict(stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    if sys.version_info >= (3, 11):
+        kwargs["process_group"] = 0
+    else:
+        kwargs["start_new_session"] = True
+    if job.cgroup:
+        # the job has to be in its cgroup before it starts (at the cost of vfork)
+        kwargs["preexec_fn"] = lambda: join_cgroup(job.cgroup)
+
+    if zygote:
+        args = zygote_args(job.cmd)
+        if args:
+            return (ZygoteProcess(args, env, job.cgroup), "zygote")
+
+    args = None
+    if options.spawn != "shell":
+        args = split_command(job.cmd)
+    if args:
+        try:
+            return (subprocess.Popen(args, **kwargs), "direct")
+        except OSError:
+            # not executable as is, let the shell try (and report errors)
+            pass
+
+    return (subprocess.Popen(job.cmd, shell=True, **kwargs), "shell")
+
+
+def get_job_state(job, host, options):
+    """
+    Ask the server for the state of a job, return None if this fails.
+    """
+
+    try:
+        sock = connect_to_server(host, options)
+        sock.sendall(("STAT " + options.token + " " + str(job.number)).encode())
+        state = sock.recv(2048).decode()
+        sock.close()
+        if len(state) != 1:
+            #the server is busy (or did not understand), so we do not know
+            return None
+        return state
+    except:
+        return None
+
+
+def job_timeout(job, options):
+    """
+    Return the number of seconds a job may run (given by its "timeout" annotation, or the --timeout option), 0 meaning forever.
+    """
+
+    if "timeout" in job.annotations:
+        return float(job.annotations["timeout"])
+    return options.timeout
+
+
+def drain_handler(signum, frame):
+    """
+    Signal handler asking to drain, i.e., to let running jobs finish, but not start new ones.
+    """
+
+    global draining
+    draining = True
+
+
+def is_draining(options):
+    """
+    Return true if no new jobs are to be started, i.e., after SIGUSR1 or once the drain file exists.
+    """
+
+    global draining
+    if not draining and options.drain_file and os.path.exists(options.drain_file):
+        draining = True
+    return draining
+
+
+def parse_signal(name):
+    """
+    Return the number of a signal given by name (e.g., "USR2" or "SIGUSR2") or number.
+    """
+
+    if name.isdigit():
+        return int(name)
+    if not name.upper().startswith("SIG"):
+        name = "SIG" + name
+    return int(getattr(signal, name.upper()))
+
+
+def slot_allowed(options):
+    """
+    With adaptive concurrency, return whether this process is among the slots allowed to start jobs (or is asked to drain).
+    If not, wait a while before returning, so the caller can check whether any jobs are left and ask again.
+    """
+
+    if not concurrency or slot < concurrency.value or is_draining(options):
+        return True
+    time.sleep(ADAPTDELAY)
+    return False
+
+
+def read_pressure():
+    """
+    Return the share of the last 10 seconds (in percent) some tasks stalled waiting for CPU, memory, or I/O, whichever is highest,
+    None if the kernel reports no pressure stall information.
+    """
+
+    pressure = None
+    for resource in ("cpu", "memory", "io"):
+        try:
+            with open("/proc/pressure/%s" % resource, 'r') as inf:
+                for line in inf:
+                    fields = line.split()
+                    if fields and fields[0] == "some":
+                        pressure = max(pressure or 0.0, float(fields[1].split("=", 1)[1]))
+        except (IOError, IndexError, ValueError):
             continue
+    return pressure
 
-    raise
+
+def read_available_memory():
+    """
+    Return the share of memory (in percent) available for starting new programs, None if unknown.
+    """
+
+    info = {}
+    try:
+        with open("/proc/meminfo", 'r') as inf:
+            for line in inf:
+                fields = line.split()
+                if len(fields) >= 2:
+                    info[fields[0].rstrip(":")] = int(fields[1])
+    except (IOError, ValueError):
+        return None
+    if not info.get("MemTotal") or "MemAvailable" not in info:
+        return None
+    return 100.0 * info["MemAvailable"] / info["MemTotal"]
 
 
-def run_job(job, options):
+def adapt_concurrency(options):
+    """
+    Lower the number of slots allowed to start jobs while the system is under pressure
+    (stalls, load average above the number of CPUs, or little available memory), raise it while it is not.
+    """
+
+    # load average beyond one runnable task per CPU counts as pressure, too
+    pressure = read_pressure() or 0.0
+    try:
+        load = os.getloadavg()[0] / multiprocessing.cpu_count()
+        pressure = max(pressure, 100.0 * (load - 1))
+    except (OSError, NotImplementedError):
+        pass
+    available = read_available_memory()
+
+    limit = concurrency.value
+    if available is not None and available < options.min_free_memory:
+        limit = max(options.min_jobs, limit // 2)
+    elif pressure > options.max_pressure:
+        limit = max(options.min_jobs, limit - 1)
+    elif pressure < options.max_pressure / 2:
+        limit = min(options.num_jobs, limit + 1)
+    if limit != concurrency.value:
+        print("running up to %d jobs in parallel (%.1f%% pressure, %s memory available)" % (limit, pressure, available is None and "unknown" or "%.0f%%" % available))
+        concurrency.value = limit
+
+
+def parse_cpu_list(s):
+    """
+    Return the set of CPUs in a list like "0-3,8,10-11" (as used in /sys).
+    """
+
+    cpus = set()
+    for part in s.strip().split(","):
+        if not part:
+            continue
+        (first, sep, last) = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    """
+    Return a list like "0-3,8" of the given CPUs.
+    """
+
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join([(first == last) and str(first) or "%d-%d" % (first, last) for (first, last) in ranges])
+
+
+def cpu_groups(size):
+    """
+    Split the CPUs we may run on into contiguous groups of the given size, NUMA node by NUMA node,
+    so that no group spans two nodes (unless no node has enough CPUs for a single group).
+    """
+
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    try:
+        for name in os.listdir("/sys/devices/system/node"):
+            if name.startswith("node") and name[4:].isdigit():
+                with open("/sys/devices/system/node/%s/cpulist" % name, 'r') as inf:
+                    nodes.append((int(name[4:]), sorted(parse_cpu_list(inf.read()) & allowed)))
+    except (IOError, OSError, ValueError):
+        nodes = []
+    nodes = [cpus for (number, cpus) in sorted(nodes) if cpus] or [sorted(allowed)]
+
+    groups = []
+    for cpus in nodes:
+        groups.extend([cpus[i:i + size] for i in range(0, len(cpus) - size + 1, size)])
+    if not groups:
+        cpus = sorted(allowed)
+        groups = [cpus[i:i + size] for i in range(0, len(cpus) - size + 1, size)] or [cpus]
+    return groups
+
+
+def prepare_cgroup(options):
+    """
+    Make sure jobs can be given cgroups of their own below the given (delegated) cgroup v2 directory,
+    with the memory and cpu controllers enabled for them.
+    A cgroup holding processes cannot enable controllers for its children, so if we run in it ourselves, move to a cgroup of our own first.
+    """
+
+    with open(os.path.join(options.cgroup, "cgroup.procs"), 'r') as inf:
+        pids = inf.read().split()
+    if str(os.getpid()) in pids:
+        leaf = os.path.join(options.cgroup, "runmaker-%d" % os.getpid())
+        if not os.path.isdir(leaf):
+            os.mkdir(leaf)
+        join_cgroup(leaf)
+
+    with open(os.path.join(options.cgroup, "cgroup.controllers"), 'r') as inf:
+        available = inf.read().split()
+    for controller in ("memory", "cpu"):
+        if controller not in available:
+            continue
+        try:
+            with open(os.path.join(options.cgroup, "cgroup.subtree_control"), 'w') as outf:
+                outf.write("+%s" % controller)
+        except (IOError, OSError):
+            pass
+
+    with open(os.path.join(options.cgroup, "cgroup.subtree_control"), 'r') as inf:
+        return inf.read().split()
+
+
+def create_cgroup(job, options):
+    """
+    Create a cgroup of its own for a job, with the configured limits, return its path.
+    """
+
+    path = os.path.join(options.cgroup, "job-%d-%d" % (os.getpid(), job.number))
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    if options.memory_max:
+        with open(os.path.join(path, "memory.max"), 'w') as outf:
+            outf.write("%d" % (options.memory_max * 1024 * 1024))
+    if options.cpu_max:
+        with open(os.path.join(path, "cpu.max"), 'w') as outf:
+            outf.write("%d 100000" % (options.cpu_max * 100000))
+    return path
+
+
+def join_cgroup(path):
+    """
+    Move the calling process into the given cgroup.
+    """
+
+    with open(os.path.join(path, "cgroup.procs"), 'w') as outf:
+        outf.write("0")
+
+
+def read_cgroup_keys(path, name):
+    """
+    Return the values in a flat keyed cgroup file (like cpu.stat) as a dictionary, empty if not available.
+    """
+
+    values = {}
+    try:
+        with open(os.path.join(path, name), 'r') as inf:
+            for line in inf:
+                fields = line.split()
+                if len(fields) == 2 and fields[1].isdigit():
+                    values[fields[0]] = int(fields[1])
+    except (IOError, OSError):
+        pass
+    return values
+
+
+def finish_cgroup(job):
+    """
+    Record a job's peak memory use, CPU time, and whether it was killed for lack of memory,
+    then kill whatever processes it left behind, and remove its cgroup.
+    """
+
+    path = job.cgroup
+    job.cgroup = ""
+    try:
+        with open(os.path.join(path, "memory.peak"), 'r') as inf:
+            job.memory_peak = int(inf.read())
+    except (IOError, OSError, ValueError):
+        job.memory_peak = None
+    job.cpu_time = read_cgroup_keys(path, "cpu.stat").get("usage_usec", 0) / 1e6
+    job.oom_killed = read_cgroup_keys(path, "memory.events").get("oom_kill", 0) > 0
+
+    try:
+        with open(os.path.join(path, "cgroup.kill"), 'w') as outf:
+            outf.write("1")
+    except (IOError, OSError):
+        pass
+    # killed processes take a moment to leave the cgroup
+    for i in range(100):
+        try:
+            os.rmdir(path)
+            return
+        except OSError:
+            time.sleep(0.01)
+    print("could not remove cgroup %s" % path)
+
+
+def format_usage(job):
+    """
+    Return the resources a job used, as recorded from its cgroup (if any), e.g., " (peak memory 12.3 MB, cpu time 4.5 s)".
+    """
+
+    if job.cpu_time is None:
+        return ""
+    usage = ["cpu time %.1f s" % job.cpu_time]
+    if job.memory_peak is not None:
+        usage.insert(0, "peak memory %.1f MB" % (job.memory_peak / 1024.0 / 1024.0))
+    return " (%s)" % ", ".join(usage)
+
+
+def next_wakeup(*times):
+    """
+    Return the number of milliseconds until the earliest of the given points in time (ignoring those that are 0), None if there is none.
+    """
+
+    times = [t for t in times if t]
+    if not times:
+        return None
+    return max(0.001, min(times) - time.time())*1000
+
+
+def kill_job(opp, signum):
+    """
+    Send a signal to the process group of a job.
+    """
+
+    try:
+        os.killpg(os.getpgid(opp.pid), signum)
+    except OSError:
+        # the job is gone already
+        pass
+
+
+def pass_tail(job, tail):
+    """
+    Pass the given last lines of a job's output on to be sent to the server along with those of other jobs, then forget about them.
+    """
+
+    tail_queue.put((job.number, list(tail)))
+    tail.clear()
+
+
+def send_tails(tails, host, options):
+    """
+    Collect the last lines of output of the jobs of all slots, and send them to the server (compressed, each line prefixed by its job number) in one request every now and then,
+    until told to stop. As they are for information only, give up on them if the server cannot be reached in time.
+    """
+
+    lines = []
+    last_send = time.time()
+    stop = False
+    while not stop:
+        try:
+            item = tails.get(timeout=max(last_send + TAILDELAY - time.time(), 0))
+            if item is None:
+                stop = True
+            else:
+                (number, tail) = item
+                lines.extend(["%d %s" % (number, line) for line in tail])
+        except queue.Empty:
+            pass
+        if not stop and time.time() < last_send + TAILDELAY:
+            continue
+        last_send = time.time()
+        if not lines:
+            continue
+        payload = zlib.compress("\n".join(lines).encode())
+        lines = []
+        try:
+            sock = connect_to_server(host, options, TAILTIMEOUT)
+            sock.sendall(("TAILS %s %d\n" % (options.token, len(payload))).encode() + payload)
+            sock.recv(2048)
+            sock.close()
+        except (IOError, OSError):
+            pass
+
+
+def parse_result(line):
+    """
+    Return the key-value pairs in a line reporting results ("@result key=value key=value ..."), values optionally quoted as in the shell.
+    """
+
+    line = line[len(RESULTPREFIX):]
+    try:
+        words = shlex.split(line)
+    except ValueError:
+        words = line.split()
+    return [tuple(word.split("=", 1)) for word in words if word.partition("=")[0] and "=" in word]
+
+
+def results_payload(job):
+    """
+    Return the results a job reported, as CSV rows of key and value to send to the server.
+    """
+
+    rows = io.StringIO()
+    writer = csv.writer(rows, lineterminator="\n")
+    for (key, value) in job.results:
+        writer.writerow([key, value])
+    return rows.getvalue().encode()
+
+
+def send_results(job, payload, host, options):
+    """
+    Send the results a job reported to a server that does not take them along with the job's state, to be appended to its results file.
+    Return true if the server confirmed.
+    """
+
+    #keep trying as long as for the job's state
+    failures = 0
+    while True:
+        try:
+            sock = connect_to_server(host, options)
+            sock.sendall(("RESULTS %s %d %d\n" % (options.token, job.number, len(payload))).encode() + payload)
+            response = sock.recv(2048).decode()
+            sock.close()
+            if response == "INVALID_TOKEN" and reload_token(options):
+                raise IOError("server has a new token")
+            if response == "INVALID_CMD":
+                #the server does not collect results at all
+                print("Server does not collect results, dropping those of `%s'" % job.cmd)
+                return True
+            return response == "ACK"
+        except (IOError, OSError):
+            #if something went wrong, wait a little and try again
+            failures = failures + 1
+            if options.set_retries and failures >= options.set_retries:
+                return False
+            delay = backoff_delay(failures, options)
+            print("Error connecting to server. Retrying in %.1f seconds." % delay)
+            time.sleep(delay)
+
+
+def run_job(job, options, abort=None, host=None):
     """
     Fork and execute the job, wait for completion, return the exit code.
+    If given an abort function, call it every now and then; once it returns true, kill the job and return None.
+    If sending output to the server, send the last lines of output every now and then.
     """
 
+    # forget about earlier runs of the job (e.g., when retrying it)
+    job.timed_out = False
+    job.checkpointed = False
+    job.cgroup = ""
+    job.memory_peak = None
+    job.cpu_time = None
+    job.oom_killed = False
+
     s = "executing `%s'" % job.cmd
     print(s)
 
@@ -101,11 +950,31 @@ def run_job(job, options):
         for s in log:
             logf.write(("%s\n" % s).encode())
 
-    opp = subprocess.Popen(job.cmd, shell=True, preexec_fn=os.setpgrp, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, )
+    tail = None
+    last_tail_send = time.time()
+    if options.tails:
+        tail = deque(maxlen=options.logfile_lines)
+
+    start = time.time()
+    if options.cgroup:
+        job.cgroup = create_cgroup(job, options)
+    try:
+        (opp, how) = spawn_job(job, options)
+    except:
+        if job.cgroup:
+            finish_cgroup(job)
+        raise
+    spawned = time.time()
+    stdout_bytes = 0
+    stderr_bytes = 0
+    if trace:
+        trace.event("spawn", start, spawned - start, job=job.number, pid=opp.pid, how=how)
     try:
         opp_pid = "%s,%s" % (os.uname()[1], opp.pid)
-        s = "status (%s): %s \"%s\"" % (opp_pid, "forked", job.cmd)
+        s = "status (%s): %s \"%s\" (%s, %.1f ms%s)" % (opp_pid, "forked", job.cmd, how, (spawned - start) * 1000, cpus and ", cpus %s" % format_cpu_list(cpus) or "")
         print(s)
+        if tail is not None:
+            tail.append(s)
         if logf:
             s = "+ %s" % s
             log.pop(0)
@@ -117,43 +986,108 @@ def run_job(job, options):
         poll.register(opp.stderr, select.POLLIN | select.POLLHUP)
         pollc = 2
 
-        events = poll.poll()
-        while pollc > 0 and len(events) > 0:
+        aborted = False
+        last_abort_check = time.time()
+        last_drain_check = time.time()
+        deadline = 0
+        if job_timeout(job, options):
+            deadline = spawned + job_timeout(job, options)
+        events = poll.poll(next_wakeup(abort and (last_abort_check + ABORTCHECKDELAY), options.checkpoint_signal and not job.checkpointed and (last_drain_check + DRAINCHECKDELAY), tail and (last_tail_send + TAILDELAY), deadline))
+        partial = {opp.stdout.fileno(): b"", opp.stderr.fileno(): b""}
+        job.results = []
+        while pollc > 0:
             for event in events:
                 (rfd, event) = event
-                if event & select.POLLIN:
-                    if rfd == opp.stdout.fileno():
-                        line = opp.stdout.readline().decode()
-                        if len(line) > 0:
-                            s = "stdout (%s): %s" % (opp_pid, line[:-1])
-                            if logf:
-                                s = ": %s" % s
-                                log.pop(0)
-                                log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
-                            else:
-                                print(s)
-                    if rfd == opp.stderr.fileno():
-                        line = opp.stderr.readline().decode()
-                        if len(line) > 0:
-                            s = "stderr (%s): %s" % (opp_pid, line[:-1])
-                            if logf:
-                                s = "! %s" % s
-                                log.pop(0)
-                                log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
-                            else:
-                                print(s)
-                if event & select.POLLHUP:
+                if not event & (select.POLLIN | select.POLLHUP):
+                    continue
+                # read whatever is there: a buffered readline() could keep lines to itself, unnoticed by poll()
+                data = os.read(rfd, 65536)
+                if data:
+                    lines = (partial[rfd] + data).split(b"\n")
+                    partial[rfd] = lines.pop()
+                else:
+                    lines = partial[rfd] and [partial[rfd]] or []
                     poll.unregister(rfd)
                     pollc = pollc - 1
+                for line in lines:
+                    line = line.decode(errors="replace")
+                    if rfd == opp.stdout.fileno():
+                        stdout_bytes = stdout_bytes + len(line) + 1
+                        if line.startswith(RESULTPREFIX):
+                            job.results.extend(parse_result(line))
+                        s = "stdout (%s): %s" % (opp_pid, line)
+                        if tail is not None:
+                            tail.append(s)
+                        if logf:
+                            s = ": %s" % s
+                            log.pop(0)
+                            log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
+                        else:
+                            print(s)
+                    if rfd == opp.stderr.fileno():
+                        stderr_bytes = stderr_bytes + len(line) + 1
+                        s = "stderr (%s): %s" % (opp_pid, line)
+                        if tail is not None:
+                            tail.append(s)
+                        if logf:
+                            s = "! %s" % s
+                            log.pop(0)
+                            log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
+                        else:
+                            print(s)
                 if logf:
                     logf.seek((job.number - 1) * (LOGWIDTH + 1) * (options.logfile_lines + 1) + (LOGWIDTH + 1))
                     for s in log:
                         logf.write(("%s\n" % s).encode())
-                if pollc > 0:
-                    events = poll.poll()
+            if abort and not aborted and (time.time() - last_abort_check) >= ABORTCHECKDELAY:
+                last_abort_check = time.time()
+                if abort():
+                    aborted = True
+                    kill_job(opp, signal.SIGKILL)
+            if deadline and time.time() >= deadline:
+                if not job.timed_out:
+                    # ask the job to terminate, then kill it if it does not
+                    job.timed_out = True
+                    s = "status (%s): %s \"%s\"" % (opp_pid, "timed out", job.cmd)
+                    print(s)
+                    kill_job(opp, signal.SIGTERM)
+                    deadline = time.time() + KILLDELAY
+                else:
+                    kill_job(opp, signal.SIGKILL)
+                    deadline = 0
+            if options.checkpoint_signal and not job.checkpointed and (time.time() - last_drain_check) >= DRAINCHECKDELAY:
+                last_drain_check = time.time()
+                if is_draining(options):
+                    # ask the job to save its progress and exit
+                    job.checkpointed = True
+                    s = "status (%s): %s \"%s\"" % (opp_pid, "checkpointing", job.cmd)
+                    print(s)
+                    kill_job(opp, options.checkpoint_signal)
+            if tail and (time.time() - last_tail_send) >= TAILDELAY:
+                pass_tail(job, tail)
+                last_tail_send = time.time()
+            if pollc > 0:
+                events = poll.poll(next_wakeup(abort and (last_abort_check + ABORTCHECKDELAY), options.checkpoint_signal and not job.checkpointed and (last_drain_check + DRAINCHECKDELAY), tail and (last_tail_send + TAILDELAY), deadline))
         returncode = opp.wait()
-        s = "status (%s): %s %s \"%s\"" % (opp_pid, "exit", returncode, job.cmd)
+        if job.cgroup:
+            finish_cgroup(job)
+        if aborted:
+            s = "status (%s): %s \"%s\"" % (opp_pid, "killed, other copy finished", job.cmd)
+            print(s)
+            return None
+        if trace:
+            usage = {}
+            if job.cpu_time is not None:
+                usage = dict(memory_peak=job.memory_peak, cpu_time=job.cpu_time, oom_kill=job.oom_killed)
+            trace.event("job", spawned, time.time() - spawned, job=job.number, pid=opp.pid, exit=returncode, stdout_bytes=stdout_bytes, stderr_bytes=stderr_bytes, **usage)
+        if job.oom_killed:
+            s = "status (%s): %s \"%s\"" % (opp_pid, "out of memory", job.cmd)
+            print(s)
+        s = "status (%s): %s %s \"%s\"%s" % (opp_pid, "exit", returncode, job.cmd, format_usage(job))
         print(s)
+        if tail is not None:
+            tail.append(s)
+            pass_tail(job, tail)
         if logf:
             s = "+ %s" % s
             log.pop(0)
@@ -169,39 +1103,70 @@ def run_job(job, options):
         raise
 
     finally:
+        if job.cgroup:
+            finish_cgroup(job)
         if logf:
             logf.close()
 
-def process_file(host, options):
+def process_jobs(host, options):
     """
-    Open the job file, and for each job to be executed, execute it.
+    Ask the server for jobs to be executed, and execute them.
     """
     run = True
     lastException = 0
     while run:
-        #do 5 attempts for each request, to be sure to avoid problems due to
-        #concurrent with the others
-        attempts = 5
+        #do several attempts for each request, to be sure to avoid problems due to
+        #concurrent with the others (or the server being restarted)
+        attempts = options.retries
         while (attempts > 0):
             attempts = attempts - 1
             job_done = False
+            #with adaptive concurrency, wait until this slot may start jobs, unless the other slots found nothing left to do
+            if not slot_allowed(options):
+                if finished is not None and finished.value:
+                    return True
+                attempts = attempts + 1
+                continue
+            #once draining, ask for no more jobs
+            if is_draining(options):
+                print("draining, not starting any more jobs")
+                return True
             try:
+                start = time.time()
                 #connect to server
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sa = (host, options.port)
-                sock.connect(sa)
+                sock = connect_to_server(host, options)
 
                 #ask for a job
-                sock.sendall(("GET " + options.token).encode())
+                if options.plain_get:
+                    sock.sendall(("GET %s" % options.token).encode())
+                else:
+                    sock.sendall(("GET %s host=%s%s" % (options.token, os.uname()[1], options.tags and " tags=" + options.tags or "")).encode())
                 response = sock.recv(2048).decode()
+                if trace:
+                    trace.event("claim", start, time.time() - start, job=response.split(" ", 1)[0])
                 if (response == ""):
                     print("Empty server response")
-                    time.sleep(random.uniform(0,3))
+                    time.sleep(backoff_delay(options.retries - attempts, options))
+                    continue
+                delay = busy_delay(response)
+                if (delay is not None):
+                    #server asked us to come back later. this is no error
+                    attempts = attempts + 1
+                    time.sleep(delay)
+                    continue
+                if (response == "INVALID_CMD" and not options.plain_get):
+                    #servers older than host affinity only know "GET <token>". ask them that way from now on
+                    print("Server does not know about host affinity, asking for any job")
+                    options.plain_get = True
+                    attempts = attempts + 1
                     continue
                 if (response == "INVALID_CMD"):
                     print("Got invalid command error from server. Check the code. Quitting")
                     sys.exit(1)
                 if (response == "INVALID_TOKEN"):
+                    if reload_token(options):
+                        #server was restarted with a new token. ask again
+                        continue
                     print("Got invalid token error. Check that token or token file are correct. Quitting")
                     sys.exit(1)
 
@@ -211,32 +1176,58 @@ def process_file(host, options):
 
                 job = Job()
                 job.number = int(v[0])
-                if (job.number != -1):
-                    job.cmd = v[1]
+                if (job.number == 0):
+                    #server said all remaining jobs wait for others. ask again later
+                    attempts = attempts + 1
+                    time.sleep(random.uniform(0.5,1.5))
+                    continue
+                elif (job.number != -1):
+                    (job.cmd, job.annotations) = parse_annotations(v[1])
+
+                    abort = None
+                    if options.speculate:
+                        #stop once another copy of the job finished
+                        abort = lambda: get_job_state(job, host, options) not in [None, 'r', 's']
 
                     #run the job
                     try:
                         set_job_state(job, 'r', host, options)
-                        if run_job(job, options) == 0:
+                        returncode = run_job(job, options, abort, host)
+                        if returncode is None:
+                            pass
+                        elif job.checkpointed and returncode != 0:
+                            #the job saved its progress, so leave it to be resumed
+                            set_job_state(job, '.', host, options)
+                        elif job.timed_out:
+                            set_job_state(job, 't', host, options)
+                        elif job.oom_killed and returncode != 0:
+                            set_job_state(job, 'o', host, options)
+                        elif returncode == 0:
                             job_done = True
-                            set_job_state(job, 'd', host, options)
+                            #results go along with marking the job done, so the server keeps only those of the copy that gets it done
+                            set_job_state(job, 'd', host, options, job.results and results_payload(job) or b"")
                         else:
                             set_job_state(job, '!', host, options)
                     except KeyboardInterrupt as ki:
                         #if the user hits ctrl-c, set job status to e, and exit
                         set_job_state(job, 'e', host, options)
                         return False
+                    #the request went fine, even if the job failed. keep asking
+                    attempts = attempts + 1
 
                 else:
-                    #server said there's nothing left to do. stop here
+                    #server said there's nothing left to do. stop here (and tell the other slots)
+                    if finished is not None:
+                        finished.value = 1
                     return True
 
             except Exception as ex:
                 #if we got an exception, sleep for a random amount of time
                 #then ask again
-                print("Exception caught. Retrying in a few seconds.")
                 lastException = ex
-                time.sleep(random.uniform(0,3))
+                delay = backoff_delay(options.retries - attempts, options)
+                print("Exception caught. Retrying in %.1f seconds." % delay)
+                time.sleep(delay)
                 continue
 
         #when the number of attempts goes to 0, then something bad is going on. stop everything
@@ -248,18 +1239,71 @@ def process_file(host, options):
             run = False
 
 
+def process_file(host, options, index=0, limit=None, done=None, tails=None):
+    """
+    Ask the server for jobs to be executed, and execute them.
+    With adaptive concurrency, only start jobs while the given slot index is below the shared limit, and stop once the shared done flag is set.
+    If sending output to the server, pass it on to the given queue.
+    """
+
+    global trace, slot, concurrency, finished, tail_queue, cpus
+    slot = index
+    concurrency = limit
+    finished = done
+    tail_queue = tails
+    # jobs (and a pre-initialized program they are forked from) inherit the CPUs of this slot
+    if options.pin:
+        groups = cpu_groups(options.pin)
+        cpus = groups[index % len(groups)]
+        os.sched_setaffinity(0, cpus)
+    signal.signal(signal.SIGUSR1, drain_handler)
+    if options.trace:
+        trace = Trace(options.trace)
+    if options.zygote:
+        prepare_zygote(options)
+
+    try:
+        return process_jobs(host, options)
+    finally:
+        if trace:
+            trace.close()
+
+
 def main():
     """
     Program entry point when run interactively.
     """
 
+    global concurrency, finished
+
     # prepare option parser
-    parser = OptionParser(usage="usage: %prog [options] host", description="Run", epilog="Refer to the help output of runmaker4-server.py for more details.")
+    parser = OptionParser(usage="usage: %prog [options] host", description="Run", epilog="Refer to the help output of runmaker4-server.py for more details. If the host is a path (containing a slash), connect to the server's Unix domain socket (see its --socket option) instead of its TCP port.")
     parser.add_option("-j", "--jobs", dest="num_jobs", type="int", default=1, action="store", help="start NUMBER jobs in parallel, 0 meaning autodetect [default: %default]", metavar="NUMBER")
+    parser.add_option("--cgroup", dest="cgroup", default="", help="run each job in a cgroup of its own below the (delegated) cgroup v2 DIRECTORY, recording its peak memory use and CPU time, and marking jobs killed for lack of memory o [default: none]", metavar="DIRECTORY")
+    parser.add_option("--memory-max", dest="memory_max", type="int", default=0, action="store", help="if using cgroups, limit each job to NUMBER megabytes of memory, 0 meaning no limit [default: %default]", metavar="NUMBER")
+    parser.add_option("--cpu-max", dest="cpu_max", type="float", default=0, action="store", help="if using cgroups, limit each job to the time of NUMBER CPUs, 0 meaning no limit [default: %default]", metavar="NUMBER")
+    parser.add_option("--pin", dest="pin", type="int", default=0, action="store", help="pin the jobs of each slot to NUMBER CPUs of their own, packed NUMA node by NUMA node, 0 meaning no pinning [default: %default]", metavar="NUMBER")
+    parser.add_option("--adaptive", dest="adaptive", default=False, action="store_true", help="start fewer than the given number of jobs in parallel while the system is under pressure, 0 meaning up to twice the number of cpus [default: no]")
+    parser.add_option("--min-jobs", dest="min_jobs", type="int", default=1, action="store", help="with adaptive concurrency, always allow NUMBER jobs in parallel [default: %default]", metavar="NUMBER")
+    parser.add_option("--max-pressure", dest="max_pressure", type="float", default=20, action="store", help="with adaptive concurrency, start fewer jobs while tasks stall for more than PERCENT of the time [default: %default]", metavar="PERCENT")
+    parser.add_option("--min-free-memory", dest="min_free_memory", type="float", default=10, action="store", help="with adaptive concurrency, halve the number of jobs started while less than PERCENT of memory is available [default: %default]", metavar="PERCENT")
     parser.add_option("-l", "--logfile", dest="logfile", default="", help="log output to FILENAME [default: none]", metavar="FILENAME")
-    parser.add_option("-n", "--loglines", dest="logfile_lines", type="int", default=3, action="store", help="if logging, log the last NUMBER lines of output [default: %default]", metavar="NUMBER")
+    parser.add_option("-n", "--loglines", dest="logfile_lines", type="int", default=3, action="store", help="if logging (or sending output to the server), log the last NUMBER lines of output [default: %default]", metavar="NUMBER")
+    parser.add_option("--tails", dest="tails", default=False, action="store_true", help="send the last lines of output of each job to the server every now and then, to be shown by runtail4.py [default: no]")
+    parser.add_option("-s", "--spawn", dest="spawn", type="choice", choices=["auto", "shell"], default="auto", help="run jobs directly if they need no shell (auto) or always via the shell (shell) [default: %default]", metavar="MODE")
+    parser.add_option("-z", "--zygote", dest="zygote", default="", help="fork jobs running the Python program FILENAME from a pre-initialized copy [default: none]", metavar="FILENAME")
+    parser.add_option("--zygote-preload", dest="zygote_preload", default="", help="if forking jobs from a pre-initialized program, also import the comma-separated list of MODULES [default: none]", metavar="MODULES")
+    parser.add_option("--timeout", dest="timeout", type="float", default=0, action="store", help="stop jobs running longer than NUMBER seconds, marking them t, 0 meaning never [default: %default]", metavar="NUMBER")
+    parser.add_option("--speculate", dest="speculate", default=False, action="store_true", help="check every now and then whether another copy of the job finished, and if so, stop [default: no]")
     parser.add_option("-p", "--port", dest="port", type="int", default=9998, action="store", help="TCP PORT the server is listening to [default: %default]", metavar="PORT")
+    parser.add_option("--retries", dest="retries", type="int", default=10, action="store", help="quit after NUMBER consecutive failed requests for jobs [default: %default]", metavar="NUMBER")
+    parser.add_option("--set-retries", dest="set_retries", type="int", default=0, action="store", help="try NUMBER times to tell the server about a job that has run, 0 meaning until it succeeds [default: %default]", metavar="NUMBER")
+    parser.add_option("--max-backoff", dest="max_backoff", type="float", default=60, action="store", help="wait no more than NUMBER seconds before repeating a failed request [default: %default]", metavar="NUMBER")
+    parser.add_option("--tags", dest="tags", default="", help="ask for jobs preferring any of the comma-separated list of TAGS (besides this host's name) [default: none]", metavar="TAGS")
     parser.add_option("-t", "--token", dest="token", default=os.path.join(os.path.expanduser("~"), ".runmaker4.token"), action="store", help="string representing either the token or the file where the token is stored. The token is sent to the server at each request for authentication purpose. If the parameter ends with .token, it is assumed that the token needs to be read from a file. [default: %default]")
+    parser.add_option("--trace", dest="trace", default="", help="append a trace of requests and job executions to FILENAME [default: none]", metavar="FILENAME")
+    parser.add_option("--drain-file", dest="drain_file", default="", help="once FILENAME exists, ask for no more jobs, and exit once running jobs finished (as on SIGUSR1) [default: none]", metavar="FILENAME")
+    parser.add_option("--checkpoint-signal", dest="checkpoint_signal", default="", help="when draining, send SIGNAL to running jobs; jobs then exiting unsuccessfully are marked pristine again [default: none]", metavar="SIGNAL")
 
     # parse options
     (options, args) = parser.parse_args()
@@ -277,12 +1321,15 @@ def main():
         sys.exit(1)
     host = args[0]
 
+    options.token_file = ""
+    options.plain_get = False
     if (options.token.endswith(".token")):
-        #we need to take the token from a file
+        #we need to take the token from a file (again if the server gets a new one)
+        options.token_file = options.token
         try:
             tokenFile = open(options.token, 'r')
             #overwrite the filename with the token. we'll pass this to the subprocesses
-            options.token = tokenFile.read()
+            options.token = tokenFile.read().strip()
             tokenFile.close()
         except:
             print ("Error occured while retrieving the token. Does the token file exist?")
@@ -292,17 +1339,83 @@ def main():
     if options.num_jobs == 0:
         try:
             options.num_jobs = multiprocessing.cpu_count()
+            # leave room for jobs waiting on I/O
+            if options.adaptive:
+                options.num_jobs = 2 * options.num_jobs
         except:
             pass
 
-    # spawn children
+    if (options.memory_max or options.cpu_max) and not options.cgroup:
+        print("Limiting memory or CPU time of jobs needs --cgroup")
+        sys.exit(1)
+    if options.cgroup:
+        if not os.path.exists(os.path.join(options.cgroup, "cgroup.subtree_control")):
+            print("%s is not a cgroup v2 directory" % options.cgroup)
+            sys.exit(1)
+        try:
+            controllers = prepare_cgroup(options)
+        except (IOError, OSError) as e:
+            print("Cannot use cgroup %s: %s" % (options.cgroup, e))
+            sys.exit(1)
+        for (limit, controller) in ((options.memory_max, "memory"), (options.cpu_max, "cpu")):
+            if limit and controller not in controllers:
+                print("Cannot enable the %s controller for cgroups below %s" % (controller, options.cgroup))
+                sys.exit(1)
+
+    if options.pin:
+        if not hasattr(os, "sched_setaffinity"):
+            print("Pinning jobs to CPUs is not supported on this system")
+            sys.exit(1)
+        groups = cpu_groups(options.pin)
+        if len(groups[0]) < options.pin:
+            print("Cannot pin jobs to %d CPUs, only %d available" % (options.pin, len(groups[0])))
+            sys.exit(1)
+        if len(groups) < options.num_jobs:
+            print("Only %d groups of %d CPUs available, so %d jobs will share CPUs" % (len(groups), options.pin, options.num_jobs))
+
+    # with adaptive concurrency, start out with one slot per cpu
+    if options.adaptive:
+        options.min_jobs = max(1, min(options.min_jobs, options.num_jobs))
+        try:
+            cpus = multiprocessing.cpu_count()
+        except:
+            cpus = options.min_jobs
+        concurrency = multiprocessing.Value('i', max(options.min_jobs, min(options.num_jobs, cpus)), lock=False)
+        finished = multiprocessing.Value('b', 0, lock=False)
+
+    if options.checkpoint_signal:
+        try:
+            options.checkpoint_signal = parse_signal(options.checkpoint_signal)
+        except (AttributeError, ValueError):
+            print("Unknown signal %s" % options.checkpoint_signal)
+            sys.exit(1)
+
+    # children pass on the output of their jobs, to be sent in batches
+    tails = None
+    if options.tails:
+        tails = multiprocessing.Queue()
+
+    # spawn children, passing on requests to drain to them
     children = []
+    signal.signal(signal.SIGUSR1, lambda signum, frame: [os.kill(child.pid, signum) for child in children if child.exitcode is None])
     for i in range(options.num_jobs):
-        child = multiprocessing.Process(target=process_file, args=(host,options))
+        child = multiprocessing.Process(target=process_file, args=(host,options,i,concurrency,finished,tails))
         child.start()
         children.append(child)
+    # start sending output only now, as forking while a thread runs is unsafe
+    if tails is not None:
+        sender = threading.Thread(target=send_tails, args=(tails, host, options))
+        sender.daemon = True
+        sender.start()
+    # with adaptive concurrency, keep adjusting the number of slots allowed to start jobs
+    while concurrency and [child for child in children if child.exitcode is None]:
+        multiprocessing.connection.wait([child.sentinel for child in children if child.exitcode is None], ADAPTDELAY)
+        adapt_concurrency(options)
     for child in children:
         child.join()
+    if tails is not None:
+        tails.put(None)
+        sender.join(TAILTIMEOUT + 1)
 
 # Start main() when run interactively
 if __name__ == '__main__':
@@ -26,20 +26,68 @@
 #
 
 from __future__ import print_function
+import csv
 import fcntl
+import io
 import os
 import select
 import signal
 import subprocess
 import sys
 import socket
+import sqlite3
+import stat
 import multiprocessing
 import tempfile
+import re
 import logging
 import string
+import struct
+import threading
+import time
 import random
+import zlib
+from collections import OrderedDict, deque
 from optparse import OptionParser
 
+# states of jobs that did not complete successfully: failed, error, timed out, out of memory
+FAILEDSTATES = "!eto"
+
+# if retrying failed jobs, the file descriptor of the per-job information file next to the job file
+jobinfo = None
+
+# last lines of output of each job, as sent by clients, least recently updated first
+tails = OrderedDict()
+
+# if keeping a log of the output sent by clients, its file descriptor
+tail_log = None
+
+# if collecting the results reported by jobs, the file descriptor of the results file
+results = None
+
+# per-job information is kept in records of this format (at an offset given by the job number):
+# time the job was last started, number of times it was started, time it last failed
+JOBINFO = struct.Struct("<dId")
+
+# maximum number of seconds a failed job has to wait before it is retried
+MAXBACKOFF = 3600
+
+# when serving several job files, jobs of the n-th file (counting from 0) are numbered from n * RUN_STRIDE + 1
+RUN_STRIDE = 1000000000
+
+# when serving several job files, the index of the one whose turn it is to hand out jobs
+turn = 0
+
+# with several accept loops, requests are served one at a time all the same, as they share the state of all jobs
+lock = threading.Lock()
+
+# start of the current one-second window of requests, and number of requests seen in it (for --max-requests)
+window_start = 0
+window_requests = 0
+
+# parameter sweeps: "{0..9}", "{0..100..10}", or "{a,b,c}", but not "${a}"
+SWEEP_RE = re.compile(r"(?<!\$)\{(?:(-?\d+)\.\.(-?\d+)(?:\.\.(-?\d+))?|([^{}\s,$'\"]*(?:,[^{}\s,$'\"]*)+))\}")
+
 class Job:
     """
     Stores a (parsed) line in the job file.
@@ -50,16 +98,57 @@ class Job:
     length = 0
     state = "."
     cmd = ""
+    annotations = {}
+    after = []
+    sweep = None
+    block = None
+    cursor = 0
+    started = 0
+    passed_over = 0
 
     def __repr__(self):
         return "Job(%s, %s, '%s', '%s')" % (self.offset, self.length, self.state, self.cmd)
 
+class Run:
+    """
+    Stores a job file being served, and its share of the jobs handed out.
+    """
+
+    index = 0
+    fname = ""
+    f = None
+    jobs = []
+    weight = 1.0
+    deficit = 0.0
+    jobinfo = None
+    db = None
+
+    def __repr__(self):
+        return "Run(%s, '%s', %s)" % (self.index, self.fname, self.weight)
+
+class Sweep:
+    """
+    Stores a parsed parameter sweep, i.e., the literal parts and value ranges of a command line.
+    """
+
+    parts = []
+    size = 1
+
+    def __repr__(self):
+        return "Sweep(%s, %s)" % (self.size, self.parts)
+
 class Command:
     #definition of constants
     #commands
     CMD_UNINITIALIZED = -1
     CMD_GET           = 0
     CMD_SET           = 1
+    CMD_STAT          = 2
+    CMD_SUBMIT        = 3
+    CMD_SUBMIT_MANY   = 4
+    CMD_TAILS         = 5
+    CMD_TAIL          = 6
+    CMD_RESULTS       = 7
     #errors/results
     VALID_CMD     = 0
     INVALID_CMD   = -1
@@ -71,6 +160,127 @@ class Command:
     token = ""
     jobNumber = -1
     jobStatus = -1
+    jobCommand = ""
+    payloadLength = 0
+    runIndex = 0
+    hostNames = set()
+
+
+def parse_annotations(cmd):
+    """
+    Split a command line into the command proper and its annotations, leaving out (and logging) invalid ones.
+    """
+
+    (line, annotations) = split_annotations(cmd)
+    for key in invalid_annotations(annotations):
+        logging.warning("Ignoring invalid %s annotation `%s' of `%s'" % (key, annotations[key], line))
+        del annotations[key]
+    return (line, annotations)
+
+
+def split_annotations(cmd):
+    """
+    Split a command line into the command proper and its annotations.
+    Annotations are written as a trailing shell comment "#@ key=value key=value ...",
+    so the shell ignores them if the line is run by an older version.
+    """
+
+    i = cmd.rfind("#@")
+    if i == -1 or (i > 0 and not cmd[i-1].isspace()):
+        return (cmd, {})
+
+    annotations = {}
+    for word in cmd[i+2:].split():
+        (key, sep, value) = word.partition("=")
+        annotations[key] = value
+
+    return (cmd[:i].rstrip(), annotations)
+
+
+def invalid_annotations(annotations):
+    """
+    Return the keys of the annotations clients would reject: timeouts that are no number of seconds.
+    """
+
+    invalid = []
+    if "timeout" in annotations:
+        try:
+            timeout = float(annotations["timeout"])
+        except ValueError:
+            timeout = -1
+        if not timeout >= 0:
+            invalid.append("timeout")
+    return invalid
+
+
+def parse_sweep(cmd, annotations):
+    """
+    Parse the parameter sweep in a command line, return None if there is none.
+    Only lines with a sweep annotation are sweeps, as the shell gives braces a meaning of its own.
+    """
+
+    if "sweep" not in annotations:
+        return None
+    sweep = Sweep()
+    sweep.parts = []
+    sweep.size = 1
+    pos = 0
+    for m in SWEEP_RE.finditer(cmd):
+        sweep.parts.append(cmd[pos:m.start()])
+        if m.group(4) is not None:
+            values = m.group(4).split(",")
+        else:
+            start = int(m.group(1))
+            stop = int(m.group(2))
+            step = abs(int(m.group(3) or 1)) or 1
+            if stop < start:
+                step = -step
+            # ranges are never expanded, but indexed on demand
+            values = range(start, stop + (step > 0 and 1 or -1), step)
+        sweep.parts.append(values)
+        sweep.size = sweep.size * len(values)
+        pos = m.end()
+    if pos == 0:
+        return None
+    sweep.parts.append(cmd[pos:])
+
+    return sweep
+
+
+def expand_sweep(sweep, i):
+    """
+    Return the command line of element i of a parameter sweep.
+    The last value range varies fastest, like in a shell brace expansion.
+    """
+
+    words = []
+    for part in reversed(sweep.parts):
+        if isinstance(part, str):
+            words.append(part)
+        else:
+            words.append(str(part[i % len(part)]))
+            i = i // len(part)
+
+    return "".join(reversed(words))
+
+
+def format_annotations(job):
+    """
+    Return the command line of a job, followed by its annotations (if any).
+    """
+
+    return format_annotations_of(job.cmd, job.annotations)
+
+
+def format_annotations_of(cmd, annotations):
+    """
+    Return a command line, followed by the given annotations (if any).
+    """
+
+    if not annotations:
+        return cmd
+    words = [(value and "%s=%s" % (key, value) or key) for (key, value) in sorted(annotations.items())]
+    return "%s #@ %s" % (cmd, " ".join(words))
 
 
 def read_jobs(f):
@@ -79,11 +289,12 @@ def read_jobs(f):
     """
 
     jobs = []
+    number = 1
 
     f.seek(0)
     while 1:
         job = Job()
-        job.number = len(jobs)+1
+        job.number = number
         job.offset = f.tell()
         s = f.readline().decode()
         job.length = f.tell() - job.offset
@@ -98,13 +309,102 @@ def read_jobs(f):
             continue
         s = s.rstrip()
         job.state = s[0]
-        job.cmd = s[2:]
+        (job.cmd, job.annotations) = parse_annotations(s[2:])
+        job.sweep = parse_sweep(job.cmd, job.annotations)
 
         jobs.append(job)
+        # each element of a parameter sweep gets its own job number
+        number = number + (job.sweep and job.sweep.size or 1)
 
     return jobs
 
 
+def submit_jobs(jobs, f, cmds):
+    """
+    Append pristine jobs with the given command lines to the job file (in a single write, synced to disk)
+    and to the list of jobs. Return their job numbers.
+    """
+
+    number = 1
+    if jobs:
+        number = jobs[-1].number + (jobs[-1].sweep and jobs[-1].sweep.size or 1)
+    f.seek(0, os.SEEK_END)
+    offset = f.tell()
+    lines = []
+    if offset and os.pread(f.fileno(), 1, offset - 1) != b"\n":
+        lines.append(b"\n")
+        offset = offset + 1
+
+    new_jobs = []
+    for cmd in cmds:
+        line = (". " + cmd + "\n").encode()
+        job = Job()
+        job.number = number
+        job.offset = offset
+        job.length = len(line)
+        (job.cmd, job.annotations) = parse_annotations(cmd)
+        job.sweep = parse_sweep(job.cmd, job.annotations)
+        new_jobs.append(job)
+        lines.append(line)
+        offset = offset + len(line)
+        # each element of a parameter sweep gets its own job number
+        number = number + (job.sweep and job.sweep.size or 1)
+
+    f.write(b"".join(lines))
+    f.flush()
+    os.fsync(f.fileno())
+
+    jobs.extend(new_jobs)
+    if [job for job in new_jobs if "label" in job.annotations or "after" in job.annotations]:
+        resolve_dependencies(jobs)
+
+    return [job.number for job in new_jobs]
+
+
+def resolve_dependencies(jobs):
+    """
+    Resolve the "after" annotations of all jobs to the list of jobs they run after.
+    Any number of lines can share a label given by a "label" annotation.
+    """
+
+    labels = {}
+    for job in jobs:
+        for label in job.annotations.get("label", "").split(","):
+            if label:
+                labels.setdefault(label, []).append(job)
+
+    for job in jobs:
+        job.after = []
+        for label in job.annotations.get("after", "").split(","):
+            if label:
+                job.after.extend(labels.get(label, []))
+
+
+def can_run(job, options):
+    """
+    Return true if the job is waiting to be executed.
+    """
+
+    return (job.state == '.') or (options.retry and job.state in FAILEDSTATES)
+
+
+def check_dependencies(job, options):
+    """
+    Return 'd' if all jobs the job runs after are done,
+    '!' if one of them can no longer complete, '.' otherwise.
+    """
+
+    result = 'd'
+    for dep in job.after:
+        if dep.state == 'd':
+            continue
+        if dep.state in FAILEDSTATES and not (options.retry and retry_time(dep, options) is not None):
+            return '!'
+        result = '.'
+
+    return result
+
+
 def set_job_state(f, job, newstate):
     """
     Do four things:
@@ -130,10 +430,291 @@ def set_job_state(f, job, newstate):
 
     return True
 
-def get_new_job(jobs, f, options):
+def open_sweep(f, job):
+    """
+    Open the file storing the state of each element of a parameter sweep, one byte per element.
+    Create it if needed.
+    """
+
+    fname = "%s.%d.sweep" % (f.name, job.offset)
+    block = os.fdopen(os.open(fname, os.O_RDWR | os.O_CREAT, 0o644), 'rb+', 0)
+    block.seek(0, os.SEEK_END)
+    if block.tell() < job.sweep.size:
+        block.write(b"." * (job.sweep.size - block.tell()))
+
+    return block
+
+
+def find_element(job, start, end, states):
+    """
+    Return the index of the first element of a parameter sweep (from index start up to end)
+    that is in any of the given states, or -1 if there is none.
+    """
+
+    pattern = ("[%s]" % re.escape(states)).encode()
+    pos = start
+    while pos < end:
+        job.block.seek(pos)
+        data = job.block.read(min(65536, end - pos))
+        if not data:
+            break
+        m = re.search(pattern, data)
+        if m:
+            return pos + m.start()
+        pos = pos + len(data)
+
+    return -1
+
+
+def sweep_element(job, i):
+    """
+    Return a job object for element i of a parameter sweep.
+    Its offset and length refer to the element's state byte.
+    """
+
+    element = Job()
+    element.number = job.number + i
+    element.offset = i
+    element.length = 1
+    job.block.seek(i)
+    element.state = job.block.read(1).decode()
+    element.cmd = expand_sweep(job.sweep, i)
+    element.annotations = job.annotations
+
+    return element
+
+
+def update_sweep_state(f, job):
+    """
+    Set the state of a parameter sweep's line from the states of its elements:
+    running (r) while elements are running, done (d) once all are, failed (!) otherwise.
+    """
+
+    job.block.seek(0)
+    data = job.block.read()
+    if b"." in data:
+        newstate = '.'
+    elif b"?" in data or b"r" in data:
+        newstate = 'r'
+    elif data.count(b"d") == len(data):
+        newstate = 'd'
+    else:
+        newstate = '!'
+    f.seek(job.offset)
+    f.write(newstate.encode())
+    f.flush()
+
+    job.state = newstate
+
+
+def get_sweep_element(f, job, options):
+    """
+    Claim and return the next element of a parameter sweep (None if there is none),
+    and whether failed elements are left waiting to be retried.
+    Pristine elements are handed out in order; with --retry, failed elements follow once none are left.
+    """
+
+    if not job.block:
+        job.block = open_sweep(f, job)
+
+    for (start, end) in [(job.cursor, job.sweep.size), (0, job.cursor)]:
+        i = find_element(job, start, end, ".")
+        while i != -1:
+            element = sweep_element(job, i)
+            job.cursor = i + 1
+            # try to claim the element
+            if set_job_state(job.block, element, '?'):
+                return (element, False)
+            i = find_element(job, i + 1, end, ".")
+
+    waiting = False
+    if options.retry:
+        i = find_element(job, 0, job.sweep.size, FAILEDSTATES)
+        while i != -1:
+            element = sweep_element(job, i)
+            ready = retry_time(element, options)
+            if ready is not None and ready > time.time():
+                waiting = True
+            elif ready is not None and set_job_state(job.block, element, '?'):
+                return (element, False)
+            i = find_element(job, i + 1, job.sweep.size, FAILEDSTATES)
+
+    update_sweep_state(f, job)
+    return (None, waiting)
+
+
+def find_straggler(jobs, options):
+    """
+    Return the job that has been running the longest without a second copy,
+    provided this is longer than the given number of seconds. Return None otherwise.
+    """
+
+    straggler = None
+    started = time.time() - options.speculate
     for job in jobs:
+        if job.state != 'r' or job.sweep:
+            continue
+        if job.started and job.started <= started:
+            straggler = job
+            started = job.started
+
+    return straggler
+
+
+def read_jobinfo(job):
+    """
+    Return the time a job was last started, the number of times it was started,
+    and the time it last failed, according to the per-job information file.
+    """
+
+    if jobinfo is None:
+        return (0, 0, 0)
+    data = os.pread(jobinfo, JOBINFO.size, (job.number - 1) * JOBINFO.size)
+    if len(data) < JOBINFO.size:
+        return (0, 0, 0)
+    return JOBINFO.unpack(data)
+
+
+def write_jobinfo(job, started, attempts, failed):
+    """
+    Write a job's record in the per-job information file.
+    """
+
+    os.pwrite(jobinfo, JOBINFO.pack(started, attempts, failed), (job.number - 1) * JOBINFO.size)
+
+
+def record_start(job):
+    """
+    Record the time a job was started in the per-job information file, counting the attempt.
+    """
+
+    if jobinfo is not None:
+        (started, attempts, failed) = read_jobinfo(job)
+        write_jobinfo(job, time.time(), attempts + 1, failed)
+
+
+def record_failure(job):
+    """
+    Record the time a job failed in the per-job information file.
+    """
+
+    if jobinfo is not None:
+        (started, attempts, failed) = read_jobinfo(job)
+        write_jobinfo(job, started, attempts, time.time())
+
+
+def retry_time(job, options):
+    """
+    Return the time from which on a failed job may be retried, or None if it has used up all its attempts.
+    Each failed attempt doubles the time to wait, starting from the given backoff.
+    """
+
+    if job.sweep:
+        # elements of a parameter sweep are accounted for one by one
+        return 0
+    (started, attempts, failed) = read_jobinfo(job)
+    if options.max_attempts and attempts >= options.max_attempts:
+        return None
+    if not attempts:
+        return 0
+    return failed + min(MAXBACKOFF, options.backoff * 2 ** (attempts - 1))
+
+
+def prefers(job, names):
+    """
+    Return true if the job has an "affinity" annotation naming a host or tag among the given names.
+    """
+
+    affinity = job.annotations.get("affinity")
+    return bool(affinity) and not names.isdisjoint(affinity.split(","))
+
+
+def prefers_other(job, names, options):
+    """
+    Return true if the job has an "affinity" annotation naming other hosts or tags than the given names,
+    and should be left to them for now. Once passed over for long enough, it can go to any host.
+    """
+
+    affinity = job.annotations.get("affinity")
+    if not affinity or not names.isdisjoint(affinity.split(",")):
+        return False
+    now = time.time()
+    if not job.passed_over:
+        job.passed_over = now
+    return now - job.passed_over < options.locality_delay
+
+
+def pending_jobs(jobs, options, names=frozenset()):
+    """
+    Iterate over the jobs that might be waiting to be executed, pristine jobs before failed ones,
+    and pristine jobs preferring a host or tag among the given names before all others.
+    """
+
+    if names:
+        for job in jobs:
+            if job.state == '.' and prefers(job, names):
+                yield job
+    for job in jobs:
+        if job.state == '.':
+            yield job
+    if options.retry:
+        for job in jobs:
+            if job.state in FAILEDSTATES:
+                yield job
+
+
+def merge_state(job, state):
+    """
+    Return the state to set a job to when a client reports the given state,
+    taking into account that a second copy of the job might be running (s).
+    A job that is done stays done. A job that failed (or was checkpointed) while another copy still runs is left to that copy.
+    """
+
+    if job.state == 'd':
+        return 'd'
+    if job.state == 's' and state == 'r':
+        return 's'
+    if job.state == 's' and state in FAILEDSTATES + ".":
+        return 'r'
+    return state
+
+
+def get_new_job(jobs, f, options, names=frozenset()):
+    """
+    Claim and return a job to be executed by a client with the given host name and tags.
+    If no job is left, return a job numbered -1.
+    If all remaining jobs wait for others to complete (or more jobs might be submitted), return a job numbered 0.
+    """
+
+    waiting = False
+    for job in pending_jobs(jobs, options, names):
         # keep going until we find a pristine job
-        if not ((job.state == '.') or (options.retry and (job.state == '!' or job.state == 'e'))):
+        if not can_run(job, options):
+            continue
+        # failed jobs have to wait before they are retried
+        if job.state != '.':
+            ready = retry_time(job, options)
+            if ready is None:
+                continue
+            if ready > time.time():
+                waiting = True
+                continue
+        # make sure all jobs this job runs after are done
+        deps = check_dependencies(job, options)
+        if deps == '.':
+            waiting = True
+        if deps != 'd':
+            continue
+        # jobs preferring other hosts are left to them for a while
+        if prefers_other(job, names, options):
+            waiting = True
+            continue
+        # parameter sweeps are claimed element by element
+        if job.sweep:
+            (element, retrying) = get_sweep_element(f, job, options)
+            if element:
+                return element
+            waiting = waiting or retrying
             continue
         # try to claim the job
         if not set_job_state(f, job, '?'):
@@ -141,11 +722,207 @@ def get_new_job(jobs, f, options):
 
         return job
 
+    # once no pristine job is left, hand out second copies of jobs that take long
+    if options.speculate:
+        job = find_straggler(jobs, options)
+        if job:
+            set_job_state(f, job, 's')
+            logging.info("Handing out second copy of job number " + str(job.number))
+            return job
+        if [job for job in jobs if job.state == 's' or (job.state == 'r' and not job.sweep)]:
+            waiting = True
+
+    job = Job()
+    job.number = -1
+    if waiting or options.keep_running:
+        job.number = 0
+    job.cmd = ""
+    return job
+
+
+def open_run(index, arg, options):
+    """
+    Open a job file given as FILENAME or FILENAME:WEIGHT, return the parsed Run object.
+    """
+
+    run = Run()
+    run.index = index
+    run.fname = arg
+    (fname, sep, weight) = arg.rpartition(":")
+    if sep:
+        try:
+            run.weight = float(weight)
+            run.fname = fname
+        except ValueError:
+            pass
+
+    # job databases are queried as needed instead
+    if run.fname.endswith(".db"):
+        if sqlite3.sqlite_version_info < (3, 35):
+            # jobs are claimed with UPDATE ... RETURNING
+            print("Job databases need SQLite 3.35 or newer, found %s" % sqlite3.sqlite_version)
+            sys.exit(1)
+        run.db = open_db(run.fname)
+        return run
+
+    if options.retry:
+        run.jobinfo = os.open("%s.jobinfo" % run.fname, os.O_RDWR | os.O_CREAT, 0o644)
+    run.f = open(run.fname, 'rb+', 0)
+    run.jobs = read_jobs(run.f)
+    resolve_dependencies(run.jobs)
+
+    return run
+
+
+def open_db(fname):
+    """
+    Open a job database (as created by rundb4.py) in WAL mode.
+    """
+
+    db = sqlite3.connect(fname, timeout=60, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+def get_db_job(db, options):
+    """
+    Claim and return a job to be executed from a job database, pristine jobs (by priority) before failed jobs due to be retried.
+    If no job is left, return a job numbered -1.
+    If failed jobs wait to be retried (or more jobs might be submitted), return a job numbered 0.
+    """
+
+    row = db.execute("UPDATE jobs SET state = '?' WHERE number = (SELECT number FROM jobs WHERE state = '.' ORDER BY priority DESC, number LIMIT 1) RETURNING number, cmd").fetchone()
+    if not row and options.retry:
+        row = db.execute("UPDATE jobs SET state = '?' WHERE number = (SELECT number FROM jobs WHERE state IN ('!', 'e', 't', 'o') AND retry_at <= ? AND (? = 0 OR attempts < ?) ORDER BY priority DESC, number LIMIT 1) RETURNING number, cmd", (time.time(), options.max_attempts, options.max_attempts)).fetchone()
+
     job = Job()
+    if row:
+        job.number = row[0]
+        job.state = '?'
+        (job.cmd, job.annotations) = parse_annotations(row[1])
+        return job
+
     job.number = -1
+    if options.keep_running or (options.retry and db.execute("SELECT 1 FROM jobs WHERE state IN ('!', 'e', 't', 'o') AND (? = 0 OR attempts < ?) LIMIT 1", (options.max_attempts, options.max_attempts)).fetchone()):
+        job.number = 0
     job.cmd = ""
     return job
 
+
+def set_db_state(db, jobn, state, options):
+    """
+    Set the state of a job in a job database. A job that is done stays done.
+    Count the attempt when a job starts, and schedule the next one when it failed.
+    Return false if setting a job done or pristine found it in that state already.
+    """
+
+    if state == 'r':
+        db.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, started = ? WHERE number = ? AND state != 'd'", (state, time.time(), jobn))
+    elif state in FAILEDSTATES:
+        db.execute("UPDATE jobs SET state = ?, retry_at = ? + min(?, ? * (1 << max(attempts - 1, 0))) WHERE number = ? AND state != 'd'", (state, time.time(), MAXBACKOFF, options.backoff, jobn))
+    else:
+        return db.execute("UPDATE jobs SET state = ? WHERE number = ? AND state NOT IN ('d', ?)", (state, jobn, state)).rowcount > 0
+    return True
+
+
+def submit_db_jobs(db, cmds):
+    """
+    Add pristine jobs with the given command lines to a job database (in a single transaction), one per element of a parameter sweep.
+    Return the job number of each command line.
+    """
+
+    numbers = []
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for cmd in cmds:
+            (line, annotations) = parse_annotations(cmd)
+            try:
+                priority = int(annotations.get("priority", 0))
+            except ValueError:
+                priority = 0
+            sweep = parse_sweep(line, annotations)
+            elements = [cmd]
+            if sweep:
+                # each element is a job of its own, no longer a sweep
+                del annotations["sweep"]
+                elements = [format_annotations_of(expand_sweep(sweep, i), annotations) for i in range(sweep.size)]
+            for (i, element) in enumerate(elements):
+                number = db.execute("INSERT INTO jobs (state, priority, cmd) VALUES ('.', ?, ?)", (priority, element)).lastrowid
+                if i == 0:
+                    numbers.append(number)
+        db.execute("COMMIT")
+    except:
+        db.execute("ROLLBACK")
+        raise
+
+    return numbers
+
+
+def select_run(run):
+    """
+    Make the per-job information file of a run the one to use.
+    """
+
+    global jobinfo
+    jobinfo = run.jobinfo
+
+
+def find_run(runs, jobn):
+    """
+    Return the run a job number handed out to clients refers to, and the job number within that run.
+    Return (None, 0) if there is none.
+    """
+
+    index = jobn // RUN_STRIDE
+    if jobn < 0 or index >= len(runs):
+        return (None, 0)
+    select_run(runs[index])
+    return (runs[index], jobn % RUN_STRIDE)
+
+
+def get_fair_job(runs, options, names=frozenset()):
+    """
+    Claim and return a job to be executed by a client with the given host name and tags, and the run it belongs to.
+    Jobs are shared among runs by their weight, using deficit round robin:
+    on its turn, a run saves up its weight, and hands out jobs for as long as it has saved up one.
+    If no job is left, return a job numbered -1; if all remaining jobs wait, return a job numbered 0.
+    """
+
+    global turn
+    waiting = False
+    idle = 0
+    while idle < len(runs):
+        run = runs[turn]
+        if run.deficit < 1:
+            run.deficit = run.deficit + run.weight
+            if run.deficit < 1:
+                # a run of low weight waits for a later round
+                turn = (turn + 1) % len(runs)
+                continue
+        select_run(run)
+        if run.db:
+            job = get_db_job(run.db, options)
+        else:
+            job = get_new_job(run.jobs, run.f, options, names)
+        if job.number > 0:
+            run.deficit = run.deficit - 1
+            if run.deficit < 1:
+                turn = (turn + 1) % len(runs)
+            return (run, job)
+        waiting = waiting or job.number == 0
+        # a run without jobs to hand out does not save up its share
+        run.deficit = 0
+        idle = idle + 1
+        turn = (turn + 1) % len(runs)
+
+    job = Job()
+    job.number = -1
+    if waiting:
+        job.number = 0
+    job.cmd = ""
+    return (None, job)
+
+
 def parse_command(command, token, options):
 
     #command to be returned. invalid by default
@@ -157,18 +934,25 @@ def parse_command(command, token, options):
         return cmd
 
     if (parts[0] == "GET"):
-        #GET format is GET <token>
-        if (len(parts) != 2):
+        #GET format is GET <token> [host=<host name>] [tags=<tag>,<tag>,...]
+        if (len(parts) < 2):
             return cmd
         if (parts[1].strip() != token):
             cmd.parseResult = Command.INVALID_TOKEN
             return cmd
+        cmd.hostNames = set()
+        for part in parts[2:]:
+            (key, sep, value) = part.partition("=")
+            if (key not in ["host", "tags"] or not sep):
+                return cmd
+            cmd.hostNames.update([name for name in value.split(",") if name])
         cmd.command = Command.CMD_GET
         cmd.parseResult = Command.VALID_CMD
         return cmd
     elif (parts[0] == "SET"):
-        #SET format is SET <token> <job number> <job status>
-        if (len(parts) != 4):
+        #SET format is SET <token> <job number> <job status> [<length>]
+        #when setting a job done, length bytes of CSV rows of its results (key and value) may follow a newline
+        if (len(parts) not in (4, 5)):
             return cmd
         if (parts[1].strip() != token):
             cmd.parseResult = Command.INVALID_TOKEN
@@ -179,33 +963,405 @@ def parse_command(command, token, options):
             #job number is not a valid integer
             return cmd
 
-        if (not (parts[3] in ['r', 'd', 'e', '!'])):
+        if (not (parts[3] in ['r', 'd', 'e', '!', 't', 'o', '.'])):
             return cmd
+        if (len(parts) == 5):
+            try:
+                cmd.payloadLength = int(parts[4])
+            except:
+                #length is not a valid integer
+                return cmd
+            if (parts[3] != 'd'):
+                return cmd
 
         cmd.jobStatus = parts[3]
         cmd.command = Command.CMD_SET
         cmd.parseResult = Command.VALID_CMD
         return cmd
+    elif (parts[0] == "STAT"):
+        #STAT format is STAT <token> <job number>
+        if (len(parts) != 3):
+            return cmd
+        if (parts[1].strip() != token):
+            cmd.parseResult = Command.INVALID_TOKEN
+            return cmd
+        try:
+            cmd.jobNumber = int(parts[2])
+        except:
+            #job number is not a valid integer
+            return cmd
+
+        cmd.command = Command.CMD_STAT
+        cmd.parseResult = Command.VALID_CMD
+        return cmd
+    elif (parts[0] == "SUBMIT"):
+        #SUBMIT format is SUBMIT <token> <command line>
+        parts = command.split(" ", 2)
+        if (len(parts) != 3 or not parts[2].strip()):
+            return cmd
+        if (parts[1].strip() != token):
+            cmd.parseResult = Command.INVALID_TOKEN
+            return cmd
+
+        cmd.jobCommand = parts[2].strip()
+        cmd.command = Command.CMD_SUBMIT
+        cmd.parseResult = Command.VALID_CMD
+        return cmd
+    elif (parts[0] == "SUBMIT_MANY"):
+        #SUBMIT_MANY format is SUBMIT_MANY <token> <length> [<job file>], followed by a newline and length bytes of command lines
+        if (len(parts) != 3 and len(parts) != 4):
+            return cmd
+        if (parts[1].strip() != token):
+            cmd.parseResult = Command.INVALID_TOKEN
+            return cmd
+        try:
+            cmd.payloadLength = int(parts[2])
+            if (len(parts) == 4):
+                cmd.runIndex = int(parts[3])
+        except:
+            #length or job file is not a valid integer
+            return cmd
+
+        cmd.command = Command.CMD_SUBMIT_MANY
+        cmd.parseResult = Command.VALID_CMD
+        return cmd
+    elif (parts[0] == "TAILS"):
+        #TAILS format is TAILS <token> [<job number>] <length>, followed by a newline and length bytes of zlib compressed output lines
+        #(without a job number, each line is prefixed by the number of the job it is output of)
+        if (len(parts) not in (3, 4)):
+            return cmd
+        if (parts[1].strip() != token):
+            cmd.parseResult = Command.INVALID_TOKEN
+            return cmd
+        try:
+            cmd.jobNumber = None
+            if (len(parts) == 4):
+                cmd.jobNumber = int(parts[2])
+            cmd.payloadLength = int(parts[-1])
+        except:
+            #job number or length is not a valid integer
+            return cmd
+
+        cmd.command = Command.CMD_TAILS
+        cmd.parseResult = Command.VALID_CMD
+        return cmd
+    elif (parts[0] == "TAIL"):
+        #TAIL format is TAIL <token> <job number>
+        if (len(parts) != 3):
+            return cmd
+        if (parts[1].strip() != token):
+            cmd.parseResult = Command.INVALID_TOKEN
+            return cmd
+        try:
+            cmd.jobNumber = int(parts[2])
+        except:
+            #job number is not a valid integer
+            return cmd
+
+        cmd.command = Command.CMD_TAIL
+        cmd.parseResult = Command.VALID_CMD
+        return cmd
+    elif (parts[0] == "RESULTS"):
+        #RESULTS format is RESULTS <token> <job number> <length>, followed by a newline and length bytes of CSV rows of key and value
+        if (len(parts) != 4):
+            return cmd
+        if (parts[1].strip() != token):
+            cmd.parseResult = Command.INVALID_TOKEN
+            return cmd
+        try:
+            cmd.jobNumber = int(parts[2])
+            cmd.payloadLength = int(parts[3])
+        except:
+            #job number or length is not a valid integer
+            return cmd
+
+        cmd.command = Command.CMD_RESULTS
+        cmd.parseResult = Command.VALID_CMD
+        return cmd
     else:
         return cmd
 
 
-def process_get(jobs, f, client, options, client_address):
-    #get a job yet to be done
-    job = get_new_job(jobs, f, options)
-    logging.debug(str(client_address) + " Returning job number " + str(job.number) + " command: " + job.cmd)
+def process_get(runs, client, options, names, client_address):
+    #get a job yet to be done, preferably one for this client
+    (run, job) = get_fair_job(runs, options, names)
+    number = job.number
+    if run:
+        number = run.index * RUN_STRIDE + job.number
+    logging.debug(str(client_address) + " Returning job number " + str(number) + " command: " + job.cmd)
     #return the client the id of the job and the command to execute
-    client.sendall((str(job.number) + " " + job.cmd).encode())
+    client.sendall((str(number) + " " + format_annotations(job)).encode())
     client.recv(2048).decode()
 
-def process_set(jobs, f, client, options, jobn, state, client_address):
+def process_set(runs, client, options, jobn, state, client_address):
+    #set the state of the job, return whether it was in another state before (a job that is done stays done)
+    #find the job file the job belongs to
+    (run, jobn) = find_run(runs, jobn)
+    if not run:
+        logging.error(str(client_address) + " Received unknown job number")
+        return False
+    if run.db:
+        logging.debug(str(client_address) + " Setting job number " + str(jobn) + " status to " + state)
+        return set_db_state(run.db, jobn, state, options)
+    (jobs, f) = (run.jobs, run.f)
     #get all jobs and search for the job requested by the client
     for job in jobs:
+        if job.sweep and job.number <= jobn < job.number + job.sweep.size:
+            if not job.block:
+                job.block = open_sweep(f, job)
+            #set the state of the element to the required value
+            element = sweep_element(job, jobn - job.number)
+            logging.debug(str(client_address) + " Setting job number " + str(element.number) + " status to " + state)
+            changed = element.state != state
+            set_job_state(job.block, element, state)
+            if state == 'r':
+                record_start(element)
+            elif state in FAILEDSTATES:
+                record_failure(element)
+            #once all elements are handed out, keep the state of the line up to date
+            if job.state != '.' and state != 'r':
+                update_sweep_state(f, job)
+            return changed
         if (job.number == jobn):
             #set the state to the required value
             logging.debug(str(client_address) + " Setting job number " + str(job.number) + " status to " + state)
-            set_job_state(f, job, state)
+            if state == 'r' and job.state != 's':
+                job.started = time.time()
+                record_start(job)
+            newstate = merge_state(job, state)
+            if newstate in FAILEDSTATES:
+                record_failure(job)
+            changed = job.state != newstate
+            set_job_state(f, job, newstate)
+            return changed and newstate == state
+    return False
+
+def process_submit(runs, client, options, cmds, index, client_address):
+    #append the jobs to the given job file, then return the client their job numbers
+    if not (0 <= index < len(runs)):
+        client.sendall("INVALID_CMD".encode())
+        logging.error(str(client_address) + " Received unknown job file: " + str(index))
+        return
+    #reject jobs that would only fail once a client runs them
+    for cmd in cmds:
+        if invalid_annotations(split_annotations(cmd)[1]):
+            client.sendall("INVALID_CMD".encode())
+            logging.error(str(client_address) + " Received job with invalid annotations: " + cmd)
+            return
+    run = runs[index]
+    if run.db:
+        numbers = submit_db_jobs(run.db, cmds)
+    else:
+        numbers = submit_jobs(run.jobs, run.f, cmds)
+    logging.debug(str(client_address) + " Submitted " + str(len(numbers)) + " jobs to " + run.fname)
+    client.sendall(" ".join([str(run.index * RUN_STRIDE + number) for number in numbers]).encode())
+
+def process_tails(client, options, jobn, payload, client_address):
+    #keep the last lines of output of the job (or of the jobs the lines are prefixed with), forgetting about the jobs least recently heard of
+    try:
+        lines = zlib.decompress(payload).decode(errors="replace").split("\n")
+        if jobn is None:
+            lines = [(int(line.partition(" ")[0]), line.partition(" ")[2]) for line in lines]
+        else:
+            lines = [(jobn, line) for line in lines]
+    except (zlib.error, ValueError):
+        client.sendall("INVALID_CMD".encode())
+        logging.error(str(client_address) + " Received invalid output of job number " + str(jobn))
+        return
+    for (number, line) in lines:
+        tail = tails.pop(number, None)
+        if tail is None:
+            tail = deque(maxlen=options.tail_lines)
+        tail.append(line)
+        tails[number] = tail
+    while len(tails) > options.tail_jobs:
+        tails.popitem(last=False)
+    if tail_log is not None:
+        os.write(tail_log, "".join(["%d %s\n" % (number, line) for (number, line) in lines]).encode())
+    client.sendall("ACK".encode())
+
+def process_tail(client, options, jobn, client_address):
+    #return the last lines of output of the job, if any
+    client.sendall("\n".join(tails.get(jobn, [])).encode())
+
+def process_results(client, options, jobn, payload, client_address):
+    #append the results reported by the job to the results file (clients that report them when setting the job done do not send these)
+    append_results(jobn, payload)
+    logging.debug(str(client_address) + " Received results of job number " + str(jobn))
+    client.sendall("ACK".encode())
+
+def append_results(jobn, payload):
+    #append the results reported by the job to the results file, if any, all rows in a single write
+    if results is not None:
+        rows = io.StringIO()
+        writer = csv.writer(rows, lineterminator="\n")
+        for row in csv.reader(io.StringIO(payload.decode(errors="replace"))):
+            if len(row) == 2:
+                writer.writerow([jobn] + row)
+        os.write(results, rows.getvalue().encode())
+
+def handle_request(client, client_address, data, runs, token, options):
+    #serve the request a client sent
+    #commands fit on one line, a payload may follow SUBMIT_MANY, TAILS, RESULTS, and SET
+    payload = b""
+    if data.startswith(b"SUBMIT_MANY ") or data.startswith(b"TAILS ") or data.startswith(b"RESULTS ") or data.startswith(b"SET "):
+        (data, payload) = (data.split(b"\n", 1) + [b""])[:2]
+    data = data.rstrip().decode()
+
+    cmd = parse_command(data, token, options)
+    delay = 0
+    if cmd.parseResult == Command.VALID_CMD and cmd.command in (Command.CMD_GET, Command.CMD_STAT, Command.CMD_TAILS):
+        delay = retry_after(options)
+
+    if cmd.parseResult == Command.INVALID_CMD:
+        client.sendall("INVALID_CMD".encode())
+        logging.error(str(client_address) +  " Received invalid command: " + data)
+    elif cmd.parseResult == Command.INVALID_TOKEN:
+        client.sendall("INVALID_TOKEN".encode())
+        logging.error(str(client_address) + " Received invalid token. Ignoring request: " + data)
+    elif delay:
+        #too many requests. tell the client to come back later (but never for reports of finished jobs, which must not get lost)
+        client.sendall(("BUSY retry-after=%d" % delay).encode())
+        logging.debug(str(client_address) + " Busy. Deferring request: " + data)
+    else:
+        if cmd.command == Command.CMD_GET:
+            process_get(runs, client, options, cmd.hostNames, client_address)
+        elif cmd.command == Command.CMD_SET:
+            if cmd.payloadLength:
+                payload = receive_payload(client, payload, cmd.payloadLength)
+            if payload is None:
+                client.sendall("INVALID_CMD".encode())
+                logging.error(str(client_address) + " Received incomplete payload: " + data)
+            else:
+                #only the copy of a job that gets it done reports its results
+                if process_set(runs, client, options, cmd.jobNumber, cmd.jobStatus, client_address) and cmd.payloadLength:
+                    append_results(cmd.jobNumber, payload)
+                elif cmd.payloadLength:
+                    logging.debug(str(client_address) + " Ignoring results of job number " + str(cmd.jobNumber) + ", which is done already")
+                client.sendall("ACK".encode())
+        elif cmd.command == Command.CMD_STAT:
+            process_stat(runs, client, options, cmd.jobNumber, client_address)
+        elif cmd.command == Command.CMD_SUBMIT:
+            process_submit(runs, client, options, [cmd.jobCommand], cmd.runIndex, client_address)
+        elif cmd.command == Command.CMD_SUBMIT_MANY:
+            payload = receive_payload(client, payload, cmd.payloadLength)
+            if payload is None:
+                client.sendall("INVALID_CMD".encode())
+                logging.error(str(client_address) + " Received incomplete payload: " + data)
+            else:
+                cmds = [line.strip() for line in payload.decode().split("\n")]
+                process_submit(runs, client, options, [line for line in cmds if line], cmd.runIndex, client_address)
+        elif cmd.command == Command.CMD_TAILS:
+            payload = receive_payload(client, payload, cmd.payloadLength)
+            if payload is None:
+                client.sendall("INVALID_CMD".encode())
+                logging.error(str(client_address) + " Received incomplete payload: " + data)
+            else:
+                process_tails(client, options, cmd.jobNumber, payload, client_address)
+        elif cmd.command == Command.CMD_TAIL:
+            process_tail(client, options, cmd.jobNumber, client_address)
+        elif cmd.command == Command.CMD_RESULTS:
+            payload = receive_payload(client, payload, cmd.payloadLength)
+            if payload is None:
+                client.sendall("INVALID_CMD".encode())
+                logging.error(str(client_address) + " Received incomplete payload: " + data)
+            else:
+                process_results(client, options, cmd.jobNumber, payload, client_address)
+
+def serve(sock, runs, token, options):
+    #accept incoming connections, serving one client at a time (also if there are other accept loops), thus automatically synchronizing clients
+    #a request that fails (even because of a bug) is logged, but does not stop the accept loop
+    while True:
+        try:
+            client, client_address = sock.accept()
+        except (IOError, OSError) as e:
+            #e.g., out of file descriptors. try again in a bit
+            logging.error("Error accepting connection: " + str(e))
+            time.sleep(1)
+            continue
+        try:
+            logging.debug("Connection from " + str(client_address))
+            data = client.recv(2048)
+            with lock:
+                handle_request(client, client_address, data, runs, token, options)
+        except (IOError, OSError) as e:
+            logging.error(str(client_address) + " Error serving request: " + str(e))
+        except Exception:
+            logging.exception(str(client_address) + " Error serving request")
+        finally:
+            client.close()
+
+def open_listeners(options):
+    #create the sockets to listen on: the TCP port (once for each accept loop, sharing it with SO_REUSEPORT), and a Unix domain socket if asked to
+    listeners = []
+    for i in range(max(1, options.accept_loops)):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if options.accept_loops > 1:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('0.0.0.0', options.port))
+        #let clients queue up while we serve another one, rather than turning them away
+        sock.listen(socket.SOMAXCONN)
+        listeners.append(sock)
+    if options.socket:
+        #remove the socket of a server that did not shut down cleanly
+        if os.path.exists(options.socket) and stat.S_ISSOCK(os.stat(options.socket).st_mode):
+            os.remove(options.socket)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(options.socket)
+        sock.listen(socket.SOMAXCONN)
+        listeners.append(sock)
+    return listeners
+
+def receive_payload(client, payload, length):
+    #read the rest of a payload of the given length, of which we already received a part
+    parts = [payload]
+    received = len(payload)
+    while received < length:
+        data = client.recv(min(1048576, length - received))
+        if not data:
+            return None
+        parts.append(data)
+        received = received + len(data)
+    return b"".join(parts)[:length]
+
+def retry_after(options):
+    #count a request that can wait. if there were more than --max-requests this second, return the number of seconds
+    #the client should wait before asking again (longer the more clients are asking), 0 otherwise
+    global window_start, window_requests
+    now = time.time()
+    if now - window_start >= 1:
+        window_start = now
+        window_requests = 0
+    window_requests = window_requests + 1
+    if not options.max_requests or window_requests <= options.max_requests:
+        return 0
+    return (window_requests - 1) // options.max_requests
+
+def process_stat(runs, client, options, jobn, client_address):
+    #search for the job requested by the client and return its state
+    client.sendall(job_state(runs, jobn).encode())
+
+
+def job_state(runs, jobn):
+    #return the state of the job with the given number, "?" if there is no such job
+    state = "?"
+    (run, jobn) = find_run(runs, jobn)
+    if run and run.db:
+        row = run.db.execute("SELECT state FROM jobs WHERE number = ?", (jobn,)).fetchone()
+        if row:
+            state = row[0]
+    (jobs, f) = run and (run.jobs, run.f) or ([], None)
+    for job in jobs:
+        if job.sweep and job.number <= jobn < job.number + job.sweep.size:
+            if not job.block:
+                job.block = open_sweep(f, job)
+            state = sweep_element(job, jobn - job.number).state
             break
+        if (job.number == jobn):
+            state = job.state
+            break
+    return state
 
 
 def main():
@@ -213,13 +1369,27 @@ def main():
     Program entry point when run interactively.
     """
 
+    global tail_log, results
+
     # prepare option parser
-    parser = OptionParser(usage="usage: %prog [options] filename", description="Read a text file with jobs, execute them one by one.", epilog="In the given file, each line beginning with a dot and a space (. ) will be executed. The file is modified to reflect the execution state of each job (r-running, d-done, !-failed, e-error).")
+    parser = OptionParser(usage="usage: %prog [options] filename[:weight] ...", description="Read a text file with jobs, execute them one by one.", epilog="In the given file, each line beginning with a dot and a space (. ) will be executed. The file is modified to reflect the execution state of each job (r-running, d-done, !-failed, e-error, t-timed out, o-out of memory). If several files are given, jobs are handed out from each in proportion to its weight (1 if not given). Files whose name ends with .db are job databases, as created by rundb4.py.")
     parser.add_option("-r", "--retry", dest="retry", default=False, action="store_true", help="retry failed jobs [default: no]")
+    parser.add_option("--max-attempts", dest="max_attempts", type="int", default=3, action="store", help="if retrying, hand out each job no more than NUMBER times, 0 meaning no limit (waiting for failed jobs to succeed forever) [default: %default]", metavar="NUMBER")
+    parser.add_option("--backoff", dest="backoff", type="float", default=10, action="store", help="if retrying, wait NUMBER seconds before handing out a failed job again, doubling with each failed attempt [default: %default]", metavar="NUMBER")
+    parser.add_option("--speculate", dest="speculate", type="int", default=0, action="store", help="once no pristine jobs are left, hand out a second copy of jobs running longer than NUMBER seconds, 0 meaning never [default: %default]", metavar="NUMBER")
+    parser.add_option("--locality-delay", dest="locality_delay", type="float", default=10, action="store", help="leave jobs with an affinity annotation to matching clients for NUMBER seconds before handing them to any client [default: %default]", metavar="NUMBER")
+    parser.add_option("-k", "--keep-running", dest="keep_running", default=False, action="store_true", help="once all jobs are processed, tell clients to wait for more jobs to be submitted instead of quitting [default: no]")
+    parser.add_option("--results", dest="results", default="", help="append the results jobs report in lines of output like \"@result key=value ...\" to the CSV file FILENAME [default: none]", metavar="FILENAME")
+    parser.add_option("--max-requests", dest="max_requests", type="int", default=0, action="store", help="answer requests for jobs, job states, and output beyond NUMBER per second with BUSY, telling clients when to come back, 0 meaning no limit [default: %default]", metavar="NUMBER")
+    parser.add_option("--tail-lines", dest="tail_lines", type="int", default=100, action="store", help="keep the last NUMBER lines of output clients send for each job [default: %default]", metavar="NUMBER")
+    parser.add_option("--tail-jobs", dest="tail_jobs", type="int", default=10000, action="store", help="keep the output clients send for no more than NUMBER jobs, forgetting about those least recently heard of [default: %default]", metavar="NUMBER")
+    parser.add_option("--tail-log", dest="tail_log", default="", help="also append all output clients send to FILENAME, each line prefixed by its job number [default: none]", metavar="FILENAME")
     parser.add_option("-l", "--logfile", dest="logfile", default=os.path.join(tempfile.gettempdir(), "runmaker4-server.log"), help="log output to FILENAME [default: %default]", metavar="FILENAME")
     parser.add_option("-v", "--verbose", dest="count_verbose", default=0, action="count", help="increase verbosity [default: don't log infos, debug]")
     parser.add_option("-q", "--quiet", dest="count_quiet", default=0, action="count", help="decrease verbosity [default: log warnings, errors]")
     parser.add_option("-p", "--port", dest="port", type="int", default=9998, action="store", help="TCP PORT the         server has to listen to [default: %default]", metavar="PORT")
+    parser.add_option("--socket", dest="socket", default="", help="also listen on the Unix domain socket PATH, for clients on the same host [default: none]", metavar="PATH")
+    parser.add_option("--accept-loops", dest="accept_loops", type="int", default=1, action="store", help="accept connections to the TCP port in NUMBER threads, sharing it with SO_REUSEPORT [default: %default]", metavar="NUMBER")
     parser.add_option("-d", "--daemon", dest="daemonize", default=False, action="store_true", help="detach and run as daemon [default: no]")
     parser.add_option("-t", "--tokenfile", dest="tokenfile", default=os.path.join(os.path.expanduser("~"), ".runmaker4.token"), action="store", help="string representing the file where the token is stored [default: %default]")
 
@@ -229,13 +1399,12 @@ def main():
     _LOGLEVELS = (logging.ERROR, logging.WARN, logging.INFO, logging.DEBUG)
     loglevel = _LOGLEVELS[max(0, min(1 + options.count_verbose - options.count_quiet, len(_LOGLEVELS)-1))]
 
-    # get file name
-    if len(args) != 1:
-        print("Need exactly one filename (a list of all jobs to run)")
+    # get file names
+    if len(args) < 1:
+        print("Need at least one filename (a list of all jobs to run)")
         print("")
         print(parser.get_usage())
         sys.exit(1)
-    fname = args[0]
 
     logging.basicConfig(filename=options.logfile, level=loglevel)
     if not options.daemonize:
@@ -244,8 +1413,19 @@ def main():
         print("The --daemon option is not implemented.")
     logging.debug("Logging to %s" % options.logfile)
 
-    f = open(fname, 'rb+', 0)
-    jobs = read_jobs(f)
+    runs = [open_run(index, arg, options) for (index, arg) in enumerate(args)]
+    for run in runs:
+        if run.weight <= 0:
+            print("Need a positive weight for %s" % run.fname)
+            sys.exit(1)
+        logging.debug("Serving %s (weight %s)" % (run.fname, run.weight))
+
+    if options.tail_log:
+        tail_log = os.open(options.tail_log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    if options.results:
+        results = os.open(options.results, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if os.fstat(results).st_size == 0:
+            os.write(results, "job,key,value\n".encode())
 
     tokenSize=6
     tokenChars=string.ascii_uppercase + string.digits
@@ -253,62 +1433,46 @@ def main():
     print("Token for runmaker4-client.py: %s (written to %s)" % (token, options.tokenfile))
     if (options.tokenfile != ""):
         #we need to write the token to a file
-        with os.fdopen(os.open(options.tokenfile, os.O_WRONLY | os.O_CREAT, 0o600), 'w') as handle:
+        with os.fdopen(os.open(options.tokenfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as handle:
             handle.write(token)
 
-    #create a socket and start listening
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_address = ('0.0.0.0', options.port)
-    logging.debug("Starting runmaker4-server.py on port " + str(options.port))
-    sock.bind(server_address)
-
-    sock.listen(0)
-    run = True
-    while run:
-        try:
-            #accept incoming connection. note that we don't use threads
-            #we serve one client at a time, thus automatically synchronizing clients
-            client, client_address = sock.accept()
-
-            logging.debug("Connection from " + str(client_address))
-            data = client.recv(2048).rstrip().decode()
+    #create the sockets and start listening
+    logging.debug("Starting runmaker4-server.py on port " + str(options.port) + (options.socket and " and " + options.socket or ""))
+    listeners = open_listeners(options)
+    for sock in listeners[1:]:
+        thread = threading.Thread(target=serve, args=(sock, runs, token, options))
+        thread.daemon = True
+        thread.start()
+    try:
+        serve(listeners[0], runs, token, options)
 
-            cmd = parse_command(data, token, options)
+    except SystemExit:
+        logging.debug("Killed.")
 
-            if cmd.parseResult == Command.INVALID_CMD:
-                client.sendall("INVALID_CMD".encode())
-                logging.error(str(client_address) +  " Received invalid command: " + data)
-            elif cmd.parseResult == Command.INVALID_TOKEN:
-                client.sendall("INVALID_TOKEN".encode())
-                logging.error(str(client_address) + " Received invalid token. Ignoring request: " + data)
-            else:
-                if cmd.command == Command.CMD_GET:
-                    process_get(jobs, f, client, options, client_address)
-                elif cmd.command == Command.CMD_SET:
-                    process_set(jobs, f, client, options, cmd.jobNumber, cmd.jobStatus, client_address)
-                    client.sendall("ACK".encode())
+    except KeyboardInterrupt:
+        logging.debug("Keyboard interrupt.")
 
-            client.close()
-
-        except SystemExit:
-            run = False
-            logging.debug("Killed.")
-
-        except KeyboardInterrupt:
-            run = False
-            logging.debug("Keyboard interrupt.")
-
-        except:
-            raise
+    #wait for a request other accept loops might be serving
+    lock.acquire()
 
     # clean up
     logging.debug("Shutting down.")
     if (options.tokenfile != ""):
         os.remove(options.tokenfile)
-    sock.close()
+    for sock in listeners:
+        sock.close()
+    if options.socket:
+        os.remove(options.socket)
 
-    f.close()
+    for run in runs:
+        if run.db:
+            run.db.close()
+        else:
+            run.f.close()
+    if tail_log is not None:
+        os.close(tail_log)
+    if results is not None:
+        os.close(results)
 
 def signal_handler(signal, frame):
     sys.exit(1)
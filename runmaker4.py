@@ -29,14 +29,28 @@
 #
 
 from __future__ import print_function
+import ast
+import builtins
+import csv
 import fcntl
+import hashlib
+import importlib
+import io
+import json
 import os
+import re
 import select
+import struct
+import shlex
 import signal
+import sqlite3
+import stat
 import subprocess
 import sys
 import multiprocessing
+import multiprocessing.connection
 import time
+import traceback
 from optparse import OptionParser
 
 # log file is this many characters wide
@@ -45,98 +59,1490 @@ LOGWIDTH = 160
 # number of seconds between each logging of output to log file
 LOGMAXDELAY = 60
 
+# command lines containing any of these characters are run via the shell
+SHELLCHARS = set("|&;<>()$`\\*?[]{}~#!\n")
+
+# command lines starting with any of these words are run via the shell
+SHELLWORDS = set(["cd", "exec", "exit", "export", "set", "source", ".", "ulimit", "umask", "if", "for", "while", "until", "case", "eval", "trap", "unset", "alias", "wait"])
+
+# if tracing, the Trace object events are recorded to
+trace = None
+
+# if forking jobs from a pre-initialized program, the Zygote object
+zygote = None
+
+# if keeping per-job information next to the job file, its file descriptor
+jobinfo = None
+
+# if caching results, the number of bytes in the result cache as last counted, plus those this process stored since
+cache_total = None
+
+# if claiming jobs by creating marker files instead of locking the job file, the directory holding them
+claims = None
+
+# once asked to drain (by SIGUSR1 or the drain file), no more jobs are started
+draining = False
+
+# with adaptive concurrency, the shared number of slots (counting from 0) allowed to start jobs
+concurrency = None
+
+# index of this process among the slots running jobs
+slot = 0
+
+# if pinning jobs, the CPUs this slot's jobs run on
+cpus = None
+
+# per-job information is kept in records of this format (at an offset given by the job number):
+# time the job was last started, number of times it was started, time it last failed
+JOBINFO = struct.Struct("<dId")
+
+# maximum number of seconds a failed job has to wait before it is retried
+MAXBACKOFF = 3600
+
+# number of seconds between checks whether a job's other copy finished
+ABORTCHECKDELAY = 1
+
+# maximum number of seconds between looks for jobs worth a second copy (doubling from one while there are none)
+SPECULATEMAXDELAY = 30
+
+# number of seconds between asking a timed out job to terminate, and killing it
+KILLDELAY = 10
+
+# number of seconds between checks whether to drain, if running jobs are to be sent a checkpoint signal
+DRAINCHECKDELAY = 1
+
+# number of seconds between adjustments of the number of slots allowed to start jobs (and checks whether to start one)
+ADAPTDELAY = 2
+
+# states of jobs that did not complete successfully: failed, error, timed out, out of memory
+FAILEDSTATES = "!eto"
+
+# parameter sweeps: "{0..9}", "{0..100..10}", or "{a,b,c}", but not "${a}"
+SWEEP_RE = re.compile(r"(?<!\$)\{(?:(-?\d+)\.\.(-?\d+)(?:\.\.(-?\d+))?|([^{}\s,$'\"]*(?:,[^{}\s,$'\"]*)+))\}")
+
+# lines of output starting with this report results of a job, e.g., "@result key=value key=value"
+RESULTPREFIX = "@result "
+
+# result cache keeps no more than this many lines of output per job
+CACHEMAXLINES = 1000
+
+# once the result cache is over its size, evict entries until it takes no more than this fraction of it
+CACHELOWWATER = 0.9
+
 class Job:
     """
-    Stores a (parsed) line in the job file.
+    Stores a (parsed) line in the job file.
+    """
+
+    number = 0
+    offset = 0
+    length = 0
+    state = "."
+    cmd = ""
+    annotations = {}
+    after = []
+    sweep = None
+    block = None
+    timed_out = False
+    checkpointed = False
+    results = None
+    cgroup = ""
+    memory_peak = None
+    cpu_time = None
+    oom_killed = False
+    generation = 0
+
+    def __repr__(self):
+        return "Job(%s, %s, '%s', '%s')" % (self.offset, self.length, self.state, self.cmd)
+
+
+class Trace:
+    """
+    Records timestamped events in Chrome trace event format, one JSON object per line.
+    Events are buffered and appended in whole lines, so many processes can share one file.
+    """
+
+    def __init__(self, fname):
+        self.fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.pid = os.getpid()
+        self.lines = []
+        self.last_flush = time.time()
+        self.metadata("process_name", name="%s,%s" % (os.uname()[1], self.pid))
+
+    def metadata(self, kind, **args):
+        self.lines.append(json.dumps({"name": kind, "ph": "M", "pid": self.pid, "tid": self.pid, "args": args}))
+
+    def event(self, kind, start, duration, **args):
+        self.lines.append(json.dumps({"name": kind, "ph": "X", "ts": int(start * 1000000), "dur": int(duration * 1000000), "pid": self.pid, "tid": self.pid, "args": args}))
+        if len(self.lines) >= 1000 or time.time() - self.last_flush >= 1:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            os.write(self.fd, ("\n".join(self.lines) + "\n").encode())
+            self.lines = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+class Sweep:
+    """
+    Stores a parsed parameter sweep, i.e., the literal parts and value ranges of a command line.
+    """
+
+    parts = []
+    size = 1
+
+    def __repr__(self):
+        return "Sweep(%s, %s)" % (self.size, self.parts)
+
+
+def parse_annotations(cmd):
+    """
+    Split a command line into the command proper and its annotations.
+    Annotations are written as a trailing shell comment "#@ key=value key=value ...",
+    so the shell ignores them if the line is run by an older version.
+    """
+
+    i = cmd.rfind("#@")
+    if i == -1 or (i > 0 and not cmd[i-1].isspace()):
+        return (cmd, {})
+
+    annotations = {}
+    for word in cmd[i+2:].split():
+        (key, sep, value) = word.partition("=")
+        annotations[key] = value
+
+    if "timeout" in annotations:
+        try:
+            timeout = float(annotations["timeout"])
+        except ValueError:
+            timeout = -1
+        if not timeout >= 0:
+            print("ignoring invalid timeout annotation `%s' of `%s'" % (annotations["timeout"], cmd[:i].rstrip()))
+            del annotations["timeout"]
+
+    return (cmd[:i].rstrip(), annotations)
+
+
+def parse_sweep(cmd, annotations):
+    """
+    Parse the parameter sweep in a command line, return None if there is none.
+    Only lines with a sweep annotation are sweeps, as the shell gives braces a meaning of its own.
+    """
+
+    if "sweep" not in annotations:
+        return None
+    sweep = Sweep()
+    sweep.parts = []
+    sweep.size = 1
+    pos = 0
+    for m in SWEEP_RE.finditer(cmd):
+        sweep.parts.append(cmd[pos:m.start()])
+        if m.group(4) is not None:
+            values = m.group(4).split(",")
+        else:
+            start = int(m.group(1))
+            stop = int(m.group(2))
+            step = abs(int(m.group(3) or 1)) or 1
+            if stop < start:
+                step = -step
+            # ranges are never expanded, but indexed on demand
+            values = range(start, stop + (step > 0 and 1 or -1), step)
+        sweep.parts.append(values)
+        sweep.size = sweep.size * len(values)
+        pos = m.end()
+    if pos == 0:
+        return None
+    sweep.parts.append(cmd[pos:])
+
+    return sweep
+
+
+def expand_sweep(sweep, i):
+    """
+    Return the command line of element i of a parameter sweep.
+    The last value range varies fastest, like in a shell brace expansion.
+    """
+
+    words = []
+    for part in reversed(sweep.parts):
+        if isinstance(part, str):
+            words.append(part)
+        else:
+            words.append(str(part[i % len(part)]))
+            i = i // len(part)
+
+    return "".join(reversed(words))
+
+
+def read_jobs(f):
+    """
+    Read the job file, return the parsed list of jobs.
+    """
+
+    jobs = []
+    number = 1
+
+    # get a read lock on the whole file
+    lock_file(f, fcntl.LOCK_SH, 0, 0)
+
+    f.seek(0)
+    while 1:
+        job = Job()
+        job.number = number
+        job.offset = f.tell()
+        s = f.readline().decode()
+        job.length = f.tell() - job.offset
+        if not s:
+            break
+        if len(s) < 3:
+            continue
+        if (s[0] == "#" or s[0] == "/"):
+            continue
+        # line format: <state><one whitespace><commandline>
+        if not (s[1] == "\t" or s[1] == " "):
+            continue
+        s = s.rstrip()
+        job.state = s[0]
+        (job.cmd, job.annotations) = parse_annotations(s[2:])
+        job.sweep = parse_sweep(job.cmd, job.annotations)
+
+        jobs.append(job)
+        # each element of a parameter sweep gets its own job number
+        number = number + (job.sweep and job.sweep.size or 1)
+
+    # release the read lock
+    lock_file(f, fcntl.LOCK_UN, 0, 0)
+
+    return jobs
+
+
+def refresh_job_states(f, jobs):
+    """
+    Re-read all job states from the file.
+    """
+
+    assert(not f.closed)
+
+    # get a read lock on the whole file
+    lock_file(f, fcntl.LOCK_SH, 0, 0)
+
+    try:
+        f.seek(0)
+        data = f.read()
+    finally:
+        # release the read lock
+        lock_file(f, fcntl.LOCK_UN, 0, 0)
+
+    for job in jobs:
+        job.state = chr(data[job.offset])
+
+
+def resolve_dependencies(jobs):
+    """
+    Resolve the "after" annotations of all jobs to the list of jobs they run after.
+    Any number of lines can share a label given by a "label" annotation.
+    """
+
+    labels = {}
+    for job in jobs:
+        for label in job.annotations.get("label", "").split(","):
+            if label:
+                labels.setdefault(label, []).append(job)
+
+    for job in jobs:
+        job.after = []
+        for label in job.annotations.get("after", "").split(","):
+            if label:
+                job.after.extend(labels.get(label, []))
+
+
+def can_run(job, options):
+    """
+    Return true if the job is waiting to be executed.
+    """
+
+    return (job.state == '.') or (options.retry and job.state in FAILEDSTATES)
+
+
+def check_dependencies(f, job, options):
+    """
+    Return 'd' if all jobs the job runs after are done,
+    '!' if one of them can no longer complete, '.' otherwise.
+    """
+
+    result = 'd'
+    for dep in job.after:
+        if dep.state == 'd':
+            continue
+        if dep.state in FAILEDSTATES and options.retry and dep.sweep and not dep.block:
+            # whether a failed parameter sweep is retried depends on its elements
+            dep.block = open_sweep(f, dep)
+        if dep.state in FAILEDSTATES and not (options.retry and retry_time(dep, options) is not None):
+            return '!'
+        result = '.'
+
+    return result
+
+
+def lock_file(f, cmd, length=0, start=0):
+    """
+    Lock or unlock a range of a file using fcntl.lockf(), unless claims rely on marker files instead.
+    """
+
+    if claims is None:
+        fcntl.lockf(f, cmd, length, start)
+
+
+def marker_path(job, generation):
+    """
+    Return the path of the marker file claiming a job for the given attempt, counting from 0.
+    """
+
+    if generation == 0:
+        return os.path.join(claims, str(job.number))
+    return os.path.join(claims, "%d.%d" % (job.number, generation))
+
+
+def read_marker(path):
+    """
+    Return the state recorded in a marker file, '?' if it holds none yet, or None if there is no such file.
+    """
+
+    try:
+        with open(path, 'rb') as inf:
+            return inf.read(1).decode() or '?'
+    except FileNotFoundError:
+        return None
+
+
+def claim_marker(f, job, newstate):
+    """
+    Claim a job by creating the marker file of its next attempt, which succeeds for exactly one process.
+    A marker file holds the state of its attempt; it is released for the next one once marked pristine,
+    or failed (if the job is expected to have failed, i.e., is to be retried).
+    Return true if successful. Otherwise, update the job object and (as a best effort) the job file from the marker.
+    """
+
+    generation = 0
+    while True:
+        path = marker_path(job, generation)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            state = read_marker(path)
+            if state is None:
+                continue
+            if state == '.' or (state in FAILEDSTATES and job.state in FAILEDSTATES):
+                generation = generation + 1
+                continue
+            # the current attempt is somebody else's
+            if state != '?':
+                os.pwrite(f.fileno(), state.encode(), job.offset)
+            job.state = state
+            return False
+        os.write(fd, newstate.encode())
+        os.close(fd)
+        break
+
+    os.pwrite(f.fileno(), newstate.encode(), job.offset)
+    job.generation = generation
+    job.state = newstate
+
+    return True
+
+
+def set_marker_state(f, job, newstate):
+    """
+    Set the state of a job we claimed in its marker file and (as a best effort) in the job file.
+    Return true if the marker file matched the job object.
+    """
+
+    path = marker_path(job, job.generation)
+    if read_marker(path) != job.state:
+        return False
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.write(fd, newstate.encode())
+    finally:
+        os.close(fd)
+    os.pwrite(f.fileno(), newstate.encode(), job.offset)
+    job.state = newstate
+
+    return True
+
+
+def set_job_state(f, job, newstate):
+    """
+    Do four things:
+    - Make sure the job file matches a job object.
+    - Modify the job file to reflect a job's new state.
+    - Modify a job object to reflect its new state.
+    - Return true if successful.
+    """
+
+    assert(not f.closed)
+    assert(job.length > 0)
+    assert(len(newstate) == 1)
+
+    # without locks, marker files decide who gets a job
+    if claims is not None:
+        start = time.time()
+        oldstate = job.state
+        if newstate == '?':
+            ok = claim_marker(f, job, newstate)
+        else:
+            ok = set_marker_state(f, job, newstate)
+        if trace:
+            trace.event((newstate == '?') and "claim" or "set_job_state", start, time.time() - start, job=job.number, state=oldstate, newstate=newstate, ok=ok, lock_wait_us=0)
+        return ok
+
+    # get an exclusive lock for the byte we will change
+    start = time.time()
+    lock_file(f, fcntl.LOCK_EX, job.offset, 1)
+    locked = time.time()
+
+    s = None
+    try:
+        f.seek(job.offset)
+        s = f.read(1).decode()
+        if s != job.state:
+            return False
+        f.seek(job.offset)
+        f.write(newstate.encode())
+        f.flush()
+    finally:
+        # release the exclusive lock
+        lock_file(f, fcntl.LOCK_UN, job.offset, 1)
+        if trace:
+            trace.event((newstate == '?') and "claim" or "set_job_state", start, time.time() - start, job=job.number, state=job.state, newstate=newstate, ok=(s == job.state), lock_wait_us=int((locked - start) * 1000000))
+
+    job.state = newstate
+
+    return True
+
+
+def open_sweep(f, job):
+    """
+    Open the file storing the state of each element of a parameter sweep, one byte per element.
+    Create it if needed.
+    """
+
+    fname = "%s.%d.sweep" % (f.name, job.offset)
+    block = os.fdopen(os.open(fname, os.O_RDWR | os.O_CREAT, 0o644), 'rb+', 0)
+
+    # get an exclusive lock on the whole file
+    lock_file(block, fcntl.LOCK_EX, 0, 0)
+
+    try:
+        block.seek(0, os.SEEK_END)
+        if block.tell() < job.sweep.size:
+            block.write(b"." * (job.sweep.size - block.tell()))
+    finally:
+        # release the exclusive lock
+        lock_file(block, fcntl.LOCK_UN, 0, 0)
+
+    return block
+
+
+def find_element(job, start, states):
+    """
+    Return the index of the first element of a parameter sweep (from index start on)
+    that is in any of the given states, or -1 if there is none.
+    """
+
+    pattern = ("[%s]" % re.escape(states)).encode()
+    pos = start
+    while pos < job.sweep.size:
+        job.block.seek(pos)
+        data = job.block.read(min(65536, job.sweep.size - pos))
+        if not data:
+            break
+        m = re.search(pattern, data)
+        if m:
+            return pos + m.start()
+        pos = pos + len(data)
+
+    return -1
+
+
+def sweep_element(job, i):
+    """
+    Return a job object for element i of a parameter sweep.
+    Its offset and length refer to the element's state byte.
+    """
+
+    element = Job()
+    element.number = job.number + i
+    element.offset = i
+    element.length = 1
+    job.block.seek(i)
+    element.state = job.block.read(1).decode()
+    element.cmd = expand_sweep(job.sweep, i)
+    element.annotations = job.annotations
+
+    return element
+
+
+def update_sweep_state(f, job):
+    """
+    Set the state of a parameter sweep's line from the states of its elements:
+    running (r) while elements are running, done (d) once all are, failed (!) otherwise.
+    """
+
+    # get an exclusive lock for the byte we will change
+    lock_file(f, fcntl.LOCK_EX, job.offset, 1)
+
+    try:
+        job.block.seek(0)
+        data = job.block.read()
+        if b"." in data:
+            newstate = '.'
+        elif b"?" in data or b"r" in data:
+            newstate = 'r'
+        elif data.count(b"d") == len(data):
+            newstate = 'd'
+        else:
+            newstate = '!'
+        f.seek(job.offset)
+        f.write(newstate.encode())
+        f.flush()
+    finally:
+        # release the exclusive lock
+        lock_file(f, fcntl.LOCK_UN, job.offset, 1)
+
+    job.state = newstate
+
+
+def parse_result(line):
+    """
+    Return the key-value pairs in a line reporting results ("@result key=value key=value ..."), values optionally quoted as in the shell.
+    """
+
+    line = line[len(RESULTPREFIX):]
+    try:
+        words = shlex.split(line)
+    except ValueError:
+        words = line.split()
+    return [tuple(word.split("=", 1)) for word in words if word.partition("=")[0] and "=" in word]
+
+
+def write_results(job, options):
+    """
+    Append the results a job reported to the results file, as CSV rows of job number, key, and value.
+    All rows of a job are appended in a single write, holding a lock, so that many processes (on many hosts) can share the file.
+    """
+
+    if not job.results:
+        return
+    rows = io.StringIO()
+    writer = csv.writer(rows, lineterminator="\n")
+    for (key, value) in job.results:
+        writer.writerow([job.number, key, value])
+
+    fd = os.open(options.results, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        # lock the results file itself, even if claims rely on marker files instead of locking the job file
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size == 0:
+                rows = "job,key,value\n" + rows.getvalue()
+            else:
+                rows = rows.getvalue()
+            os.write(fd, rows.encode())
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def cache_key(job, options):
+    """
+    Return the result cache key of a job, or None if the job cannot be cached.
+    The key covers the command line, the working directory, and the declared inputs.
+    """
+
+    h = hashlib.sha256()
+    h.update(("%s\n%s\n" % (job.cmd, os.getcwd())).encode())
+    inputs = job.annotations.get("inputs", "")
+    for fname in [i for i in inputs.split(",") if i]:
+        try:
+            st = os.stat(fname)
+            if not options.cache_hash:
+                h.update(("%s %d %d\n" % (fname, st.st_size, st.st_mtime_ns)).encode())
+                continue
+            h.update(("%s %d\n" % (fname, st.st_size)).encode())
+            with open(fname, 'rb') as inf:
+                for chunk in iter(lambda: inf.read(1 << 20), b""):
+                    h.update(chunk)
+        except EnvironmentError:
+            return None
+
+    return h.hexdigest()
+
+
+def restore_job(job, key, options):
+    """
+    Look up a job in the result cache, replay its output, return true on a hit.
+    """
+
+    fname = os.path.join(options.cache_dir, key)
+    try:
+        with open(fname, 'r') as inf:
+            entry = json.load(inf)
+        # mark the entry as recently used
+        os.utime(fname, None)
+    except (EnvironmentError, ValueError):
+        return False
+
+    print("cached `%s'" % job.cmd)
+    job.results = [tuple(result) for result in entry.get("results", [])]
+    log = [":".ljust(LOGWIDTH) for i in range(options.logfile_lines)]
+    for (stream, line) in entry["output"]:
+        s = "%s (cached): %s" % (stream, line)
+        if options.logfile:
+            s = "%s %s" % ((stream == "stdout") and ":" or "!", s)
+            log.pop(0)
+            log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
+        else:
+            print(s)
+    s = "status (cached): %s %s \"%s\"" % ("exit", 0, job.cmd)
+    print(s)
+    if options.logfile:
+        s = "+ %s" % s
+        log.pop(0)
+        log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
+        s = ".-> %s (in %s)" % (job.cmd, os.getcwd())
+        with open(options.logfile, 'rb+', 0) as logf:
+            logf.seek((job.number - 1) * (LOGWIDTH + 1) * (options.logfile_lines + 1))
+            logf.write(("%s\n" % s[:LOGWIDTH].ljust(LOGWIDTH)).encode())
+            for s in log:
+                logf.write(("%s\n" % s).encode())
+
+    return True
+
+
+def store_job(job, key, output, options):
+    """
+    Store the output of a successful job in the result cache.
+    Once the cache seems to exceed its size, evict the least recently used entries.
+    """
+
+    global cache_total
+
+    fname = os.path.join(options.cache_dir, key)
+    tmpname = "%s.%s.%d.tmp" % (fname, os.uname()[1], os.getpid())
+    try:
+        with open(tmpname, 'w') as outf:
+            json.dump({"cmd": job.cmd, "output": output[-CACHEMAXLINES:], "results": job.results or []}, outf)
+        size = os.path.getsize(tmpname)
+        os.rename(tmpname, fname)
+    except EnvironmentError:
+        return
+
+    # only look at the whole cache when it might have grown too large (other processes storing entries are noticed then)
+    if cache_total is not None:
+        cache_total = cache_total + size
+        if cache_total <= options.cache_size * 1024 * 1024:
+            return
+    cache_total = evict_cached(options)
+
+
+def evict_cached(options):
+    """
+    Remove the least recently used entries of the result cache if it takes more than --cache-size megabytes,
+    until it takes no more than CACHELOWWATER of that. Return the number of bytes left in the cache.
+    """
+
+    entries = []
+    total = 0
+    for name in os.listdir(options.cache_dir):
+        try:
+            st = os.stat(os.path.join(options.cache_dir, name))
+        except EnvironmentError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+        total = total + st.st_size
+    if total <= options.cache_size * 1024 * 1024:
+        return total
+    entries.sort()
+    for (mtime, size, name) in entries:
+        if total <= CACHELOWWATER * options.cache_size * 1024 * 1024:
+            break
+        try:
+            os.remove(os.path.join(options.cache_dir, name))
+        except EnvironmentError:
+            pass
+        total = total - size
+    return total
+
+
+def lock_staging(options):
+    """
+    Return the lock file of the staging directory (shared by all slots on a host), locked; closing it releases the lock.
+    """
+
+    lockf = open(os.path.join(options.stage_dir, ".lock"), 'a')
+    fcntl.lockf(lockf, fcntl.LOCK_EX)
+    return lockf
+
+
+def staged_current(path, st, options):
+    """
+    Return whether the staged copy at the given path is current: whether the size and modification time of the input (as given by its stat result)
+    match those recorded when it was staged (and, with --stage-verify, its content hash matches the one recorded).
+    Call with the lock on the staging directory held.
+    """
+
+    try:
+        with open(path + ".stage", 'r') as inf:
+            entry = json.load(inf)
+        if entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns or os.path.getsize(path) != st.st_size:
+            return False
+        return not options.stage_verify or file_hash(path) == entry["sha256"]
+    except (EnvironmentError, ValueError, KeyError):
+        return False
+
+
+def claim_copy(tmpname):
+    """
+    Claim copying an input to the given temporary file in the staging directory, by creating it exclusively.
+    Return a descriptor of the file and whether the claim succeeded; if not, another process is copying,
+    and locking the descriptor waits for it to finish. Return None for the descriptor if the copy just finished.
+    Call with the lock on the staging directory held.
+    """
+
+    try:
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        return (fd, True)
+    except FileExistsError:
+        pass
+    try:
+        fd = os.open(tmpname, os.O_WRONLY)
+    except FileNotFoundError:
+        return (None, False)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return (fd, False)
+    # left over by a process that died while copying, take it over
+    os.ftruncate(fd, 0)
+    return (fd, True)
+
+
+def stage_input(fname, options):
+    """
+    Return the path of a current staged copy of an input (see staged_current), marked as in use by this process,
+    copying the input if there is none, or None if it cannot be staged.
+    Only the process that claimed the copy (see claim_copy) copies, without holding the lock on the staging directory; the others wait for it.
+    """
+
+    try:
+        st = os.stat(fname)
+    except EnvironmentError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    name = "%s-%s" % (hashlib.sha256(os.path.abspath(fname).encode()).hexdigest()[:16], os.path.basename(fname))
+    path = os.path.join(options.stage_dir, name)
+    tmpname = path + ".tmp"
+
+    while True:
+        lockf = lock_staging(options)
+        try:
+            if staged_current(path, st, options):
+                # mark the copy as recently used
+                os.utime(path + ".stage", None)
+                mark_staged(path)
+                return path
+            (fd, claimed) = claim_copy(tmpname)
+            if claimed:
+                mark_staged(path)
+        finally:
+            lockf.close()
+        if claimed:
+            break
+        if fd is not None:
+            # wait for the other copy to finish, then look again
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            os.close(fd)
+
+    h = hashlib.sha256()
+    try:
+        with open(fname, 'rb') as inf:
+            for chunk in iter(lambda: inf.read(1 << 20), b""):
+                h.update(chunk)
+                os.write(fd, chunk)
+        if os.fstat(fd).st_size != st.st_size or os.stat(fname).st_mtime_ns != st.st_mtime_ns:
+            # the input changed while we copied it
+            raise IOError("`%s' changed while staging it" % fname)
+        lockf = lock_staging(options)
+        try:
+            os.rename(tmpname, path)
+            with open(path + ".stage", 'w') as outf:
+                json.dump({"source": os.path.abspath(fname), "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": h.hexdigest()}, outf)
+        finally:
+            lockf.close()
+    except EnvironmentError:
+        try:
+            os.remove(tmpname)
+        except EnvironmentError:
+            pass
+        release_staged([path])
+        path = None
+    finally:
+        # let those waiting for the copy look again
+        os.close(fd)
+
+    return path
+
+
+def mark_staged(path):
+    """
+    Mark a staged copy as in use by this process, so that it is not evicted.
+    """
+
+    open("%s.use.%d" % (path, os.getpid()), 'a').close()
+
+
+def release_staged(paths):
+    """
+    Mark staged copies as no longer in use by this process.
+    """
+
+    for path in paths:
+        try:
+            os.remove("%s.use.%d" % (path, os.getpid()))
+        except EnvironmentError:
+            pass
+
+
+def file_hash(fname):
+    """
+    Return the SHA-256 hash of a file's content.
+    """
+
+    h = hashlib.sha256()
+    with open(fname, 'rb') as inf:
+        for chunk in iter(lambda: inf.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def evict_staged(options):
+    """
+    Remove the least recently used staged inputs (except those in use by running processes), and copies left over from interrupted runs,
+    until the staged inputs take no more than --stage-size megabytes.
+    Call with the lock on the staging directory held.
+    """
+
+    entries = []
+    in_use = set()
+    total = 0
+    for name in os.listdir(options.stage_dir):
+        path = os.path.join(options.stage_dir, name)
+        if name.endswith(".tmp"):
+            (fd, claimed) = claim_copy(path)
+            if claimed:
+                # nobody is copying any more
+                try:
+                    os.remove(path)
+                except EnvironmentError:
+                    pass
+            if fd is not None:
+                os.close(fd)
+            continue
+        (base, sep, pid) = name.rpartition(".use.")
+        if sep:
+            try:
+                os.kill(int(pid), 0)
+                in_use.add(os.path.join(options.stage_dir, base))
+            except ProcessLookupError:
+                # left over by a process that is gone
+                try:
+                    os.remove(path)
+                except EnvironmentError:
+                    pass
+            except (ValueError, OSError):
+                in_use.add(os.path.join(options.stage_dir, base))
+            continue
+        if not name.endswith(".stage"):
+            continue
+        path = path[:-len(".stage")]
+        try:
+            mtime = os.stat(path + ".stage").st_mtime
+            size = os.path.getsize(path)
+        except EnvironmentError:
+            (mtime, size) = (0, 0)
+        entries.append((mtime, size, path))
+        total = total + size
+    entries.sort()
+    for (mtime, size, path) in entries:
+        if total <= options.stage_size * 1024 * 1024:
+            break
+        if path in in_use:
+            continue
+        for fname in (path + ".stage", path):
+            try:
+                os.remove(fname)
+            except EnvironmentError:
+                pass
+        total = total - size
+
+
+def stage_inputs(job, options):
+    """
+    Copy the declared inputs of a job to the staging directory (once per host),
+    return the job's command line with their paths replaced by those of the staged copies, and the list of these.
+    Inputs that cannot be staged are left to be read where they are.
+    Once the job is done with the staged copies, call release_staged.
+    """
+
+    cmd = job.cmd
+    inputs = [i for i in job.annotations.get("inputs", "").split(",") if i]
+    if not inputs:
+        return (cmd, [])
+
+    start = time.time()
+    staged = [(fname, stage_input(fname, options)) for fname in inputs]
+    lockf = lock_staging(options)
+    try:
+        evict_staged(options)
+    finally:
+        lockf.close()
+    if trace:
+        trace.event("stage", start, time.time() - start, job=job.number)
+
+    for (fname, path) in staged:
+        if path is None:
+            print("could not stage `%s', reading it in place" % fname)
+            continue
+        # replace the path where it is a word of its own, or follows an "="
+        cmd = re.sub(r"(?<![^\s'\"=])" + re.escape(fname) + r"(?![^\s'\";|&)])", lambda m: path, cmd)
+    return (cmd, [path for (fname, path) in staged if path])
+
+
+def split_command(cmd):
+    """
+    Split a command line into its arguments, return None if it needs a shell to run.
+    """
+
+    if SHELLCHARS.intersection(cmd):
+        return None
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not args or args[0] in SHELLWORDS or "=" in args[0]:
+        return None
+
+    return args
+
+
+class Zygote:
+    """
+    Stores a pre-initialized Python program that jobs running it are forked from.
+    """
+
+    path = ""
+    code = None
+
+    def __repr__(self):
+        return "Zygote(%s)" % self.path
+
+
+class ZygoteProcess:
+    """
+    A job forked from the (pre-initialized) runner process.
+    Provides the parts of the interface of subprocess.Popen needed to run a job.
+    """
+
+    def __init__(self, args, env, cgroup=""):
+        (stdin_r, stdin_w) = os.pipe()
+        (stdout_r, stdout_w) = os.pipe()
+        (stderr_r, stderr_w) = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            returncode = 1
+            try:
+                if cgroup:
+                    join_cgroup(cgroup)
+                os.setpgid(0, 0)
+                os.dup2(stdin_r, 0)
+                os.dup2(stdout_w, 1)
+                os.dup2(stderr_w, 2)
+                for fd in (stdin_r, stdin_w, stdout_r, stdout_w, stderr_r, stderr_w):
+                    os.close(fd)
+                for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2):
+                    signal.signal(signum, signal.SIG_DFL)
+                sys.stdin = open(0, 'r', closefd=False)
+                sys.stdout = open(1, 'w', closefd=False)
+                sys.stderr = open(2, 'w', closefd=False)
+                sys.argv = args
+                os.environ.clear()
+                os.environ.update(env)
+                sys.path[0] = os.path.dirname(zygote.path)
+                returncode = 0
+                try:
+                    exec(zygote.code, {"__name__": "__main__", "__file__": zygote.path, "__builtins__": builtins})
+                except SystemExit as e:
+                    if e.code is None:
+                        returncode = 0
+                    elif isinstance(e.code, int):
+                        returncode = e.code & 0xff
+                    else:
+                        print(e.code, file=sys.stderr)
+                        returncode = 1
+                except:
+                    traceback.print_exc()
+                    returncode = 1
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(returncode)
+        os.close(stdin_r)
+        os.close(stdout_w)
+        os.close(stderr_w)
+        self.stdin = os.fdopen(stdin_w, 'wb')
+        self.stdout = os.fdopen(stdout_r, 'rb')
+        self.stderr = os.fdopen(stderr_r, 'rb')
+        self.returncode = None
+
+    def wait(self):
+        if self.returncode is None:
+            (pid, status) = os.waitpid(self.pid, 0)
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+            self.stdout.close()
+            self.stderr.close()
+        return self.returncode
+
+
+def prepare_zygote(options):
+    """
+    Load the Python program given as zygote, and import the modules it (and the user) asks for,
+    so that jobs running it are forked with all of this already done.
+    """
+
+    global zygote
+    zygote = Zygote()
+    zygote.path = os.path.realpath(options.zygote)
+    with open(zygote.path) as inf:
+        source = inf.read()
+    zygote.code = compile(source, zygote.path, "exec")
+
+    modules = [m for m in options.zygote_preload.split(",") if m]
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.append(node.module)
+    sys.path.insert(0, os.path.dirname(zygote.path))
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            pass
+    sys.path.pop(0)
+
+
+def zygote_args(cmd):
+    """
+    Return the arguments of a job running the zygote's program, None if it runs something else.
+    """
+
+    args = split_command(cmd)
+    if not args:
+        return None
+    if os.path.basename(args[0]).startswith("python") and len(args) > 1:
+        args = args[1:]
+    if os.path.realpath(args[0]) != zygote.path:
+        return None
+
+    return args
+
+
+def spawn_job(job, cmd, options):
+    """
+    Start a job running the given command line in a process group of its own, return the Popen object and how it was started.
+    Unless told otherwise, command lines without shell syntax are executed directly.
+    This saves a shell per job, and (as no preexec_fn is needed) allows Python to use vfork.
+    """
+
+    # tell the job who it is, so that copies of a job can keep their outputs apart
+    env = dict(os.environ, RUNMAKER_JOB=str(job.number), RUNMAKER_COPY="%s,%s" % (os.uname()[1], os.getpid()))
+
+    kwargs = dict(stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    if sys.version_info >= (3, 11):
+        kwargs["process_group"] = 0
+    else:
+        kwargs["start_new_session"] = True
+    if job.cgroup:
+        # the job has to be in its cgroup before it starts (at the cost of vfork)
+        kwargs["preexec_fn"] = lambda: join_cgroup(job.cgroup)
+
+    if zygote:
+        args = zygote_args(cmd)
+        if args:
+            return (ZygoteProcess(args, env, job.cgroup), "zygote")
+
+    args = None
+    if options.spawn != "shell":
+        args = split_command(cmd)
+    if args:
+        try:
+            return (subprocess.Popen(args, **kwargs), "direct")
+        except OSError:
+            # not executable as is, let the shell try (and report errors)
+            pass
+
+    return (subprocess.Popen(cmd, shell=True, **kwargs), "shell")
+
+
+def job_timeout(job, options):
+    """
+    Return the number of seconds a job may run (given by its "timeout" annotation, or the --timeout option), 0 meaning forever.
+    """
+
+    if "timeout" in job.annotations:
+        return float(job.annotations["timeout"])
+    return options.timeout
+
+
+def drain_handler(signum, frame):
+    """
+    Signal handler asking to drain, i.e., to let running jobs finish, but not start new ones.
+    """
+
+    global draining
+    draining = True
+
+
+def is_draining(options):
+    """
+    Return true if no new jobs are to be started, i.e., after SIGUSR1 or once the drain file exists.
+    """
+
+    global draining
+    if not draining and options.drain_file and os.path.exists(options.drain_file):
+        draining = True
+    return draining
+
+
+def parse_signal(name):
+    """
+    Return the number of a signal given by name (e.g., "USR2" or "SIGUSR2") or number.
+    """
+
+    if name.isdigit():
+        return int(name)
+    if not name.upper().startswith("SIG"):
+        name = "SIG" + name
+    return int(getattr(signal, name.upper()))
+
+
+def slot_allowed(options):
+    """
+    With adaptive concurrency, return whether this process is among the slots allowed to start jobs (or is asked to drain).
+    If not, wait a while before returning, so the caller can check whether any jobs are left and ask again.
+    """
+
+    if not concurrency or slot < concurrency.value or is_draining(options):
+        return True
+    time.sleep(ADAPTDELAY)
+    return False
+
+
+def read_pressure():
+    """
+    Return the share of the last 10 seconds (in percent) some tasks stalled waiting for CPU, memory, or I/O, whichever is highest,
+    None if the kernel reports no pressure stall information.
+    """
+
+    pressure = None
+    for resource in ("cpu", "memory", "io"):
+        try:
+            with open("/proc/pressure/%s" % resource, 'r') as inf:
+                for line in inf:
+                    fields = line.split()
+                    if fields and fields[0] == "some":
+                        pressure = max(pressure or 0.0, float(fields[1].split("=", 1)[1]))
+        except (IOError, IndexError, ValueError):
+            continue
+    return pressure
+
+
+def read_available_memory():
+    """
+    Return the share of memory (in percent) available for starting new programs, None if unknown.
+    """
+
+    info = {}
+    try:
+        with open("/proc/meminfo", 'r') as inf:
+            for line in inf:
+                fields = line.split()
+                if len(fields) >= 2:
+                    info[fields[0].rstrip(":")] = int(fields[1])
+    except (IOError, ValueError):
+        return None
+    if not info.get("MemTotal") or "MemAvailable" not in info:
+        return None
+    return 100.0 * info["MemAvailable"] / info["MemTotal"]
+
+
+def adapt_concurrency(options):
+    """
+    Lower the number of slots allowed to start jobs while the system is under pressure
+    (stalls, load average above the number of CPUs, or little available memory), raise it while it is not.
+    """
+
+    # load average beyond one runnable task per CPU counts as pressure, too
+    pressure = read_pressure() or 0.0
+    try:
+        load = os.getloadavg()[0] / multiprocessing.cpu_count()
+        pressure = max(pressure, 100.0 * (load - 1))
+    except (OSError, NotImplementedError):
+        pass
+    available = read_available_memory()
+
+    limit = concurrency.value
+    if available is not None and available < options.min_free_memory:
+        limit = max(options.min_jobs, limit // 2)
+    elif pressure > options.max_pressure:
+        limit = max(options.min_jobs, limit - 1)
+    elif pressure < options.max_pressure / 2:
+        limit = min(options.num_jobs, limit + 1)
+    if limit != concurrency.value:
+        print("running up to %d jobs in parallel (%.1f%% pressure, %s memory available)" % (limit, pressure, available is None and "unknown" or "%.0f%%" % available))
+        concurrency.value = limit
+
+
+def parse_cpu_list(s):
+    """
+    Return the set of CPUs in a list like "0-3,8,10-11" (as used in /sys).
+    """
+
+    cpus = set()
+    for part in s.strip().split(","):
+        if not part:
+            continue
+        (first, sep, last) = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    """
+    Return a list like "0-3,8" of the given CPUs.
+    """
+
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join([(first == last) and str(first) or "%d-%d" % (first, last) for (first, last) in ranges])
+
+
+def cpu_groups(size):
+    """
+    Split the CPUs we may run on into contiguous groups of the given size, NUMA node by NUMA node,
+    so that no group spans two nodes (unless no node has enough CPUs for a single group).
     """
 
-    number = 0
-    offset = 0
-    length = 0
-    state = "."
-    cmd = ""
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    try:
+        for name in os.listdir("/sys/devices/system/node"):
+            if name.startswith("node") and name[4:].isdigit():
+                with open("/sys/devices/system/node/%s/cpulist" % name, 'r') as inf:
+                    nodes.append((int(name[4:]), sorted(parse_cpu_list(inf.read()) & allowed)))
+    except (IOError, OSError, ValueError):
+        nodes = []
+    nodes = [cpus for (number, cpus) in sorted(nodes) if cpus] or [sorted(allowed)]
 
-    def __repr__(self):
-        return "Job(%s, %s, '%s', '%s')" % (self.offset, self.length, self.state, self.cmd)
+    groups = []
+    for cpus in nodes:
+        groups.extend([cpus[i:i + size] for i in range(0, len(cpus) - size + 1, size)])
+    if not groups:
+        cpus = sorted(allowed)
+        groups = [cpus[i:i + size] for i in range(0, len(cpus) - size + 1, size)] or [cpus]
+    return groups
 
 
-def read_jobs(f):
+def prepare_cgroup(options):
     """
-    Read the job file, return the parsed list of jobs.
+    Make sure jobs can be given cgroups of their own below the given (delegated) cgroup v2 directory,
+    with the memory and cpu controllers enabled for them.
+    A cgroup holding processes cannot enable controllers for its children, so if we run in it ourselves, move to a cgroup of our own first.
     """
 
-    jobs = []
-
-    # get a read lock on the whole file
-    fcntl.lockf(f, fcntl.LOCK_SH, 0, 0)
+    with open(os.path.join(options.cgroup, "cgroup.procs"), 'r') as inf:
+        pids = inf.read().split()
+    if str(os.getpid()) in pids:
+        leaf = os.path.join(options.cgroup, "runmaker-%d" % os.getpid())
+        if not os.path.isdir(leaf):
+            os.mkdir(leaf)
+        join_cgroup(leaf)
 
-    f.seek(0)
-    while 1:
-        job = Job()
-        job.number = len(jobs)+1
-        job.offset = f.tell()
-        s = f.readline().decode()
-        job.length = f.tell() - job.offset
-        if not s:
-            break
-        if len(s) < 3:
-            continue
-        if (s[0] == "#" or s[0] == "/"):
-            continue
-        # line format: <state><one whitespace><commandline>
-        if not (s[1] == "\t" or s[1] == " "):
+    with open(os.path.join(options.cgroup, "cgroup.controllers"), 'r') as inf:
+        available = inf.read().split()
+    for controller in ("memory", "cpu"):
+        if controller not in available:
             continue
-        s = s.rstrip()
-        job.state = s[0]
-        job.cmd = s[2:]
+        try:
+            with open(os.path.join(options.cgroup, "cgroup.subtree_control"), 'w') as outf:
+                outf.write("+%s" % controller)
+        except (IOError, OSError):
+            pass
 
-        jobs.append(job)
+    with open(os.path.join(options.cgroup, "cgroup.subtree_control"), 'r') as inf:
+        return inf.read().split()
 
-    # release the read lock
-    fcntl.lockf(f, fcntl.LOCK_UN, 0, 0)
 
-    return jobs
+def create_cgroup(job, options):
+    """
+    Create a cgroup of its own for a job, with the configured limits, return its path.
+    """
 
+    path = os.path.join(options.cgroup, "job-%d-%d" % (os.getpid(), job.number))
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    if options.memory_max:
+        with open(os.path.join(path, "memory.max"), 'w') as outf:
+            outf.write("%d" % (options.memory_max * 1024 * 1024))
+    if options.cpu_max:
+        with open(os.path.join(path, "cpu.max"), 'w') as outf:
+            outf.write("%d 100000" % (options.cpu_max * 100000))
+    return path
 
-def set_job_state(f, job, newstate):
+
+def join_cgroup(path):
     """
-    Do four things:
-    - Make sure the job file matches a job object.
-    - Modify the job file to reflect a job's new state.
-    - Modify a job object to reflect its new state.
-    - Return true if successful.
+    Move the calling process into the given cgroup.
     """
 
-    assert(not f.closed)
-    assert(job.length > 0)
-    assert(len(newstate) == 1)
+    with open(os.path.join(path, "cgroup.procs"), 'w') as outf:
+        outf.write("0")
 
-    # get an exclusive lock for the byte we will change
-    fcntl.lockf(f, fcntl.LOCK_EX, job.offset, 1)
 
+def read_cgroup_keys(path, name):
+    """
+    Return the values in a flat keyed cgroup file (like cpu.stat) as a dictionary, empty if not available.
+    """
+
+    values = {}
     try:
-        f.seek(job.offset)
-        s = f.read(1).decode()
-        if s != job.state:
-            return False
-        f.seek(job.offset)
-        f.write(newstate.encode())
-        f.flush()
-    finally:
-        # release the exclusive lock
-        fcntl.lockf(f, fcntl.LOCK_UN, job.offset, 1)
+        with open(os.path.join(path, name), 'r') as inf:
+            for line in inf:
+                fields = line.split()
+                if len(fields) == 2 and fields[1].isdigit():
+                    values[fields[0]] = int(fields[1])
+    except (IOError, OSError):
+        pass
+    return values
 
-    job.state = newstate
 
-    return True
+def finish_cgroup(job):
+    """
+    Record a job's peak memory use, CPU time, and whether it was killed for lack of memory,
+    then kill whatever processes it left behind, and remove its cgroup.
+    """
 
+    path = job.cgroup
+    job.cgroup = ""
+    try:
+        with open(os.path.join(path, "memory.peak"), 'r') as inf:
+            job.memory_peak = int(inf.read())
+    except (IOError, OSError, ValueError):
+        job.memory_peak = None
+    job.cpu_time = read_cgroup_keys(path, "cpu.stat").get("usage_usec", 0) / 1e6
+    job.oom_killed = read_cgroup_keys(path, "memory.events").get("oom_kill", 0) > 0
+
+    try:
+        with open(os.path.join(path, "cgroup.kill"), 'w') as outf:
+            outf.write("1")
+    except (IOError, OSError):
+        pass
+    # killed processes take a moment to leave the cgroup
+    for i in range(100):
+        try:
+            os.rmdir(path)
+            return
+        except OSError:
+            time.sleep(0.01)
+    print("could not remove cgroup %s" % path)
+
+
+def format_usage(job):
+    """
+    Return the resources a job used, as recorded from its cgroup (if any), e.g., " (peak memory 12.3 MB, cpu time 4.5 s)".
+    """
+
+    if job.cpu_time is None:
+        return ""
+    usage = ["cpu time %.1f s" % job.cpu_time]
+    if job.memory_peak is not None:
+        usage.insert(0, "peak memory %.1f MB" % (job.memory_peak / 1024.0 / 1024.0))
+    return " (%s)" % ", ".join(usage)
+
+
+def next_wakeup(*times):
+    """
+    Return the number of milliseconds until the earliest of the given points in time (ignoring those that are 0), None if there is none.
+    """
+
+    times = [t for t in times if t]
+    if not times:
+        return None
+    return max(0.001, min(times) - time.time())*1000
+
+
+def kill_job(opp, signum):
+    """
+    Send a signal to the process group of a job.
+    """
+
+    try:
+        os.killpg(os.getpgid(opp.pid), signum)
+    except OSError:
+        # the job is gone already
+        pass
 
-def run_job(job, options):
+
+def run_job(job, options, output=None, abort=None):
     """
     Fork and execute the job, wait for completion, return the exit code.
+    If given a list as output, append to it (stream, line) tuples of everything the job printed.
+    If given an abort function, call it every now and then; once it returns true, kill the job and return None.
     """
 
-    s = "executing `%s'" % job.cmd
+    # forget about earlier runs of the job (e.g., when retrying it)
+    job.timed_out = False
+    job.checkpointed = False
+    job.cgroup = ""
+    job.memory_peak = None
+    job.cpu_time = None
+    job.oom_killed = False
+
+    # run the job on staged copies of its inputs, but keep its command line as is (e.g., for its cache key)
+    cmd = job.cmd
+    staged = []
+    if options.stage_dir:
+        (cmd, staged) = stage_inputs(job, options)
+
+    s = "executing `%s'" % cmd
     print(s)
 
     logf = None
@@ -152,10 +1558,24 @@ def run_job(job, options):
         for s in log:
             logf.write(("%s\n" % s).encode())
 
-    opp = subprocess.Popen(job.cmd, shell=True, preexec_fn=os.setpgrp, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, )
+    start = time.time()
+    if options.cgroup:
+        job.cgroup = create_cgroup(job, options)
+    try:
+        (opp, how) = spawn_job(job, cmd, options)
+    except:
+        if job.cgroup:
+            finish_cgroup(job)
+        release_staged(staged)
+        raise
+    spawned = time.time()
+    stdout_bytes = 0
+    stderr_bytes = 0
+    if trace:
+        trace.event("spawn", start, spawned - start, job=job.number, pid=opp.pid, how=how)
     try:
         opp_pid = "%s,%s" % (os.uname()[1], opp.pid)
-        s = "status (%s): %s \"%s\"" % (opp_pid, "forked", job.cmd)
+        s = "status (%s): %s \"%s\" (%s, %.1f ms%s)" % (opp_pid, "forked", job.cmd, how, (spawned - start) * 1000, cpus and ", cpus %s" % format_cpu_list(cpus) or "")
         print(s)
         if logf:
             s = "+ %s" % s
@@ -168,37 +1588,57 @@ def run_job(job, options):
         poll.register(opp.stderr, select.POLLIN | select.POLLHUP)
         pollc = 2
 
-        next_wakeup = max(0.001, last_log_write + LOGMAXDELAY - time.time())*1000
-        events = poll.poll(next_wakeup)
+        aborted = False
+        last_abort_check = time.time()
+        last_drain_check = time.time()
+        deadline = 0
+        if job_timeout(job, options):
+            deadline = spawned + job_timeout(job, options)
+        events = poll.poll(next_wakeup(logf and (last_log_write + LOGMAXDELAY), abort and (last_abort_check + ABORTCHECKDELAY), options.checkpoint_signal and not job.checkpointed and (last_drain_check + DRAINCHECKDELAY), deadline))
+        partial = {opp.stdout.fileno(): b"", opp.stderr.fileno(): b""}
+        job.results = []
         while pollc > 0:
             for event in events:
                 (rfd, event) = event
-                if event & select.POLLIN:
-                    if rfd == opp.stdout.fileno():
-                        line = opp.stdout.readline().decode()
-                        if len(line) > 0:
-                            s = "stdout (%s): %s" % (opp_pid, line[:-1])
-                            if logf:
-                                s = ": %s" % s
-                                log.pop(0)
-                                log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
-                                log_changed = True
-                            else:
-                                print(s)
-                    if rfd == opp.stderr.fileno():
-                        line = opp.stderr.readline().decode()
-                        if len(line) > 0:
-                            s = "stderr (%s): %s" % (opp_pid, line[:-1])
-                            if logf:
-                                s = "! %s" % s
-                                log.pop(0)
-                                log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
-                                log_changed = True
-                            else:
-                                print(s)
-                if event & select.POLLHUP:
+                if not event & (select.POLLIN | select.POLLHUP):
+                    continue
+                # read whatever is there: a buffered readline() could keep lines to itself, unnoticed by poll()
+                data = os.read(rfd, 65536)
+                if data:
+                    lines = (partial[rfd] + data).split(b"\n")
+                    partial[rfd] = lines.pop()
+                else:
+                    lines = partial[rfd] and [partial[rfd]] or []
                     poll.unregister(rfd)
                     pollc = pollc - 1
+                for line in lines:
+                    line = line.decode(errors="replace")
+                    if rfd == opp.stdout.fileno():
+                        stdout_bytes = stdout_bytes + len(line) + 1
+                        if line.startswith(RESULTPREFIX):
+                            job.results.extend(parse_result(line))
+                        if output is not None:
+                            output.append(("stdout", line))
+                        s = "stdout (%s): %s" % (opp_pid, line)
+                        if logf:
+                            s = ": %s" % s
+                            log.pop(0)
+                            log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
+                            log_changed = True
+                        else:
+                            print(s)
+                    if rfd == opp.stderr.fileno():
+                        stderr_bytes = stderr_bytes + len(line) + 1
+                        if output is not None:
+                            output.append(("stderr", line))
+                        s = "stderr (%s): %s" % (opp_pid, line)
+                        if logf:
+                            s = "! %s" % s
+                            log.pop(0)
+                            log.append(s[:LOGWIDTH].ljust(LOGWIDTH))
+                            log_changed = True
+                        else:
+                            print(s)
             if logf:
                 if log_changed and (time.time() - last_log_write) >= LOGMAXDELAY:
                     logf.seek((job.number - 1) * (LOGWIDTH + 1) * (options.logfile_lines + 1) + (LOGWIDTH + 1))
@@ -206,11 +1646,48 @@ def run_job(job, options):
                         logf.write(("%s\n" % s).encode())
                     last_log_write = time.time()
                     log_changed = False
+            if abort and not aborted and (time.time() - last_abort_check) >= ABORTCHECKDELAY:
+                last_abort_check = time.time()
+                if abort():
+                    aborted = True
+                    kill_job(opp, signal.SIGKILL)
+            if deadline and time.time() >= deadline:
+                if not job.timed_out:
+                    # ask the job to terminate, then kill it if it does not
+                    job.timed_out = True
+                    s = "status (%s): %s \"%s\"" % (opp_pid, "timed out", job.cmd)
+                    print(s)
+                    kill_job(opp, signal.SIGTERM)
+                    deadline = time.time() + KILLDELAY
+                else:
+                    kill_job(opp, signal.SIGKILL)
+                    deadline = 0
+            if options.checkpoint_signal and not job.checkpointed and (time.time() - last_drain_check) >= DRAINCHECKDELAY:
+                last_drain_check = time.time()
+                if is_draining(options):
+                    # ask the job to save its progress and exit
+                    job.checkpointed = True
+                    s = "status (%s): %s \"%s\"" % (opp_pid, "checkpointing", job.cmd)
+                    print(s)
+                    kill_job(opp, options.checkpoint_signal)
             if pollc > 0:
-                next_wakeup = max(0.001, last_log_write + LOGMAXDELAY - time.time())*1000
-                events = poll.poll(next_wakeup)
+                events = poll.poll(next_wakeup(logf and (last_log_write + LOGMAXDELAY), abort and (last_abort_check + ABORTCHECKDELAY), options.checkpoint_signal and not job.checkpointed and (last_drain_check + DRAINCHECKDELAY), deadline))
         returncode = opp.wait()
-        s = "status (%s): %s %s \"%s\"" % (opp_pid, "exit", returncode, job.cmd)
+        if job.cgroup:
+            finish_cgroup(job)
+        if aborted:
+            s = "status (%s): %s \"%s\"" % (opp_pid, "killed, other copy finished", job.cmd)
+            print(s)
+            return None
+        if trace:
+            usage = {}
+            if job.cpu_time is not None:
+                usage = dict(memory_peak=job.memory_peak, cpu_time=job.cpu_time, oom_kill=job.oom_killed)
+            trace.event("job", spawned, time.time() - spawned, job=job.number, pid=opp.pid, exit=returncode, stdout_bytes=stdout_bytes, stderr_bytes=stderr_bytes, **usage)
+        if job.oom_killed:
+            s = "status (%s): %s \"%s\"" % (opp_pid, "out of memory", job.cmd)
+            print(s)
+        s = "status (%s): %s %s \"%s\"%s" % (opp_pid, "exit", returncode, job.cmd, format_usage(job))
         print(s)
         if logf:
             s = "+ %s" % s
@@ -227,41 +1704,560 @@ def run_job(job, options):
         raise
 
     finally:
+        if job.cgroup:
+            finish_cgroup(job)
+        release_staged(staged)
         if logf:
             logf.close()
 
 
 
-def process_file(fname, options):
+def read_job_state(f, job):
     """
-    Open the job file, and for each job to be executed, execute it.
+    Return a job's state in the job file.
     """
 
-    f = open(fname, 'rb+', 0)
+    return os.pread(f.fileno(), 1, job.offset).decode()
 
-    jobs = read_jobs(f)
+
+def set_job_state_from(f, job, oldstates, newstate):
+    """
+    Set a job's new state if, in the job file, it is in any of the given old states.
+    Return true if successful.
+    """
+
+    for oldstate in oldstates:
+        job.state = oldstate
+        if set_job_state(f, job, newstate):
+            return True
+
+    return False
+
+
+def finish_job(f, job, newstate):
+    """
+    Set the final state of a job we ran, taking into account that another copy of it might be running.
+    A job that is done stays done. A job that failed while another copy still runs is left to that copy.
+    """
+
+    if newstate == 'd':
+        return set_job_state_from(f, job, "rs?", newstate)
+    if set_job_state_from(f, job, "s", 'r'):
+        return False
+    return set_job_state_from(f, job, "r?", newstate)
+
+
+def read_jobinfo(job):
+    """
+    Return the time a job was last started, the number of times it was started,
+    and the time it last failed, according to the per-job information file.
+    """
+
+    if jobinfo is None:
+        return (0, 0, 0)
+    data = os.pread(jobinfo, JOBINFO.size, (job.number - 1) * JOBINFO.size)
+    if len(data) < JOBINFO.size:
+        return (0, 0, 0)
+    return JOBINFO.unpack(data)
+
+
+def write_jobinfo(job, started, attempts, failed):
+    """
+    Write a job's record in the per-job information file.
+    """
+
+    os.pwrite(jobinfo, JOBINFO.pack(started, attempts, failed), (job.number - 1) * JOBINFO.size)
+
+
+def record_start(job):
+    """
+    Record the time a job was started in the per-job information file, counting the attempt.
+    """
+
+    if jobinfo is not None:
+        (started, attempts, failed) = read_jobinfo(job)
+        write_jobinfo(job, time.time(), attempts + 1, failed)
+
+
+def record_failure(job):
+    """
+    Record the time a job failed in the per-job information file.
+    """
+
+    if jobinfo is not None:
+        (started, attempts, failed) = read_jobinfo(job)
+        write_jobinfo(job, started, attempts, time.time())
+
+
+def read_start(job):
+    """
+    Return the time a job was last started, according to the per-job information file.
+    """
+
+    return read_jobinfo(job)[0]
+
+
+def retry_time(job, options):
+    """
+    Return the time from which on a failed job may be retried, or None if it has used up all its attempts.
+    Each failed attempt doubles the time to wait, starting from the given backoff.
+    """
+
+    if job.sweep:
+        # elements of a parameter sweep are accounted for one by one: the sweep waits for the first failed one still to be retried
+        if not job.block:
+            return 0
+        ready = None
+        i = find_element(job, 0, FAILEDSTATES)
+        while i != -1:
+            element = Job()
+            element.number = job.number + i
+            t = retry_time(element, options)
+            if t is not None and (ready is None or t < ready):
+                ready = t
+            i = find_element(job, i + 1, FAILEDSTATES)
+        return ready
+    (started, attempts, failed) = read_jobinfo(job)
+    if options.max_attempts and attempts >= options.max_attempts:
+        return None
+    if not attempts:
+        return 0
+    return failed + min(MAXBACKOFF, options.backoff * 2 ** (attempts - 1))
+
+
+def run_claimed_job(f, job, options, copy=False):
+    """
+    Run a job we claimed (or, if copy is true, a copy of a job that is already running),
+    keeping its state in the job file up to date.
+    Return true if the job is done.
+    """
+
+    abort = None
+    if options.speculate:
+        # stop once another copy of the job finished
+        abort = lambda: read_job_state(f, job) not in "rs"
+    try:
+        key = None
+        output = None
+        if options.cache_dir:
+            key = cache_key(job, options)
+        if key and not copy and restore_job(job, key, options):
+            if trace:
+                trace.event("cached", time.time(), 0, job=job.number)
+            if options.results:
+                write_results(job, options)
+            assert(set_job_state(f, job, 'd'))
+            return True
+        if key:
+            output = []
+        if not copy:
+            assert(set_job_state(f, job, 'r'))
+            record_start(job)
+        returncode = run_job(job, options, output, abort)
+        if returncode is None:
+            return False
+        if job.checkpointed and returncode != 0:
+            # the job saved its progress, so leave it to be resumed
+            finish_job(f, job, '.')
+            return False
+        if job.timed_out:
+            if finish_job(f, job, 't'):
+                record_failure(job)
+            return False
+        if job.oom_killed and returncode != 0:
+            if finish_job(f, job, 'o'):
+                record_failure(job)
+            return False
+        if returncode == 0:
+            if key:
+                store_job(job, key, output, options)
+            # only the copy that marks the job done reports its results
+            if not finish_job(f, job, 'd'):
+                return False
+            if options.results:
+                write_results(job, options)
+            return True
+        else:
+            if finish_job(f, job, '!'):
+                record_failure(job)
+            return False
+    except:
+        #print "Error while executing:", sys.exc_info()[0]
+        if finish_job(f, job, 'e'):
+            record_failure(job)
+        raise
+
+
+def find_straggler(jobs, options):
+    """
+    Return the job that has been running the longest without a second copy,
+    provided this is longer than the given number of seconds. Return None otherwise.
+    """
+
+    straggler = None
+    started = time.time() - options.speculate
     for job in jobs:
-        # keep going until we find a pristine job
-        if not ((job.state == '.') or (options.retry and (job.state == '!' or job.state == 'e'))):
+        if job.state != 'r' or job.sweep:
             continue
-        # try to claim the job
-        if not set_job_state(f, job, '?'):
+        start = read_start(job)
+        if start and start <= started:
+            straggler = job
+            started = start
+
+    return straggler
+
+
+def process_sweep(f, job, options):
+    """
+    Execute the elements of a parameter sweep one by one, pristine elements before failed ones.
+    Return a tuple of whether an element is done and no more jobs are to be run,
+    and whether failed elements are left waiting to be retried.
+    """
+
+    if not job.block:
+        job.block = open_sweep(f, job)
+
+    waiting = False
+    for states in options.retry and (".", FAILEDSTATES) or (".",):
+        i = 0
+        while True:
+            i = find_element(job, i, states)
+            if i == -1:
+                break
+            if not slot_allowed(options):
+                # look again later, unless no elements are left by then
+                update_sweep_state(f, job)
+                return (False, True)
+            if is_draining(options):
+                update_sweep_state(f, job)
+                return (True, False)
+            element = sweep_element(job, i)
+            i = i + 1
+            if element.state != '.':
+                ready = retry_time(element, options)
+                if ready is None:
+                    continue
+                if ready > time.time():
+                    waiting = True
+                    continue
+            # try to claim the element
+            if not set_job_state(job.block, element, '?'):
+                continue
+            # from here on out, the element is ours
+            done = run_claimed_job(job.block, element, options)
+            if done and options.one_only:
+                return (True, False)
+            # an element that failed is retried after a while
+            waiting = waiting or (options.retry and not done)
+    update_sweep_state(f, job)
+    return (False, waiting)
+
+
+def pending_jobs(jobs, options):
+    """
+    Iterate over the jobs that might be waiting to be executed, pristine jobs before failed ones.
+    """
+
+    for job in jobs:
+        if job.state == '.':
+            yield job
+    if options.retry:
+        for job in jobs:
+            if job.state in FAILEDSTATES:
+                yield job
+
+
+def process_jobs(f, options):
+    """
+    For each job in the job file to be executed, execute it.
+    """
+
+    start = time.time()
+    jobs = read_jobs(f)
+    if trace:
+        trace.event("read_jobs", start, time.time() - start, jobs=len(jobs))
+    resolve_dependencies(jobs)
+    last_refresh = time.time()
+    speculate_delay = 1
+    next_speculate = 0
+    while True:
+        waiting = False
+        for job in pending_jobs(jobs, options):
+            # keep going until we find a pristine job
+            if not can_run(job, options):
+                continue
+            # with adaptive concurrency, look again later (the job might be gone by then) unless this slot may start jobs
+            if not slot_allowed(options):
+                waiting = True
+                break
+            # once draining, start no more jobs
+            if is_draining(options):
+                print("draining, not starting any more jobs")
+                return
+            # failed jobs have to wait before they are retried
+            if job.state != '.':
+                ready = retry_time(job, options)
+                if ready is None:
+                    continue
+                if ready > time.time():
+                    waiting = True
+                    continue
+            # make sure all jobs this job runs after are done
+            deps = check_dependencies(f, job, options)
+            if deps == '.' and time.time() - last_refresh >= 1:
+                refresh_job_states(f, jobs)
+                last_refresh = time.time()
+                if not can_run(job, options):
+                    continue
+                deps = check_dependencies(f, job, options)
+            if deps == '.':
+                waiting = True
+            if deps != 'd':
+                continue
+            # parameter sweeps are claimed element by element
+            if job.sweep:
+                (stop, retrying) = process_sweep(f, job, options)
+                if stop:
+                    return
+                waiting = waiting or retrying
+                continue
+            # try to claim the job
+            if not set_job_state(f, job, '?'):
+                continue
+            # from here on out, the job is ours
+            done = run_claimed_job(f, job, options)
+            if done and options.one_only:
+                return
+            # a job that failed is retried after a while
+            waiting = waiting or (options.retry and not done)
+        # once no pristine job is left, run second copies of jobs that take long
+        speculating = False
+        if options.speculate and not is_draining(options) and not (concurrency and slot >= concurrency.value):
+            if time.time() >= next_speculate:
+                refresh_job_states(f, jobs)
+                last_refresh = time.time()
+                job = find_straggler(jobs, options)
+                if job and set_job_state(f, job, 's'):
+                    print("speculatively executing second copy of `%s'" % job.cmd)
+                    speculate_delay = 1
+                    next_speculate = 0
+                    if run_claimed_job(f, job, options, True) and options.one_only:
+                        return
+                    continue
+                # look less often while no job runs long enough, rather than re-reading the job file every second
+                next_speculate = time.time() + speculate_delay
+                speculate_delay = min(2 * speculate_delay, SPECULATEMAXDELAY, options.speculate)
+            if [job for job in jobs if job.state in "rs"]:
+                speculating = not waiting
+                waiting = True
+        # stop once no job is left waiting for others to complete
+        if not waiting or is_draining(options):
+            break
+        if speculating:
+            # only waiting for a job worth a second copy
+            time.sleep(max(min(next_speculate - time.time(), SPECULATEMAXDELAY), 0.1))
             continue
-        # from here on out, the job is ours
-        try:
-            assert(set_job_state(f, job, 'r'))
-            if run_job(job, options) == 0:
-                assert(set_job_state(f, job, 'd'))
-                if options.one_only:
+        time.sleep(1)
+        refresh_job_states(f, jobs)
+        last_refresh = time.time()
+
+
+def open_db(fname):
+    """
+    Open a job database (as created by rundb4.py) in WAL mode.
+    """
+
+    db = sqlite3.connect(fname, timeout=60, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+def claim_db_jobs(db, options):
+    """
+    Claim up to the given number of jobs from a job database, pristine jobs (by priority) before failed jobs due to be retried.
+    Return the list of claimed jobs.
+    """
+
+    start = time.time()
+    rows = db.execute("UPDATE jobs SET state = '?' WHERE number IN (SELECT number FROM jobs WHERE state = '.' ORDER BY priority DESC, number LIMIT ?) RETURNING number, priority, cmd", (options.claim_batch,)).fetchall()
+    if not rows and options.retry:
+        rows = db.execute("UPDATE jobs SET state = '?' WHERE number IN (SELECT number FROM jobs WHERE state IN ('!', 'e', 't', 'o') AND retry_at <= ? AND (? = 0 OR attempts < ?) ORDER BY priority DESC, number LIMIT ?) RETURNING number, priority, cmd", (time.time(), options.max_attempts, options.max_attempts, options.claim_batch)).fetchall()
+    if trace:
+        trace.event("claim", start, time.time() - start, jobs=len(rows))
+
+    jobs = []
+    for (number, priority, cmd) in sorted(rows, key=lambda row: (-row[1], row[0])):
+        job = Job()
+        job.number = number
+        job.state = '?'
+        (job.cmd, job.annotations) = parse_annotations(cmd)
+        jobs.append(job)
+
+    return jobs
+
+
+def set_db_state(db, job, newstate, options):
+    """
+    Set the state of a job we claimed in a job database.
+    Count the attempt when starting a job, and schedule the next one when it failed.
+    """
+
+    start = time.time()
+    if newstate == 'r':
+        db.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, started = ? WHERE number = ?", (newstate, start, job.number))
+    elif newstate in FAILEDSTATES:
+        db.execute("UPDATE jobs SET state = ?, retry_at = ? + min(?, ? * (1 << max(attempts - 1, 0))) WHERE number = ?", (newstate, start, MAXBACKOFF, options.backoff, job.number))
+    else:
+        db.execute("UPDATE jobs SET state = ? WHERE number = ?", (newstate, job.number))
+    if trace:
+        trace.event("set_job_state", start, time.time() - start, job=job.number, state=job.state, newstate=newstate, ok=True)
+    job.state = newstate
+
+
+def run_db_job(db, job, options):
+    """
+    Run a job we claimed from a job database, keeping its state up to date.
+    Return true if the job is done.
+    """
+
+    try:
+        key = None
+        output = None
+        if options.cache_dir:
+            key = cache_key(job, options)
+        if key and restore_job(job, key, options):
+            if trace:
+                trace.event("cached", time.time(), 0, job=job.number)
+            if options.results:
+                write_results(job, options)
+            set_db_state(db, job, 'd', options)
+            return True
+        if key:
+            output = []
+        set_db_state(db, job, 'r', options)
+        returncode = run_job(job, options, output)
+        if job.checkpointed and returncode != 0:
+            # the job saved its progress, so leave it to be resumed
+            set_db_state(db, job, '.', options)
+            return False
+        if job.timed_out:
+            set_db_state(db, job, 't', options)
+            return False
+        if job.oom_killed and returncode != 0:
+            set_db_state(db, job, 'o', options)
+            return False
+        if returncode == 0:
+            if key:
+                store_job(job, key, output, options)
+            if options.results:
+                write_results(job, options)
+            set_db_state(db, job, 'd', options)
+            return True
+        set_db_state(db, job, '!', options)
+        return False
+    except:
+        set_db_state(db, job, 'e', options)
+        raise
+
+
+def process_db(fname, options):
+    """
+    Claim jobs from a job database in batches, and execute them one by one.
+    """
+
+    db = open_db(fname)
+    claimed = []
+    try:
+        while True:
+            # with adaptive concurrency, hand back the jobs we claimed to slots that may start them, and stop once no jobs are left
+            if not slot_allowed(options):
+                release_db_jobs(db, claimed)
+                claimed = []
+                if not db.execute("SELECT 1 FROM jobs WHERE state = '.' LIMIT 1").fetchone() and not retry_due(db, options):
                     break
-            else:
-                assert(set_job_state(f, job, '!'))
-        except:
-            #print "Error while executing:", sys.exc_info()[0]
-            assert(set_job_state(f, job, 'e'))
-            raise
+                continue
+            # once draining, start no more jobs
+            if is_draining(options):
+                print("draining, not starting any more jobs")
+                break
+            if not claimed:
+                claimed = claim_db_jobs(db, options)
+            if not claimed:
+                # keep waiting while failed jobs are due to be retried later
+                if retry_due(db, options):
+                    time.sleep(1)
+                    continue
+                break
+            job = claimed.pop(0)
+            if run_db_job(db, job, options) and options.one_only:
+                break
+    finally:
+        release_db_jobs(db, claimed)
+        db.close()
+
+
+def retry_due(db, options):
+    """
+    Return whether failed jobs in a job database are still to be retried.
+    """
 
-    f.close()
+    return bool(options.retry and db.execute("SELECT 1 FROM jobs WHERE state IN ('!', 'e', 't', 'o') AND (? = 0 OR attempts < ?) LIMIT 1", (options.max_attempts, options.max_attempts)).fetchone())
+
+
+def release_db_jobs(db, jobs):
+    """
+    Hand back jobs we claimed from a job database, but did not start.
+    """
+
+    for job in jobs:
+        db.execute("UPDATE jobs SET state = '.' WHERE number = ? AND state = '?'", (job.number,))
+
+
+def process_file(fname, options, index=0, limit=None):
+    """
+    Open the job file, and for each job to be executed, execute it.
+    With adaptive concurrency, only start jobs while the given slot index is below the shared limit.
+    """
+
+    global trace, jobinfo, claims, slot, concurrency, cpus
+    slot = index
+    concurrency = limit
+    # jobs (and a pre-initialized program they are forked from) inherit the CPUs of this slot
+    if options.pin:
+        groups = cpu_groups(options.pin)
+        cpus = groups[index % len(groups)]
+        os.sched_setaffinity(0, cpus)
+    signal.signal(signal.SIGUSR1, drain_handler)
+    if options.claims == "markers" and not fname.endswith(".db"):
+        claims = "%s.claims" % fname
+        if not os.path.isdir(claims):
+            try:
+                os.makedirs(claims)
+            except FileExistsError:
+                pass
+    if options.trace:
+        trace = Trace(options.trace)
+    if (options.speculate or options.retry) and not fname.endswith(".db"):
+        jobinfo = os.open("%s.jobinfo" % fname, os.O_RDWR | os.O_CREAT, 0o644)
+    if options.zygote:
+        prepare_zygote(options)
+
+    # job databases keep their own attempt counters
+    if fname.endswith(".db"):
+        try:
+            process_db(fname, options)
+        finally:
+            if trace:
+                trace.close()
+        return
+
+    f = open(fname, 'rb+', 0)
+    try:
+        process_jobs(f, options)
+    finally:
+        f.close()
+        if trace:
+            trace.close()
 
 
 
@@ -270,13 +2266,42 @@ def main():
     Program entry point when run interactively.
     """
 
+    global concurrency
+
     # prepare option parser
-    parser = OptionParser(usage="usage: %prog [options] filename", description="Read a text file with jobs, execute them one by one.", epilog="In the given file, each line beginning with a dot and a space (. ) will be executed. The file is modified to reflect the execution state of each job (r-running, d-done, !-failed, e-error).")
+    parser = OptionParser(usage="usage: %prog [options] filename", description="Read a text file with jobs, execute them one by one.", epilog="In the given file, each line beginning with a dot and a space (. ) will be executed. The file is modified to reflect the execution state of each job (r-running, d-done, !-failed, e-error, t-timed out, o-out of memory). Files whose name ends with .db are job databases, as created by rundb4.py.")
     parser.add_option("-j", "--jobs", dest="num_jobs", type="int", default=1, action="store", help="start NUMBER jobs in parallel, 0 meaning autodetect [default: %default]", metavar="NUMBER")
+    parser.add_option("--cgroup", dest="cgroup", default="", help="run each job in a cgroup of its own below the (delegated) cgroup v2 DIRECTORY, recording its peak memory use and CPU time, and marking jobs killed for lack of memory o [default: none]", metavar="DIRECTORY")
+    parser.add_option("--memory-max", dest="memory_max", type="int", default=0, action="store", help="if using cgroups, limit each job to NUMBER megabytes of memory, 0 meaning no limit [default: %default]", metavar="NUMBER")
+    parser.add_option("--cpu-max", dest="cpu_max", type="float", default=0, action="store", help="if using cgroups, limit each job to the time of NUMBER CPUs, 0 meaning no limit [default: %default]", metavar="NUMBER")
+    parser.add_option("--pin", dest="pin", type="int", default=0, action="store", help="pin the jobs of each slot to NUMBER CPUs of their own, packed NUMA node by NUMA node, 0 meaning no pinning [default: %default]", metavar="NUMBER")
+    parser.add_option("--adaptive", dest="adaptive", default=False, action="store_true", help="start fewer than the given number of jobs in parallel while the system is under pressure, 0 meaning up to twice the number of cpus [default: no]")
+    parser.add_option("--min-jobs", dest="min_jobs", type="int", default=1, action="store", help="with adaptive concurrency, always allow NUMBER jobs in parallel [default: %default]", metavar="NUMBER")
+    parser.add_option("--max-pressure", dest="max_pressure", type="float", default=20, action="store", help="with adaptive concurrency, start fewer jobs while tasks stall for more than PERCENT of the time [default: %default]", metavar="PERCENT")
+    parser.add_option("--min-free-memory", dest="min_free_memory", type="float", default=10, action="store", help="with adaptive concurrency, halve the number of jobs started while less than PERCENT of memory is available [default: %default]", metavar="PERCENT")
     parser.add_option("-r", "--retry", dest="retry", default=False, action="store_true", help="retry failed jobs [default: no]")
+    parser.add_option("--max-attempts", dest="max_attempts", type="int", default=3, action="store", help="if retrying, start each job no more than NUMBER times, 0 meaning no limit (waiting for failed jobs to succeed forever) [default: %default]", metavar="NUMBER")
+    parser.add_option("--backoff", dest="backoff", type="float", default=10, action="store", help="if retrying, wait NUMBER seconds before retrying a failed job, doubling with each failed attempt [default: %default]", metavar="NUMBER")
     parser.add_option("-l", "--logfile", dest="logfile", default="", help="log output to FILENAME [default: none]", metavar="FILENAME")
+    parser.add_option("--results", dest="results", default="", help="append the results jobs report in lines of output like \"@result key=value ...\" to the CSV file FILENAME [default: none]", metavar="FILENAME")
     parser.add_option("-n", "--loglines", dest="logfile_lines", type="int", default=3, action="store", help="if logging, log the last NUMBER lines of output [default: %default]", metavar="NUMBER")
+    parser.add_option("-s", "--spawn", dest="spawn", type="choice", choices=["auto", "shell"], default="auto", help="run jobs directly if they need no shell (auto) or always via the shell (shell) [default: %default]", metavar="MODE")
+    parser.add_option("-z", "--zygote", dest="zygote", default="", help="fork jobs running the Python program FILENAME from a pre-initialized copy [default: none]", metavar="FILENAME")
+    parser.add_option("--zygote-preload", dest="zygote_preload", default="", help="if forking jobs from a pre-initialized program, also import the comma-separated list of MODULES [default: none]", metavar="MODULES")
     parser.add_option("-1", "--one-only", dest="one_only", default=False, action="store_true", help="run no more than a single job before exiting [default: no]")
+    parser.add_option("--timeout", dest="timeout", type="float", default=0, action="store", help="stop jobs running longer than NUMBER seconds, marking them t, 0 meaning never [default: %default]", metavar="NUMBER")
+    parser.add_option("--speculate", dest="speculate", type="int", default=0, action="store", help="once no pristine jobs are left, start a second copy of jobs running longer than NUMBER seconds, 0 meaning never [default: %default]", metavar="NUMBER")
+    parser.add_option("-c", "--cache", dest="cache_dir", default="", help="skip jobs found in the result cache in DIRECTORY, store successful jobs there [default: none]", metavar="DIRECTORY")
+    parser.add_option("--cache-size", dest="cache_size", type="int", default=100, action="store", help="if caching, keep no more than NUMBER megabytes of cached output [default: %default]", metavar="NUMBER")
+    parser.add_option("--cache-hash", dest="cache_hash", default=False, action="store_true", help="if caching, identify inputs by content hash instead of size and modification time [default: no]")
+    parser.add_option("--stage-dir", dest="stage_dir", default="", help="copy the inputs jobs declare (in an inputs annotation) to DIRECTORY, once for all slots on this host, and run jobs on the copies [default: none]", metavar="DIRECTORY")
+    parser.add_option("--stage-size", dest="stage_size", type="int", default=10240, action="store", help="if staging, keep no more than NUMBER megabytes of inputs [default: %default]", metavar="NUMBER")
+    parser.add_option("--stage-verify", dest="stage_verify", default=False, action="store_true", help="if staging, check the content hash of a staged copy each time it is used [default: no]")
+    parser.add_option("--claims", dest="claims", type="choice", choices=["lockf", "markers"], default="lockf", help="claim jobs by locking the job file (lockf) or by creating marker files next to it, for file systems without working locks (markers) [default: %default]", metavar="METHOD")
+    parser.add_option("--claim-batch", dest="claim_batch", type="int", default=1, action="store", help="if using a job database, claim NUMBER jobs at a time [default: %default]", metavar="NUMBER")
+    parser.add_option("--trace", dest="trace", default="", help="append a trace of claims, state changes, and job executions to FILENAME [default: none]", metavar="FILENAME")
+    parser.add_option("--drain-file", dest="drain_file", default="", help="once FILENAME exists, start no more jobs, and exit once running jobs finished (as on SIGUSR1) [default: none]", metavar="FILENAME")
+    parser.add_option("--checkpoint-signal", dest="checkpoint_signal", default="", help="when draining, send SIGNAL to running jobs; jobs then exiting unsuccessfully are marked pristine again [default: none]", metavar="SIGNAL")
 
     # parse options
     (options, args) = parser.parse_args()
@@ -289,19 +2314,92 @@ def main():
         sys.exit(1)
     fname = args[0]
 
+    if options.cache_dir and not os.path.isdir(options.cache_dir):
+        os.makedirs(options.cache_dir)
+    if options.stage_dir and not os.path.isdir(options.stage_dir):
+        os.makedirs(options.stage_dir)
+
     # autodetect number of cpus
     if options.num_jobs == 0:
         try:
             options.num_jobs = multiprocessing.cpu_count()
+            # leave room for jobs waiting on I/O
+            if options.adaptive:
+                options.num_jobs = 2 * options.num_jobs
         except:
             pass
 
-    # spawn children
+    if (options.memory_max or options.cpu_max) and not options.cgroup:
+        print("Limiting memory or CPU time of jobs needs --cgroup")
+        sys.exit(1)
+    if options.cgroup:
+        if not os.path.exists(os.path.join(options.cgroup, "cgroup.subtree_control")):
+            print("%s is not a cgroup v2 directory" % options.cgroup)
+            sys.exit(1)
+        try:
+            controllers = prepare_cgroup(options)
+        except (IOError, OSError) as e:
+            print("Cannot use cgroup %s: %s" % (options.cgroup, e))
+            sys.exit(1)
+        for (limit, controller) in ((options.memory_max, "memory"), (options.cpu_max, "cpu")):
+            if limit and controller not in controllers:
+                print("Cannot enable the %s controller for cgroups below %s" % (controller, options.cgroup))
+                sys.exit(1)
+
+    if options.pin:
+        if not hasattr(os, "sched_setaffinity"):
+            print("Pinning jobs to CPUs is not supported on this system")
+            sys.exit(1)
+        groups = cpu_groups(options.pin)
+        if len(groups[0]) < options.pin:
+            print("Cannot pin jobs to %d CPUs, only %d available" % (options.pin, len(groups[0])))
+            sys.exit(1)
+        if len(groups) < options.num_jobs:
+            print("Only %d groups of %d CPUs available, so %d jobs will share CPUs" % (len(groups), options.pin, options.num_jobs))
+
+    # with adaptive concurrency, start out with one slot per cpu
+    if options.adaptive:
+        options.min_jobs = max(1, min(options.min_jobs, options.num_jobs))
+        try:
+            cpus = multiprocessing.cpu_count()
+        except:
+            cpus = options.min_jobs
+        concurrency = multiprocessing.Value('i', max(options.min_jobs, min(options.num_jobs, cpus)), lock=False)
+
+    if options.claims == "markers" and options.speculate:
+        print("Speculative execution needs --claims=lockf")
+        sys.exit(1)
+
+    if fname.endswith(".db"):
+        if not os.path.exists(fname):
+            print("Job database %s does not exist, create it using rundb4.py" % fname)
+            sys.exit(1)
+        if sqlite3.sqlite_version_info < (3, 35):
+            # jobs are claimed with UPDATE ... RETURNING
+            print("Job databases need SQLite 3.35 or newer, found %s" % sqlite3.sqlite_version)
+            sys.exit(1)
+        if options.speculate:
+            print("Speculative execution needs a text file")
+            sys.exit(1)
+
+    if options.checkpoint_signal:
+        try:
+            options.checkpoint_signal = parse_signal(options.checkpoint_signal)
+        except (AttributeError, ValueError):
+            print("Unknown signal %s" % options.checkpoint_signal)
+            sys.exit(1)
+
+    # spawn children, passing on requests to drain to them
     children = []
+    signal.signal(signal.SIGUSR1, lambda signum, frame: [os.kill(child.pid, signum) for child in children if child.exitcode is None])
     for i in range(options.num_jobs):
-        child = multiprocessing.Process(target=process_file, args=(fname,options,))
+        child = multiprocessing.Process(target=process_file, args=(fname,options,i,concurrency,))
         child.start()
         children.append(child)
+    # with adaptive concurrency, keep adjusting the number of slots allowed to start jobs
+    while concurrency and [child for child in children if child.exitcode is None]:
+        multiprocessing.connection.wait([child.sentinel for child in children if child.exitcode is None], ADAPTDELAY)
+        adapt_concurrency(options)
     for child in children:
         child.join()
 
@@ -29,6 +29,7 @@ import fcntl
 import os
 import select
 import signal
+import sqlite3
 import subprocess
 import sys
 import multiprocessing
@@ -138,13 +139,45 @@ def process_file(fname, jobIds, options):
     f.close()
 
 
+def process_db(fname, jobIds, options):
+    """
+    Manipulate a job database (as created by rundb4.py), where job ids are job numbers.
+    """
+
+    db = sqlite3.connect(fname, timeout=60, isolation_level=None)
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if options.all_jobs:
+            rows = db.execute("SELECT number, state, cmd FROM jobs ORDER BY number").fetchall()
+        else:
+            # look up the given jobs only, a few hundred at a time
+            numbers = sorted(set([int(jobId) for jobId in jobIds if jobId.isdigit()]))
+            rows = []
+            for i in range(0, len(numbers), 500):
+                chunk = numbers[i:i+500]
+                rows.extend(db.execute("SELECT number, state, cmd FROM jobs WHERE number IN (%s) ORDER BY number" % ",".join("?" * len(chunk)), chunk).fetchall())
+        for (number, state, cmd) in rows:
+            if options.set_state:
+                db.execute("UPDATE jobs SET state = ? WHERE number = ?", (options.set_state, number))
+                state = options.set_state
+            if options.list:
+                print("%s: %s - %s" % (number, state, cmd))
+        db.execute("COMMIT")
+    except:
+        db.execute("ROLLBACK")
+        raise
+
+    db.close()
+
+
 def main():
     """
     Program entry point when run interactively.
     """
 
     # prepare option parser
-    parser = OptionParser(usage="usage: %prog [options] filename jobId jobId ...", description="Read a text file with jobs, manipulate their state.", epilog="In the given file, each line beginning with a dot and a space (. ) will be executed. The file is modified to reflect the execution state of each job (r-running, d-done, !-failed, e-error).")
+    parser = OptionParser(usage="usage: %prog [options] filename jobId jobId ...", description="Read a text file with jobs, manipulate their state.", epilog="In the given file, each line beginning with a dot and a space (. ) will be executed. The file is modified to reflect the execution state of each job (r-running, d-done, !-failed, e-error, t-timed out, o-out of memory). If the file name ends with .db, it is a job database (as created by rundb4.py), and job ids are job numbers.")
     parser.add_option("-s", "--set", dest="set_state", default="", help="set state to STATE [default: no change]", metavar="STATE")
     parser.add_option("-l", "--list", dest="list", default=False, action="store_true", help="list given jobs [default: no]")
     parser.add_option("-a", "--all", dest="all_jobs", default=False, action="store_true", help="affect all jobs [default: no]")
@@ -165,7 +198,10 @@ def main():
         jobIds = args[1:]
 
     # process file
-    process_file(fname, jobIds, options)
+    if fname.endswith(".db"):
+        process_db(fname, jobIds, options)
+    else:
+        process_file(fname, jobIds, options)
 
 
 # Start main() when run interactively
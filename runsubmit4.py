@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2026 Runmaker4 contributors
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+#
+# Submits jobs to a running runmaker4-server.py.
+#
+# Can also be used from Python:
+#
+#   import runsubmit4
+#   numbers = runsubmit4.submit("alice", 9998, "000000", ["./sim -r 1", "./sim -r 2"])
+#
+
+from __future__ import print_function
+import os
+import socket
+import sys
+from optparse import OptionParser
+
+
+def connect(host, port):
+    """
+    Return a socket connected to the server: to its Unix domain socket if the host is given as a path (containing a slash), to its TCP port otherwise.
+    """
+
+    if "/" in host:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(host)
+        return sock
+    return socket.create_connection((host, port))
+
+
+def submit(host, port, token, cmds, run=0):
+    """
+    Submit a list of command lines to the server in a single request, return their job numbers.
+    If the server serves several job files, the jobs are appended to the given one (counting from 0).
+    """
+
+    payload = "\n".join(cmds).encode()
+    sock = connect(host, port)
+    try:
+        sock.sendall(("SUBMIT_MANY %s %d %d\n" % (token, len(payload), run)).encode() + payload)
+        parts = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            parts.append(data)
+    finally:
+        sock.close()
+
+    response = b"".join(parts).decode()
+    if response in ("", "INVALID_CMD", "INVALID_TOKEN"):
+        raise RuntimeError("server did not accept jobs: %s" % (response or "no response"))
+    return [int(number) for number in response.split()]
+
+
+def read_token(token):
+    """
+    Return the token, reading it from a file if the given string ends with .token.
+    """
+
+    if token.endswith(".token"):
+        with open(token, 'r') as inf:
+            return inf.read().strip()
+    return token
+
+
+def main():
+    """
+    Program entry point when run interactively.
+    """
+
+    # prepare option parser
+    parser = OptionParser(usage="usage: %prog [options] host [filename]", description="Submit jobs to a running runmaker4-server.py.", epilog="Each line of the given file (or of standard input) is a command line to be appended to the server's job file, optionally followed by annotations. The job numbers assigned to the submitted lines are printed, one per line. If the host is a path (containing a slash), connect to the server's Unix domain socket.")
+    parser.add_option("-b", "--batch", dest="batch", type="int", default=10000, action="store", help="submit NUMBER lines per request [default: %default]", metavar="NUMBER")
+    parser.add_option("-f", "--file", dest="run", type="int", default=0, action="store", help="if the server serves several job files, append to the NUMBER-th one, counting from 0 [default: %default]", metavar="NUMBER")
+    parser.add_option("-p", "--port", dest="port", type="int", default=9998, action="store", help="TCP PORT the server is listening to [default: %default]", metavar="PORT")
+    parser.add_option("-t", "--token", dest="token", default=os.path.join(os.path.expanduser("~"), ".runmaker4.token"), action="store", help="string representing either the token or the file where the token is stored. If the parameter ends with .token, it is assumed that the token needs to be read from a file. [default: %default]")
+    parser.add_option("-q", "--quiet", dest="quiet", default=False, action="store_true", help="do not print job numbers [default: no]")
+
+    # parse options
+    (options, args) = parser.parse_args()
+
+    # get host name
+    if len(args) < 1 or len(args) > 2:
+        print("Need a host name (of the server), and optionally a filename (a list of jobs to submit)")
+        print("")
+        print(parser.get_usage())
+        sys.exit(1)
+    host = args[0]
+
+    try:
+        token = read_token(options.token)
+    except IOError:
+        print("Error occured while retrieving the token. Does the token file exist?")
+        sys.exit(1)
+
+    inf = sys.stdin
+    if len(args) > 1:
+        inf = open(args[1], 'r')
+
+    batch = []
+    for line in inf:
+        line = line.strip()
+        if not line:
+            continue
+        batch.append(line)
+        if len(batch) >= options.batch:
+            numbers = submit(host, options.port, token, batch, options.run)
+            if not options.quiet:
+                print("\n".join([str(number) for number in numbers]))
+            batch = []
+    if batch:
+        numbers = submit(host, options.port, token, batch, options.run)
+        if not options.quiet:
+            print("\n".join([str(number) for number in numbers]))
+
+    if inf is not sys.stdin:
+        inf.close()
+
+
+# Start main() when run interactively
+if __name__ == '__main__':
+    main()
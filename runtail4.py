@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2026 Runmaker4 contributors
+#
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+#
+# Shows the last lines of output of jobs, as sent to a running runmaker4-server.py by runmaker4-client.py --tails.
+#
+
+from __future__ import print_function
+import os
+import sys
+import time
+from optparse import OptionParser
+
+# directory containing runmaker4.py and friends
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASEDIR)
+import runsubmit4
+
+
+def get_tail(host, port, token, number):
+    """
+    Return the last lines of output of a job the server knows about, as a list.
+    """
+
+    sock = runsubmit4.connect(host, port)
+    try:
+        sock.sendall(("TAIL %s %d" % (token, number)).encode())
+        parts = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            parts.append(data)
+    finally:
+        sock.close()
+
+    response = b"".join(parts).decode(errors="replace")
+    if response in ("INVALID_CMD", "INVALID_TOKEN"):
+        raise RuntimeError("server did not answer: %s" % response)
+    return [line for line in response.split("\n") if line]
+
+
+def main():
+    """
+    Program entry point when run interactively.
+    """
+
+    # prepare option parser
+    parser = OptionParser(usage="usage: %prog [options] host jobId jobId ...", description="Show the last lines of output of jobs, as sent to a running runmaker4-server.py.", epilog="Clients only send output when started with --tails. The server keeps the last --tail-lines lines of each job. If the host is a path (containing a slash), connect to the server's Unix domain socket.")
+    parser.add_option("-p", "--port", dest="port", type="int", default=9998, action="store", help="TCP PORT the server is listening to [default: %default]", metavar="PORT")
+    parser.add_option("-t", "--token", dest="token", default=os.path.join(os.path.expanduser("~"), ".runmaker4.token"), action="store", help="string representing either the token or the file where the token is stored. If the parameter ends with .token, it is assumed that the token needs to be read from a file. [default: %default]")
+    parser.add_option("-w", "--watch", dest="watch", type="float", default=0, action="store", help="show the output again every NUMBER seconds, 0 meaning only once [default: %default]", metavar="NUMBER")
+
+    # parse options
+    (options, args) = parser.parse_args()
+
+    # get host name and job numbers
+    if len(args) < 2:
+        print("Need a host name (of the server), and at least one job id")
+        print("")
+        print(parser.get_usage())
+        sys.exit(1)
+    host = args[0]
+    try:
+        numbers = [int(arg) for arg in args[1:]]
+    except ValueError:
+        print("Job ids need to be numbers")
+        sys.exit(1)
+
+    try:
+        token = runsubmit4.read_token(options.token)
+    except IOError:
+        print("Error occured while retrieving the token. Does the token file exist?")
+        sys.exit(1)
+
+    while True:
+        for number in numbers:
+            try:
+                lines = get_tail(host, options.port, token, number)
+            except (RuntimeError, IOError) as e:
+                print("Error occured while asking the server: %s" % e)
+                sys.exit(1)
+            if len(numbers) > 1:
+                print("==> job %d <==" % number)
+            print("\n".join(lines))
+        if not options.watch:
+            break
+        time.sleep(options.watch)
+
+
+# Start main() when run interactively
+if __name__ == '__main__':
+    main()
@@ -26,10 +26,20 @@
 
 from __future__ import print_function
 import fcntl
+import json
+import math
+import sqlite3
 import sys
 import time
+from collections import deque
 from optparse import OptionParser
 
+# states of jobs being worked on: running (possibly with a second copy), claimed
+RUNNINGSTATES = "rs?"
+
+# states of jobs that were processed: done, failed, error, timed out, out of memory
+PROCESSEDSTATES = "d!eto"
+
 
 class Job:
     """
@@ -40,6 +50,7 @@ class Job:
     length = 0
     state = "."
     cmd = ""
+    started = 0
 
     def __repr__(self):
         return "Job(%s, %s, '%s', '%s')" % (self.offset, self.length, self.state, self.cmd)
@@ -106,15 +117,121 @@ def refresh_job_states(f, jobs):
     return None
 
 
+def read_db_counts(db):
+    """
+    Return the number of jobs in each state of a job database, and the list of jobs being worked on.
+    """
+
+    counts = dict(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+    running = []
+    for (number, state, started) in db.execute("SELECT number, state, started FROM jobs WHERE state IN ('r', 's', '?')"):
+        job = Job()
+        job.offset = number
+        job.length = 1
+        job.state = state
+        job.started = started
+        running.append(job)
+
+    return (counts, running)
+
+
+class Estimator:
+    """
+    Estimates the throughput of a run (as an exponentially weighted moving average) and the time until it completes,
+    from the job states seen over time.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.first = None         # time of the first update
+        self.last = None          # time of the last update
+        self.processed = 0        # number of jobs processed at the last update
+        self.rate = 0.0           # moving average of jobs processed per second (biased towards 0 at first)
+        self.weight = 0.0         # weight of the moving average, to correct for this bias
+        self.started = {}         # time each job being worked on was started (None if unknown), by job
+        self.durations = deque()  # (time, seconds) of the jobs completed within the window
+
+    def update(self, processed, running, state_of, now):
+        """
+        Take note of the number of jobs processed, and of the jobs being worked on.
+        Call state_of to learn the state of a job that is no longer being worked on.
+        """
+
+        if self.last is None:
+            self.first = now
+        elif now > self.last:
+            # the longer since the last update, the more weight the new sample gets
+            alpha = 1 - math.exp(-(now - self.last) / self.window)
+            self.rate = self.rate + alpha * (max(processed - self.processed, 0) / (now - self.last) - self.rate)
+            self.weight = self.weight + alpha * (1 - self.weight)
+
+        current = set()
+        for job in running:
+            current.add(job.offset)
+            if job.offset not in self.started:
+                # jobs already running when we started were started at an unknown time, unless the job database knows
+                self.started[job.offset] = job.started or (self.last is not None and now or None)
+        for offset in [offset for offset in self.started if offset not in current]:
+            started = self.started.pop(offset)
+            if started is not None and state_of(offset) in PROCESSEDSTATES:
+                self.durations.append((now, now - started))
+        while self.durations and self.durations[0][0] < now - self.window:
+            self.durations.popleft()
+
+        self.last = now
+        self.processed = processed
+
+    def jobs_per_minute(self):
+        """
+        Return the number of jobs processed per minute, None if not known yet.
+        """
+
+        if not self.weight:
+            return None
+        return self.rate / self.weight * 60
+
+    def mean_duration(self):
+        """
+        Return the mean duration of the jobs completed within the window, None if there were none.
+        """
+
+        if not self.durations:
+            return None
+        return sum([d for (t, d) in self.durations]) / len(self.durations)
+
+    def eta(self, pending, now):
+        """
+        Return the number of seconds until all jobs are processed, None if not known:
+        the time running jobs still need (given their age), plus the time pending jobs need, spread over as many slots.
+        """
+
+        mean = self.mean_duration()
+        if mean is None or not self.started:
+            return None
+        remaining = [max(mean - (now - (started or self.first)), 0) for started in self.started.values()]
+        return (sum(remaining) + pending * mean) / len(remaining)
+
+
+def format_duration(seconds):
+    """
+    Return a number of seconds as H:MM:SS.
+    """
+
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
 def main():
     """
     Program entry point when run interactively.
     """
 
     # prepare option parser
-    parser = OptionParser(usage="usage: %prog [options] filename", description="Wait until all jobs in a text file are processed.", epilog="In the given file, each line beginning with a dot and a space (. ) will be executed. The file is modified to reflect the execution state of each job (r-running, d-done, !-failed, e-error).")
+    parser = OptionParser(usage="usage: %prog [options] filename", description="Wait until all jobs in a text file are processed.", epilog="In the given file, each line beginning with a dot and a space (. ) will be executed. The file is modified to reflect the execution state of each job (r-running, d-done, !-failed, e-error, t-timed out, o-out of memory).")
     parser.add_option("-e", "--use-exit-status", dest="use_exit_status", default=False, action="store_true", help="use exit status 0 only if all jobs are marked done [default: no]")
     parser.add_option("-p", "--progress", dest="progress", default=False, action="store_true", help="show progress while waiting [default: no]")
+    parser.add_option("-w", "--window", dest="window", type="float", default=300, action="store", help="estimate throughput and job durations from about the last NUMBER seconds [default: %default]", metavar="NUMBER")
+    parser.add_option("-J", "--json-interval", dest="json_interval", type="float", default=0, action="store", help="print progress as a line of JSON every NUMBER seconds, 0 meaning never [default: %default]", metavar="NUMBER")
 
     # parse options
     (options, args) = parser.parse_args()
@@ -129,36 +246,73 @@ def main():
 
     # process file
 
-    f = open(fname, 'rb', 0)
-
-    jobs = read_jobs(f)
-    states = list()
+    # job databases (as created by rundb4.py) are only asked for the number of jobs in each state, and the jobs being worked on
+    db = None
+    f = None
+    if fname.endswith(".db"):
+        db = sqlite3.connect(fname, timeout=60)
+    else:
+        f = open(fname, 'rb', 0)
+        jobs = read_jobs(f)
+    seen = None
+    estimator = Estimator(options.window)
+    next_json = 0
     while True:
-        old_states = states
-        refresh_job_states(f, jobs)
-        states = list((j.state for j in jobs))
-
-        count_unproc  = len(["." for j in jobs if j.state == '.'])
-        count_running = len(["." for j in jobs if j.state == 'r'])
-        count_failed  = len(["." for j in jobs if j.state == '!'])
-        count_error   = len(["." for j in jobs if j.state == 'e'])
-        count_done    = len(["." for j in jobs if j.state == 'd'])
-
-        if states != old_states:
+        if db:
+            (counts, running) = read_db_counts(db)
+            state_of = lambda number: (db.execute("SELECT state FROM jobs WHERE number = ?", (number,)).fetchone() or ('.',))[0]
+        else:
+            refresh_job_states(f, jobs)
+            counts = {}
+            for job in jobs:
+                counts[job.state] = counts.get(job.state, 0) + 1
+            running = [job for job in jobs if job.state in RUNNINGSTATES]
+            state_of = dict([(job.offset, job.state) for job in jobs]).get
+        count_jobs = sum(counts.values())
+        now = time.time()
+        estimator.update(sum([counts.get(state, 0) for state in PROCESSEDSTATES]), running, state_of, now)
+        rate = estimator.jobs_per_minute()
+        eta = estimator.eta(counts.get('.', 0), now)
+
+        count_unproc  = counts.get('.', 0)
+        count_running = sum([counts.get(state, 0) for state in RUNNINGSTATES])
+        count_failed  = counts.get('!', 0)
+        count_error   = counts.get('e', 0)
+        count_timeout = counts.get('t', 0)
+        count_oom     = counts.get('o', 0)
+        count_done    = counts.get('d', 0)
+
+        # show progress whenever jobs changed their state
+        old_seen = seen
+        seen = (sorted(counts.items()), sorted([job.offset for job in running]))
+        if seen != old_seen:
             if options.progress:
                 bar_len = 16
 
-                len_running   = int(1.0 * count_running/len(jobs)*bar_len)
-                len_failed    = int(1.0 * count_failed /len(jobs)*bar_len)
-                len_error     = int(1.0 * count_error  /len(jobs)*bar_len)
-                len_done      = int(1.0 * count_done   /len(jobs)*bar_len)
-
-                len_rest = bar_len - (len_running + len_failed + len_error + len_done)
-                bar_print = ("=" * len_done) + ("e" * len_error) + ("!" * len_failed) + (">" * len_running) + (" " * len_rest)
-                print("progress: %3d of %3d jobs processed, %d errors [%s]" % (count_failed + count_error + count_done, len(jobs), count_failed + count_error, bar_print))
-
-        if count_unproc + count_running == 0:
-            if options.use_exit_status and (count_done != len(jobs)):
+                len_running   = int(1.0 * count_running/count_jobs*bar_len)
+                len_failed    = int(1.0 * count_failed /count_jobs*bar_len)
+                len_error     = int(1.0 * count_error  /count_jobs*bar_len)
+                len_timeout   = int(1.0 * count_timeout/count_jobs*bar_len)
+                len_oom       = int(1.0 * count_oom    /count_jobs*bar_len)
+                len_done      = int(1.0 * count_done   /count_jobs*bar_len)
+
+                len_rest = bar_len - (len_running + len_failed + len_error + len_timeout + len_oom + len_done)
+                bar_print = ("=" * len_done) + ("e" * len_error) + ("t" * len_timeout) + ("o" * len_oom) + ("!" * len_failed) + (">" * len_running) + (" " * len_rest)
+                estimate = ""
+                if rate is not None:
+                    estimate = ", %.1f jobs/min" % rate
+                if eta is not None:
+                    estimate = estimate + ", ETA %s" % format_duration(eta)
+                print("progress: %3d of %3d jobs processed, %d errors [%s]%s" % (count_failed + count_error + count_timeout + count_oom + count_done, count_jobs, count_failed + count_error + count_timeout + count_oom, bar_print, estimate))
+
+        finished = (count_unproc + count_running == 0)
+        if options.json_interval and (now >= next_json or finished):
+            next_json = now + options.json_interval
+            print(json.dumps({"time": now, "jobs": count_jobs, "pending": count_unproc, "running": count_running, "done": count_done, "failed": count_failed, "error": count_error, "timeout": count_timeout, "oom": count_oom, "jobs_per_min": rate, "mean_duration_s": estimator.mean_duration(), "eta_s": eta}, sort_keys=True))
+            sys.stdout.flush()
+
+        if finished:
+            if options.use_exit_status and (count_done != count_jobs):
                 sys.exit(1)
             sys.exit(0)
 
@@ -0,0 +1,35 @@
+#
+# Regression test: runmaker4.py -r has to end once a parameter sweep another job runs after has used up its attempts.
+#
+
+import os
+import subprocess
+import sys
+
+RUNMAKER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "runmaker4.py")
+
+
+def run_jobs(tmp_path, lines, *args):
+    """
+    Write the given job lines to a job file, run runmaker4.py on it, and return the states of its lines.
+    """
+
+    fname = tmp_path / "runs.txt"
+    fname.write_text("".join(". %s\n" % line for line in lines))
+    subprocess.run([sys.executable, RUNMAKER] + list(args) + [str(fname)], cwd=str(tmp_path), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60, check=True)
+    return [line[0] for line in fname.read_text().splitlines()]
+
+
+def test_failed_sweep_ends_retries(tmp_path):
+    states = run_jobs(tmp_path, ['sh -c "exit {1..2}" #@ sweep label=sw', "echo after #@ after=sw"], "-r", "--backoff", "0.1")
+    assert states == ["!", "."]
+
+
+def test_failed_job_ends_retries(tmp_path):
+    states = run_jobs(tmp_path, ['sh -c "exit 1" #@ label=sw', "echo after #@ after=sw"], "-r", "--backoff", "0.1")
+    assert states == ["!", "."]
+
+
+def test_sweep_retry_then_after(tmp_path):
+    states = run_jobs(tmp_path, ['sh -c "exit {0..0}" #@ sweep label=sw', "echo after #@ after=sw"], "-r", "--backoff", "0.1")
+    assert states == ["d", "d"]